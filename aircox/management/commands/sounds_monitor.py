@@ -19,6 +19,15 @@ Where:
     'name' the title of the sound;
 
 
+Scans are incremental: files whose size, modification time and inode did
+not change since the last scan are skipped. These are kept in the index
+file given by the setting AIRCOX_SOUND_INDEX; use `--full` to read all
+files anyway.
+
+In monitor mode, filesystem events are coalesced by file until it has not
+been modified for a while (`--debounce`), then files are read by a bounded
+count of threads (`--jobs`) and synced to the database in batch.
+
 To check quality of files, call the command sound_quality_check using the
 parameters given by the setting AIRCOX_SOUND_QUALITY. This script requires
 Sox (and soxi).
@@ -27,21 +36,27 @@ from argparse import RawTextHelpFormatter
 import concurrent.futures as futures
 import datetime
 import atexit
+import bisect
+import json
 import logging
 import os
 import re
+import threading
 import time
 
 import mutagen
 from watchdog.observers import Observer
-from watchdog.events import PatternMatchingEventHandler, FileModifiedEvent
+from watchdog.events import PatternMatchingEventHandler
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
 from django.utils import timezone as tz
 from django.utils.translation import gettext as _
 
 from aircox import settings, utils
+from aircox.metrics import Registry
 from aircox.models import Diffusion, Program, Sound, Track
+from aircox.models.signals import sounds_synced
 from .import_playlist import PlaylistImport
 
 logger = logging.getLogger('aircox.commands')
@@ -55,9 +70,64 @@ sound_path_re = re.compile(
 )
 
 
+class FileInfo:
+    """
+    Information read from a sound file's metadata. Unlike mutagen's
+    objects, it can be passed between processes.
+    """
+    tag_names = ('album', 'year', 'tracknumber', 'title', 'artist')
+    """ Tags that are kept """
+    length = None
+    """ Duration in seconds """
+    tags = None
+    """ Tags by name, None if file has no tag """
+
+    def __init__(self, length=None, tags=None):
+        self.length = length
+        self.tags = tags
+
+
+def read_file_info(path):
+    """
+    Read metadata of the sound file at `path`. Return a FileInfo, or None
+    if the file does not exist or its format is unknown.
+
+    It does not use the database, so it can be run in worker processes.
+    """
+    if not os.path.exists(path):
+        return None
+    info = mutagen.File(path)
+    if info is None:
+        return None
+    tags = None
+    if info.tags:
+        tags = {name: info.tags.get(name) for name in FileInfo.tag_names
+                if name in info.tags}
+    return FileInfo(info.info.length, tags)
+
+
+def read_files_info(paths):
+    """
+    Return `(path, info, seconds)` for each of the given paths, where
+    seconds is the time spent reading it. Errors are logged and give no
+    info.
+    """
+    results = []
+    for path in paths:
+        start = time.monotonic()
+        try:
+            info = read_file_info(path)
+        except Exception as err:
+            logger.warning('sound %s: can not read file info: %s', path, err)
+            info = None
+        results.append((path, info, time.monotonic() - start))
+    return results
+
+
 class SoundFile:
     path = None
     info = None
+    """ FileInfo, if it has been read """
     path_info = None
     sound = None
 
@@ -81,16 +151,7 @@ class SoundFile:
         sound, created = Sound.objects.get_or_create(path=self.path, defaults=kwargs) \
                          if not sound else (sound, False)
         self.sound = sound
-
-        sound.program = program
-        if created or sound.check_on_file():
-            logger.info('sound is new or have been modified -> %s', self.path)
-            self.read_path()
-            sound.name = self.path_info.get('name')
-
-            self.read_file_info()
-            if self.info is not None:
-                sound.duration = utils.seconds_to_time(self.info.info.length)
+        self.update(sound, program, created)
 
         # check for episode
         if sound.episode is None and self.read_path():
@@ -101,6 +162,27 @@ class SoundFile:
             self.find_playlist(sound)
         return sound
 
+    def update(self, sound, program, created=False):
+        """
+        Update sound from the file, without saving it. File information and
+        metadata are read if the file is new or has been modified, in which
+        case True is returned.
+        """
+        sound.program = program
+        if not (sound.check_on_file() or created):
+            return False
+
+        logger.info('sound is new or have been modified -> %s', self.path)
+        self.read_path()
+        sound.name = self.path_info.get('name')
+
+        # info may have been read in advance (see `SoundScanner`)
+        if self.info is None:
+            self.read_file_info()
+        if self.info is not None:
+            sound.duration = utils.seconds_to_time(self.info.length)
+        return True
+
     def read_path(self):
         """
         Parse file name to get info on the assumption it has the correct
@@ -124,32 +206,43 @@ class SoundFile:
 
     def read_file_info(self):
         """ Read file information and metadata. """
-        if os.path.exists(self.path):
-            self.info = mutagen.File(self.path)
-        else:
-            self.info = None
+        self.info = read_file_info(self.path)
 
-    def find_episode(self, program):
+    def get_date(self):
         """
-        For a given program, check if there is an initial diffusion
-        to associate to, using the date info we have. Update self.sound
-        and save it consequently.
-
-        We only allow initial diffusion since there should be no
-        rerun.
+        Return the date or datetime of the episode's diffusion read from
+        the file name, or None.
         """
         pi = self.path_info
-        if 'year' not in pi or not self.sound or self.sound.episode:
+        if not pi or 'year' not in pi:
             return None
 
         if pi.get('hour') is not None:
             date = tz.datetime(pi.get('year'), pi.get('month'), pi.get('day'),
                                pi.get('hour') or 0, pi.get('minute') or 0)
-            date = tz.get_current_timezone().localize(date)
-        else:
-            date = datetime.date(pi.get('year'), pi.get('month'), pi.get('day'))
+            return tz.get_current_timezone().localize(date)
+        return datetime.date(pi.get('year'), pi.get('month'), pi.get('day'))
+
+    def find_episode(self, program, diffusions=None):
+        """
+        For a given program, check if there is an initial diffusion
+        to associate to, using the date info we have. Update self.sound
+        (without saving it).
+
+        If given, diffusions are looked up in DiffusionIndex `diffusions`
+        instead of the database.
+
+        We only allow initial diffusion since there should be no
+        rerun.
+        """
+        if not self.sound or self.sound.episode:
+            return None
+        date = self.get_date()
+        if date is None:
+            return None
 
-        diffusion = program.diffusion_set.at(date).first()
+        diffusion = diffusions.get(date) if diffusions is not None else \
+            program.diffusion_set.at(date).first()
         if not diffusion:
             return None
 
@@ -171,40 +264,659 @@ class SoundFile:
         if sound.track_set.count():
             return
 
+        track = self.read_playlist(sound, use_meta)
+        if track is not None:
+            track.save()
+
+    def read_playlist(self, sound, use_meta=True):
+        """
+        Import the playlist file corresponding to the sound path, if any.
+        Otherwise, return a track built from file's metadata (not saved)
+        if `use_meta` is True.
+        """
         # import playlist
-        path = os.path.splitext(self.sound.path)[0] + '.csv'
+        path = os.path.splitext(sound.path)[0] + '.csv'
         if os.path.exists(path):
             PlaylistImport(path, sound=sound).run()
         # use metadata
         elif use_meta:
             if self.info is None:
                 self.read_file_info()
-            if self.info.tags:
+            if self.info is not None and self.info.tags:
                 tags = self.info.tags
                 info = '{} ({})'.format(tags.get('album'), tags.get('year')) \
                     if ('album' and 'year' in tags) else tags.get('album') \
                     if 'album' in tags else tags.get('year', '')
 
-                track = Track(sound=sound,
-                              position=int(tags.get('tracknumber', 0)),
-                              title=tags.get('title', self.path_info['name']),
-                              artist=tags.get('artist', _('unknown')),
-                              info=info)
-                track.save()
+                return Track(sound=sound,
+                             position=int(tags.get('tracknumber', 0)),
+                             title=tags.get('title', self.path_info['name']),
+                             artist=tags.get('artist', _('unknown')),
+                             info=info)
+
+
+class DiffusionIndex:
+    """
+    In-memory index of a program's diffusions, used to match sound files
+    to episodes without a query per file. Dates and datetimes are matched
+    as `DiffusionQuerySet.at()` does.
+    """
+    diffusions = None
+    """ Diffusions ordered by start """
+    starts = None
+    """ Start of the diffusions """
+    by_date = None
+    """ First diffusion by (local) date """
+    max_duration = None
+    """ Longest duration of the diffusions """
+
+    def __init__(self, diffusions):
+        self.diffusions = list(diffusions)
+        self.starts = [diffusion.start for diffusion in self.diffusions]
+        self.by_date = {}
+        for diffusion in self.diffusions:
+            self.by_date.setdefault(tz.localtime(diffusion.start).date(),
+                                    diffusion)
+        self.max_duration = max((diffusion.end - diffusion.start
+                                 for diffusion in self.diffusions),
+                                default=tz.timedelta())
+
+    @classmethod
+    def load(cls, program, dates):
+        """
+        Load program's diffusions covering the given dates and datetimes,
+        in a single query.
+        """
+        current = tz.get_current_timezone()
+        bounds = []
+        for date in dates:
+            if isinstance(date, tz.datetime):
+                bounds.append(date)
+            else:
+                bounds += [tz.make_aware(tz.datetime.combine(date, time),
+                                         current)
+                           for time in (datetime.time(),
+                                        datetime.time(23, 59, 59, 999))]
+        if not bounds:
+            return cls([])
+        return cls(program.diffusion_set.filter(start__lte=max(bounds),
+                                                end__gte=min(bounds))
+                                        .select_related('episode')
+                                        .order_by('start'))
+
+    def get(self, date):
+        """ Return first diffusion at the given date or datetime. """
+        if not isinstance(date, tz.datetime):
+            return self.by_date.get(date)
+
+        # diffusions starting before date, and not ending before it
+        start = bisect.bisect_left(self.starts, date - self.max_duration)
+        end = bisect.bisect_right(self.starts, date)
+        return next((diffusion for diffusion in self.diffusions[start:end]
+                     if diffusion.end >= date), None)
+
+
+class SoundWriter:
+    """
+    Synchronise sound files with the database in bulk, in a transaction
+    per program. It is used from one thread only, such as database is
+    written from a single place.
+
+    Since bulk operations do not send `post_save`, `sounds_synced` is sent
+    once sounds of a program have been written.
+    """
+    batch_size = 1000
+    """ Count of pending sound files of a program before they are written """
+    fields = ('path', 'program', 'episode', 'type', 'name', 'duration', 'mtime',
+              'is_good_quality')
+    """ Updated sounds' fields """
+    items = None
+    """ Pending `(sound_file, sound, sound_kwargs)` by program """
+    removed = None
+    """ Pks of removed sounds by program """
+    count = 0
+    """ Count of written sound files """
+    duration = 0
+    """ Time spent writing in seconds """
+
+    def __init__(self, batch_size=None):
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.items = {}
+        self.removed = {}
+
+    def add(self, sound_file, sound=None, program=None, **sound_kwargs):
+        """
+        Add sound file to be synced with `sound` (created using
+        `sound_kwargs` if None).
+        """
+        items = self.items.setdefault(program, [])
+        items.append((sound_file, sound, sound_kwargs))
+        if len(items) >= self.batch_size:
+            self.flush(program)
+
+    def remove(self, program, pk):
+        """ Mark the sound as removed. """
+        self.removed.setdefault(program, []).append(pk)
+
+    def flush(self, program=None):
+        """ Write pending sounds of the given program, or of all of them. """
+        programs = [program] if program is not None else \
+            set(self.items) | set(self.removed)
+        for program in programs:
+            items = self.items.pop(program, [])
+            removed = self.removed.pop(program, [])
+            start = time.monotonic()
+            with transaction.atomic():
+                self.write(program, items, removed)
+            sounds_synced.send(Sound, program=program)
+            self.count += len(items) + len(removed)
+            self.duration += time.monotonic() - start
+
+    def write(self, program, items, removed):
+        created, updated, unmatched = [], {}, []
+        for sound_file, sound, sound_kwargs in items:
+            if sound is None:
+                sound = Sound(path=sound_file.path, program=program,
+                              **sound_kwargs)
+                created.append(sound)
+            sound_file.sound = sound
+            if sound_file.update(sound, program, sound.pk is None) and \
+                    sound.pk is not None:
+                updated[sound.pk] = sound
+            if sound.episode is None and sound_file.read_path():
+                unmatched.append(sound_file)
+
+        # unchanged sounds are only updated when an episode is found
+        if unmatched:
+            diffusions = DiffusionIndex.load(
+                program, [sound_file.get_date() for sound_file in unmatched])
+            for sound_file in unmatched:
+                sound = sound_file.sound
+                if sound_file.find_episode(program, diffusions) and \
+                        sound.pk is not None:
+                    updated[sound.pk] = sound
+
+        if removed:
+            Sound.objects.filter(pk__in=removed) \
+                         .update(type=Sound.TYPE_REMOVED)
+        if created:
+            Sound.objects.bulk_create(created)
+            # not all database backends set pks on bulk create
+            if created[0].pk is None:
+                pks = dict(Sound.objects.filter(program=program)
+                                        .values_list('path', 'pk'))
+                for sound in created:
+                    sound.pk = pks[sound.path]
+        if updated:
+            Sound.objects.bulk_update(updated.values(), self.fields)
+        self.write_playlists(program, [item[0] for item in items
+                                       if item[0].info is not None])
+
+    def write_playlists(self, program, sound_files):
+        """ Import playlists of sounds that have no track yet. """
+        if not sound_files:
+            return
+        sounds = set(Track.objects.filter(sound__program=program)
+                                  .values_list('sound_id', flat=True))
+        tracks = (sound_file.read_playlist(sound_file.sound)
+                  for sound_file in sound_files
+                  if sound_file.sound.pk not in sounds)
+        Track.objects.bulk_create(track for track in tracks
+                                  if track is not None)
+
+
+class FileIndex:
+    """
+    Persistent index of sound files' `[size, mtime_ns, inode]` by path, as
+    of the last scan. It completes sounds' `mtime` (stored with a precision
+    of one second) in order to detect changes without reading the files.
+    """
+    path = None
+    """ Path to the index file """
+    entries = None
+    """ Index entries by sound file path """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        """ Write index to file (replaced atomically). """
+        utils.atomic_write(self.path, json.dumps(self.entries))
+
+
+class SoundScanner:
+    """
+    Scan programs' directories for changes, incrementally: files are
+    compared against an index of sounds loaded in a single query and a
+    FileIndex, and only new, modified and vanished ones are synced.
+
+    Metadata of new and modified files are read by `jobs` worker
+    processes, while the database is written by a single SoundWriter.
+    """
+    jobs = 1
+    """ Count of processes reading files' metadata """
+    chunk_size = 20
+    """ Count of files read by a worker in a single task """
+    writer = None
+    """ SoundWriter """
+    index = None
+    """ FileIndex """
+    full = False
+    """ If True, all files are read, whatever the FileIndex says """
+    sounds = None
+    """
+    Sounds as `(pk, mtime timestamp, type, episode_id)` by directory and
+    path
+    """
+    files = 0
+    """ Count of scanned files """
+    read = 0
+    """ Count of files whose metadata have been read """
+    synced = 0
+    """ Count of synced files (including read and vanished ones) """
+    timings = None
+    """ Time spent in seconds by phase """
+
+    def __init__(self, jobs=None, batch_size=None, index_path=None,
+                 full=False):
+        if jobs is not None:
+            self.jobs = jobs
+        self.full = full
+        self.writer = SoundWriter(batch_size)
+        self.index = FileIndex(index_path or settings.AIRCOX_SOUND_INDEX)
+        self.timings = {'list': 0, 'read': 0, 'write': 0, 'total': 0}
+
+    def scan(self, programs):
+        """ Scan directories of the given programs. """
+        start = time.monotonic()
+        self.load_index()
+        pending, modified = {}, set()
+        for program in programs:
+            logger.info('#%d %s', program.id, program.title)
+            self.scan_dir(program, settings.AIRCOX_SOUND_ARCHIVES_SUBDIR,
+                          pending, modified, type=Sound.TYPE_ARCHIVE)
+            self.scan_dir(program, settings.AIRCOX_SOUND_EXCERPTS_SUBDIR,
+                          pending, modified, type=Sound.TYPE_EXCERPT)
+
+        # fetch sounds to be synced at once
+        sounds = Sound.objects.in_bulk(
+            sync_kwargs['sound'] for _, sync_kwargs in pending.values()
+            if sync_kwargs['sound'] is not None)
+        for path, (_, sync_kwargs) in pending.items():
+            sound = sync_kwargs['sound'] = sounds.get(sync_kwargs['sound'])
+            if sound is not None and path in modified:
+                # file is known to be modified, even within the second of
+                # its mtime: make sure `check_on_file()` reports it.
+                sound.mtime = None
+        self.synced += len(pending)
+        self.timings['list'] = time.monotonic() - start
+
+        self.read_files(pending, modified)
+        self.writer.flush()
+        self.index.save()
+        self.timings['write'] = self.writer.duration
+        self.timings['total'] = time.monotonic() - start
+
+    def load_index(self):
+        """ Load sounds' index from database, and the file index. """
+        if not self.full:
+            self.index.load()
+        self.sounds = {}
+        sounds = Sound.objects.filter(path__isnull=False).values_list(
+            'path', 'pk', 'mtime', 'type', 'episode_id')
+        for path, pk, mtime, type, episode_id in sounds:
+            mtime = mtime and int(mtime.timestamp())
+            self.sounds.setdefault(os.path.dirname(path), {})[path] = \
+                (pk, mtime, type, episode_id)
+
+    def scan_dir(self, program, subdir, pending, modified, **sound_kwargs):
+        """
+        Scan a given directory that is associated to the given program.
+        Files to sync are added to `pending` as `(sound_file, sync_kwargs)`
+        by path, with the sound's pk as `sync_kwargs['sound']`. Paths of
+        new and modified files are added to `modified`.
+
+        Unchanged files are skipped, unless their sound still has to be
+        associated to an episode.
+        """
+        logger.info('- %s/', subdir)
+        if not program.ensure_dir(subdir):
+            return
+
+        subdir = os.path.join(program.path, subdir)
+        sounds = self.sounds.pop(subdir, {})
+        with os.scandir(subdir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(settings.AIRCOX_SOUND_FILE_EXT) \
+                        or not entry.is_file():
+                    continue
+
+                self.files += 1
+                stat = entry.stat()
+                key = [stat.st_size, stat.st_mtime_ns, entry.inode()]
+                sound = sounds.pop(entry.path, None)
+                sound_file = SoundFile(entry.path)
+                changed = self.is_changed(entry.path, sound, stat, key)
+                self.index.entries[entry.path] = key
+                if changed:
+                    modified.add(entry.path)
+                elif sound[3] is not None or not sound_file.read_path():
+                    continue
+
+                pending[entry.path] = (sound_file, dict(
+                    sound_kwargs, program=program,
+                    sound=sound and sound[0]))
+
+        # vanished files
+        for path, sound in sounds.items():
+            self.index.entries.pop(path, None)
+            if sound[2] != Sound.TYPE_REMOVED:
+                logger.info('sound %s: has been removed', path)
+                self.writer.remove(program, sound[0])
+                self.synced += 1
+
+    def is_changed(self, path, sound, stat, key):
+        """
+        Return True if file is new, restored or modified according to its
+        sound's mtime or its FileIndex entry.
+        """
+        if sound is None or self.full:
+            return True
+        pk, mtime, type, episode_id = sound
+        return type == Sound.TYPE_REMOVED or mtime != int(stat.st_mtime) \
+            or self.index.entries.get(path, key) != key
+
+    def read_files(self, pending, modified):
+        """
+        Read metadata of modified files, and add all pending ones to the
+        writer.
+        """
+        paths = []
+        for path, (sound_file, sync_kwargs) in pending.items():
+            if path in modified:
+                paths.append(path)
+            else:
+                self.writer.add(sound_file, **sync_kwargs)
+
+        self.read += len(paths)
+        chunks = [paths[i:i+self.chunk_size]
+                  for i in range(0, len(paths), self.chunk_size)]
+        if self.jobs <= 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                self.on_read(pending, read_files_info(chunk))
+            return
+
+        # database connections must not be shared with worker processes
+        connections.close_all()
+        with futures.ProcessPoolExecutor(self.jobs) as pool:
+            tasks = [pool.submit(read_files_info, chunk) for chunk in chunks]
+            for task in futures.as_completed(tasks):
+                self.on_read(pending, task.result())
+
+    def on_read(self, pending, results):
+        for path, info, duration in results:
+            sound_file, sync_kwargs = pending[path]
+            sound_file.info = info
+            self.timings['read'] += duration
+            self.writer.add(sound_file, **sync_kwargs)
+
+
+class PathEvents:
+    """ Events of a file, coalesced until they are handled. """
+    SYNC = 'sync'
+    MOVE = 'move'
+    DELETE = 'delete'
+
+    action = None
+    """ What to do with the file (one of SYNC, MOVE, DELETE) """
+    src = None
+    """
+    For MOVE, previous path of the file. It is kept when the moved file is
+    then deleted, such as both sounds are removed.
+    """
+    sound_kwargs = None
+    """ Arguments used to create the file's sound """
+    first = None
+    """ Monotonic time of the first event """
+    last = None
+    """ Monotonic time of the last event """
+    info = None
+    """ FileInfo, once read """
+
+    def __init__(self, action, now, src=None, **sound_kwargs):
+        self.action = action
+        self.src = src
+        self.sound_kwargs = sound_kwargs
+        self.first = self.last = now
+
+    def push(self, action, now, src=None, **sound_kwargs):
+        """ Coalesce a new event. """
+        self.last = now
+        # a moved file stays moved when it is modified later
+        if action == self.DELETE and self.action == self.MOVE:
+            self.action = action
+        elif action != self.SYNC or self.action == self.DELETE:
+            self.action, self.src = action, src
+        self.sound_kwargs.update(sound_kwargs)
+
+
+class EventPipeline:
+    """
+    Handle sound files' events (from watchdog). Events are coalesced by
+    path until the file has been quiet for `debounce` seconds. Files are
+    then read by at most `jobs` threads, with a single job at a time per
+    path. The database is written in batch from the thread processing the
+    pipeline (see `process()`).
+
+    Queue depth and latency from the first event of a file until its sound
+    is written are measured.
+    """
+    debounce = 5.0
+    """ Time in seconds a file must be quiet before being handled """
+    jobs = 2
+    """ Max count of files being read at once """
+    pending = None
+    """ PathEvents waiting for the file to be quiet, by path """
+    running = None
+    """ PathEvents being read or written, by path """
+    writer = None
+    """ SoundWriter """
+    programs = None
+    """ Programs by directory path """
+    events = 0
+    """ Count of received events """
+    written = 0
+    """ Count of handled files """
+    latency = None
+    """ Latency in seconds from events to database: `[sum, max]` """
+
+    def __init__(self, debounce=None, jobs=None, executor=None):
+        if debounce is not None:
+            self.debounce = debounce
+        if jobs is not None:
+            self.jobs = jobs
+        self.executor = executor
+        self.pending, self.running = {}, {}
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.writer = SoundWriter()
+        self.programs = {}
+        self.latency = [0, 0]
+
+    @property
+    def queue_depth(self):
+        """ Count of files waiting or being handled. """
+        return len(self.pending) + len(self.running)
+
+    def push(self, path, action, src=None, **sound_kwargs):
+        """ Add an event (thread-safe). """
+        now = time.monotonic()
+        with self.lock:
+            self.events += 1
+            if action == PathEvents.MOVE:
+                self.pending.pop(src, None)
+            events = self.pending.get(path)
+            if events is None:
+                self.pending[path] = PathEvents(action, now, src,
+                                                **sound_kwargs)
+            else:
+                events.push(action, now, src, **sound_kwargs)
+
+    def process(self, now=None, timeout=0):
+        """
+        Dispatch quiet files to be read, and write the ones that have been
+        read (waiting at most `timeout` seconds for them).
+        """
+        self.dispatch(time.monotonic() if now is None else now)
+        if not self.futures:
+            return
+        done, _ = futures.wait(self.futures, timeout)
+        if done:
+            self.write([self.futures.pop(future) for future in done])
+
+    def dispatch(self, now):
+        """ Submit quiet files to the executor, up to `jobs` of them. """
+        with self.lock:
+            quiet = [path for path, events in self.pending.items()
+                     if now - events.last >= self.debounce and
+                     path not in self.running]
+            for path in quiet[:max(0, self.jobs - len(self.running))]:
+                events = self.running[path] = self.pending.pop(path)
+                future = self.executor.submit(self.read, path, events)
+                self.futures[future] = path
+
+    def read(self, path, events):
+        if events.action != PathEvents.DELETE:
+            events.info = read_files_info([path])[0][1]
+
+    def get_program(self, path):
+        """ Return program of the file at the given path. """
+        dirname = os.path.dirname(os.path.dirname(path))
+        if dirname not in self.programs:
+            self.programs = {program.path: program
+                             for program in Program.objects.all()}
+        return self.programs.get(dirname)
+
+    def write(self, paths):
+        """ Sync sounds of the given paths in the database. """
+        running = {path: self.running[path] for path in paths}
+        try:
+            sources = [events.src for events in running.values()
+                       if events.src is not None]
+            sounds = {sound.path: sound for sound in Sound.objects.filter(
+                path__in=list(running) + sources)}
+            for path, events in running.items():
+                program = self.get_program(path)
+                if program is None:
+                    logger.warning('sound %s: no program found', path)
+                    continue
+
+                sound = sounds.get(path)
+                if events.action == PathEvents.DELETE:
+                    for sound in (sound, sounds.get(events.src)):
+                        if sound is not None and \
+                                sound.type != Sound.TYPE_REMOVED:
+                            self.writer.remove(program, sound.pk)
+                    continue
+
+                if events.action == PathEvents.MOVE:
+                    moved = sounds.get(events.src)
+                    if sound is None and moved is not None:
+                        # keep moved sound, mtime is reset to have it saved
+                        sound = moved
+                        sound.path, sound.mtime = path, None
+                        sound.type = events.sound_kwargs['type']
+                    elif moved is not None:
+                        self.writer.remove(program, moved.pk)
+
+                sound_file = SoundFile(path)
+                sound_file.info = events.info
+                self.writer.add(sound_file, sound=sound, program=program,
+                                **events.sound_kwargs)
+
+            self.writer.flush()
+        finally:
+            now = time.monotonic()
+            with self.lock:
+                for path, events in running.items():
+                    del self.running[path]
+                    latency = now - events.first
+                    self.latency[0] += latency
+                    self.latency[1] = max(self.latency[1], latency)
+                self.written += len(running)
+
+    def get_metrics(self):
+        """ Return a Registry holding current metrics. """
+        registry, name = Registry(), 'aircox_sounds_monitor_'
+        registry.gauge(name + 'queue_depth',
+                       'Files waiting or being handled') \
+                .set(self.queue_depth)
+        registry.counter(name + 'events_total',
+                         'Received filesystem events').inc(self.events)
+        registry.counter(name + 'writes_total',
+                         'Files synced to the database').inc(self.written)
+        registry.counter(name + 'latency_seconds_sum',
+                         'Time from files\' first event to their sync') \
+                .inc(self.latency[0])
+        registry.gauge(name + 'latency_seconds_max',
+                       'Max time from a file\'s first event to its sync') \
+                .set(self.latency[1])
+        return registry
+
+    def dump_metrics(self, path):
+        """ Write metrics to file (replaced atomically). """
+        self.get_metrics().dump(path)
+
+    def run(self, interval=1.0, report_interval=10.0, metrics_path=None):
+        """
+        Process the pipeline forever; log metrics every `report_interval`
+        seconds, and dump them to `metrics_path` if given.
+        """
+        next_report = time.monotonic() + report_interval
+        with futures.ThreadPoolExecutor(self.jobs) as executor:
+            self.executor = executor
+            while True:
+                try:
+                    self.process(timeout=interval)
+                except Exception as err:
+                    logger.exception('sounds sync failed: %s', err)
+
+                now = time.monotonic()
+                if now >= next_report:
+                    logger.info('queue depth: %d, events: %d, synced: %d, '
+                                'latency mean: %.2fs, max: %.2fs',
+                                self.queue_depth, self.events, self.written,
+                                self.latency[0] / (self.written or 1),
+                                self.latency[1])
+                    next_report = now + report_interval
+                    if metrics_path:
+                        self.dump_metrics(metrics_path)
+                if not self.futures:
+                    time.sleep(interval)
 
 
 class MonitorHandler(PatternMatchingEventHandler):
     """
     Event handler for watchdog, in order to be used in monitoring.
     """
-    pool = None
+    pipeline = None
+    """ EventPipeline handling the events """
 
-    def __init__(self, subdir, pool):
+    def __init__(self, subdir, pipeline):
         """
         subdir: AIRCOX_SOUND_ARCHIVES_SUBDIR or AIRCOX_SOUND_EXCERPTS_SUBDIR
         """
         self.subdir = subdir
-        self.pool = pool
+        self.pipeline = pipeline
 
         if self.subdir == settings.AIRCOX_SOUND_ARCHIVES_SUBDIR:
             self.sound_kwargs = {'type': Sound.TYPE_ARCHIVE}
@@ -219,24 +931,18 @@ class MonitorHandler(PatternMatchingEventHandler):
         self.on_modified(event)
 
     def on_modified(self, event):
-        logger.info('sound modified: %s', event.src_path)
-        def updated(event, sound_kwargs):
-            SoundFile(event.src_path).sync(**sound_kwargs)
-        self.pool.submit(updated, event, self.sound_kwargs)
+        logger.debug('sound modified: %s', event.src_path)
+        self.pipeline.push(event.src_path, PathEvents.SYNC,
+                           **self.sound_kwargs)
 
     def on_moved(self, event):
         logger.info('sound moved: %s -> %s', event.src_path, event.dest_path)
-        def moved(event, sound_kwargs):
-            sound = Sound.objects.filter(path=event.src_path)
-            sound_file = SoundFile(event.dest_path) if not sound else sound
-            sound_file.sync(**sound_kwargs)
-        self.pool.submit(moved, event, self.sound_kwargs)
+        self.pipeline.push(event.dest_path, PathEvents.MOVE,
+                           src=event.src_path, **self.sound_kwargs)
 
     def on_deleted(self, event):
         logger.info('sound deleted: %s', event.src_path)
-        def deleted(event):
-            SoundFile(event.src_path).sync(deleted=True)
-        self.pool.submit(deleted, event.src_path)
+        self.pipeline.push(event.src_path, PathEvents.DELETE)
 
 
 class Command(BaseCommand):
@@ -250,80 +956,45 @@ class Command(BaseCommand):
             logger.info('%s, %s: %s', str(program), str(component),
                         ' '.join([str(c) for c in content]))
 
-    def scan(self):
+    def scan(self, jobs=1, full=False):
         """
         For all programs, scan dirs
         """
         logger.info('scan all programs...')
-        programs = Program.objects.filter()
+        scanner = SoundScanner(jobs, full=full)
+        scanner.scan(Program.objects.all())
 
-        dirs = []
-        for program in programs:
-            logger.info('#%d %s', program.id, program.title)
-            self.scan_for_program(
-                program, settings.AIRCOX_SOUND_ARCHIVES_SUBDIR,
-                type=Sound.TYPE_ARCHIVE,
-            )
-            self.scan_for_program(
-                program, settings.AIRCOX_SOUND_EXCERPTS_SUBDIR,
-                type=Sound.TYPE_EXCERPT,
-            )
-            dirs.append(os.path.join(program.path))
+        timings = scanner.timings
+        logger.info('scanned %d files (%d synced, %d read) in %.2fs: '
+                    '%.1f files/s', scanner.files, scanner.synced,
+                    scanner.read, timings['total'],
+                    scanner.files / (timings['total'] or 1))
+        logger.info('time spent listing: %.2fs, reading (in workers): '
+                    '%.2fs, writing: %.2fs', timings['list'],
+                    timings['read'], timings['write'])
 
-    def scan_for_program(self, program, subdir, **sound_kwargs):
-        """
-        Scan a given directory that is associated to the given program, and
-        update sounds information.
-        """
-        logger.info('- %s/', subdir)
-        if not program.ensure_dir(subdir):
-            return
-
-        subdir = os.path.join(program.path, subdir)
-        sounds = []
-
-        # sounds in directory
-        for path in os.listdir(subdir):
-            path = os.path.join(subdir, path)
-            if not path.endswith(settings.AIRCOX_SOUND_FILE_EXT):
-                continue
-
-            sound_file = SoundFile(path)
-            sound_file.sync(program=program, **sound_kwargs)
-            sounds.append(sound_file.sound.pk)
-
-        # sounds in db & unchecked
-        sounds = Sound.objects.filter(path__startswith=subdir). \
-            exclude(pk__in=sounds)
-        self.check_sounds(sounds, program=program)
-
-    def check_sounds(self, qs, **sync_kwargs):
-        """ Only check for the sound existence or update """
-        # check files
-        for sound in qs:
-            if sound.check_on_file():
-                SoundFile(sound.path).sync(sound=sound, **sync_kwargs)
-
-    def monitor(self):
+    def monitor(self, jobs=1, debounce=EventPipeline.debounce,
+                metrics_path=None):
         """ Run in monitor mode """
-        with futures.ThreadPoolExecutor() as pool:
-            archives_handler = MonitorHandler(settings.AIRCOX_SOUND_ARCHIVES_SUBDIR, pool)
-            excerpts_handler = MonitorHandler(settings.AIRCOX_SOUND_EXCERPTS_SUBDIR, pool)
-
-            observer = Observer()
-            observer.schedule(archives_handler, settings.AIRCOX_PROGRAMS_DIR,
-                              recursive=True)
-            observer.schedule(excerpts_handler, settings.AIRCOX_PROGRAMS_DIR,
-                              recursive=True)
-            observer.start()
-
-            def leave():
-                observer.stop()
-                observer.join()
-            atexit.register(leave)
+        pipeline = EventPipeline(debounce, jobs)
+        archives_handler = MonitorHandler(
+            settings.AIRCOX_SOUND_ARCHIVES_SUBDIR, pipeline)
+        excerpts_handler = MonitorHandler(
+            settings.AIRCOX_SOUND_EXCERPTS_SUBDIR, pipeline)
 
-            while True:
-                time.sleep(1)
+        observer = Observer()
+        observer.schedule(archives_handler, settings.AIRCOX_PROGRAMS_DIR,
+                          recursive=True)
+        observer.schedule(excerpts_handler, settings.AIRCOX_PROGRAMS_DIR,
+                          recursive=True)
+        observer.start()
+
+        def leave():
+            observer.stop()
+            observer.join()
+        atexit.register(leave)
+
+        pipeline.run(metrics_path=metrics_path)
 
     def add_arguments(self, parser):
         parser.formatter_class = RawTextHelpFormatter
@@ -337,16 +1008,37 @@ class Command(BaseCommand):
             help='Scan programs directories for changes, plus check for a '
                  ' matching diffusion on sounds that have not been yet assigned'
         )
+        parser.add_argument(
+            '--full', action='store_true',
+            help='When scanning, read all files instead of skipping the ones '
+                 'unchanged since the last scan'
+        )
+        parser.add_argument(
+            '-j', '--jobs', type=int, default=1,
+            help='Count of processes (when scanning) or threads (when '
+                 'monitoring) reading sound files metadata'
+        )
         parser.add_argument(
             '-m', '--monitor', action='store_true',
             help='Run in monitor mode, watch for modification in the filesystem '
                  'and react in consequence'
         )
+        parser.add_argument(
+            '--debounce', type=float, default=EventPipeline.debounce,
+            help='When monitoring, time in SECONDS a file must not be '
+                 'modified before being synced'
+        )
+        parser.add_argument(
+            '--metrics', type=str, default=None,
+            help='When monitoring, write metrics in Prometheus text format '
+                 'to this file'
+        )
 
     def handle(self, *args, **options):
         if options.get('scan'):
-            self.scan()
+            self.scan(options.get('jobs') or 1, options.get('full'))
         #if options.get('quality_check'):
         #    self.check_quality(check=(not options.get('scan')))
         if options.get('monitor'):
-            self.monitor()
+            self.monitor(options.get('jobs') or 1, options.get('debounce'),
+                         options.get('metrics'))
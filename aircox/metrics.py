@@ -0,0 +1,198 @@
+"""
+Metrics rendered in Prometheus text format: counters, gauges and
+histograms, whose values are stored by labels, grouped in registries.
+"""
+import bisect
+import threading
+
+from .utils import atomic_write
+
+
+__all__ = ['Metric', 'Counter', 'Gauge', 'Histogram', 'Registry']
+
+
+class Metric:
+    """ Base class for metrics, whose values are stored by labels. """
+    type = None
+    name = None
+    help = None
+    labels = ()
+    """ Labels' names """
+
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        if labels is not None:
+            self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def format_labels(self, key, **extra):
+        labels = list(zip(self.labels, key)) + list(extra.items())
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                              for k, v in labels) + '}'
+
+    def dump_state(self, label):
+        """ Return values whose first label's value is `label`. """
+        label = str(label)
+        with self.lock:
+            return {key: self.copy(value)
+                    for key, value in self.values.items()
+                    if key[:1] == (label,)}
+
+    def load_state(self, state):
+        """ Set values from a state returned by `dump_state`. """
+        with self.lock:
+            self.values.update(state)
+
+    def copy(self, value):
+        return value
+
+    def render(self):
+        """ Return metric as Prometheus text lines. """
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines += self.render_value(key, value)
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.get_key(labels), 0)
+
+    def render_value(self, key, value):
+        return ['{}{} {}'.format(self.name, self.format_labels(key), value)]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Histogram, whose values are stored as `[bucket counts, sum, count]`.
+    """
+    type = 'histogram'
+    buckets = (.001, .005, .01, .05, .1, .5, 1, 5, 10, 30)
+    """ Buckets' upper bounds """
+
+    def __init__(self, name, help, labels=None, buckets=None):
+        super().__init__(name, help, labels)
+        if buckets is not None:
+            self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            data = self.values.get(key)
+            if data is None:
+                data = self.values[key] = [[0] * len(self.buckets), 0, 0]
+            if index < len(self.buckets):
+                data[0][index] += 1
+            data[1] += value
+            data[2] += 1
+
+    def get(self, **labels):
+        """ Return `(sum, count)` of observed values. """
+        data = self.values.get(self.get_key(labels))
+        return (data[1], data[2]) if data else (0, 0)
+
+    def copy(self, value):
+        return [list(value[0]), value[1], value[2]]
+
+    def render_value(self, key, value):
+        lines, total = [], 0
+        for bound, count in zip(self.buckets, value[0]):
+            total += count
+            lines.append('{}_bucket{} {}'.format(
+                self.name, self.format_labels(key, le=bound), total))
+        lines += [
+            '{}_bucket{} {}'.format(self.name,
+                                    self.format_labels(key, le='+Inf'),
+                                    value[2]),
+            '{}_sum{} {}'.format(self.name, self.format_labels(key),
+                                 value[1]),
+            '{}_count{} {}'.format(self.name, self.format_labels(key),
+                                   value[2]),
+        ]
+        return lines
+
+
+class Registry:
+    """ Set of metrics. """
+    metrics = None
+    """ Metrics by name """
+    labels = ()
+    """ Default labels' names of metrics created by the registry """
+
+    def __init__(self, labels=None):
+        self.metrics = {}
+        if labels is not None:
+            self.labels = labels
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=None, **kwargs):
+        return self.register(Counter(
+            name, help, self.labels if labels is None else labels, **kwargs))
+
+    def gauge(self, name, help, labels=None, **kwargs):
+        return self.register(Gauge(
+            name, help, self.labels if labels is None else labels, **kwargs))
+
+    def histogram(self, name, help, labels=None, **kwargs):
+        return self.register(Histogram(
+            name, help, self.labels if labels is None else labels, **kwargs))
+
+    def copy(self):
+        """ Return an empty registry with the same metrics. """
+        copy = Registry(self.labels)
+        for metric in self.metrics.values():
+            kwargs = {'buckets': metric.buckets} \
+                if isinstance(metric, Histogram) else {}
+            copy.register(type(metric)(metric.name, metric.help,
+                                       metric.labels, **kwargs))
+        return copy
+
+    def dump_state(self, label):
+        """
+        Return values of all metrics whose first label's value is `label`.
+        """
+        return {name: metric.dump_state(label)
+                for name, metric in self.metrics.items()}
+
+    def load_state(self, state):
+        for name, values in state.items():
+            if name in self.metrics:
+                self.metrics[name].load_state(values)
+
+    def render(self):
+        """ Return metrics in Prometheus text format. """
+        return '\n'.join(line for metric in self.metrics.values()
+                         for line in metric.render()) + '\n'
+
+    def dump(self, path):
+        """ Write metrics to file (replaced atomically). """
+        atomic_write(path, self.render())
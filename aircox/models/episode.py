@@ -212,7 +212,7 @@ class Diffusion(BaseRerun):
 
     def save_initial(self):
         self.program = self.episode.program
-        if self.episode != self._initial['episode']:
+        if self.episode_id != self._initial['episode']:
             self.rerun_set.update(episode=self.episode, program=self.program)
 
     @property
@@ -312,7 +312,8 @@ class Diffusion(BaseRerun):
         self._initial = {
             'start': self.start,
             'end': self.end,
-            'episode': getattr(self, 'episode', None),
+            # use id: accessing episode would query it for each instance
+            'episode': self.episode_id,
         }
 
 
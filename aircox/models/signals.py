@@ -3,13 +3,20 @@ import pytz
 from django.contrib.auth.models import User, Group, Permission
 from django.db import transaction
 from django.db.models import F, signals
-from django.dispatch import receiver
+from django.dispatch import Signal, receiver
 from django.utils import timezone as tz
 
 from .. import settings, utils
 from . import Diffusion, Episode, Page, Program, Schedule
 
 
+sounds_synced = Signal()
+"""
+Sent with the `program` argument once its sounds have been created or
+updated in bulk (e.g. by sounds_monitor), as `post_save` is not sent then.
+"""
+
+
 # Add a default group to a user when it is created. It also assigns a list
 # of permissions to the group if it is created.
 #
@@ -156,9 +156,8 @@ class Sound(models.Model):
         Get the last modification date from file
         """
         mtime = os.stat(self.path).st_mtime
-        mtime = tz.datetime.fromtimestamp(mtime)
-        mtime = mtime.replace(microsecond=0)
-        return tz.make_aware(mtime, tz.get_current_timezone())
+        mtime = tz.datetime.fromtimestamp(mtime, tz.utc)
+        return mtime.replace(microsecond=0)
 
     def file_exists(self):
         """ Return true if the file still exists. """
@@ -130,12 +130,24 @@ ensure(
     ('.ogg', '.flac', '.wav', '.mp3', '.opus')
 )
 
+# Index of sound files as of the last scan, used by sounds_monitor to skip
+# unchanged files. It is kept out of the programs directory, which users
+# may write to and which is served as media.
+ensure('AIRCOX_SOUND_INDEX',
+       os.path.join(settings.PROJECT_ROOT, 'cache/sounds_index.json'))
+
 
 ########################################################################
 # Streamer & Controllers
 ########################################################################
 # Controllers working directory
 ensure('AIRCOX_CONTROLLERS_WORKING_DIR', '/tmp/aircox')
+# Generate the rotation order of streamed programs' sounds instead of
+# letting liquidsoap shuffle them: stream's delay is then the minimal
+# delay between two plays of the same sound.
+ensure('AIRCOX_STREAMER_ROTATION', False)
+# Count of sounds written ahead in rotation playlists
+ensure('AIRCOX_STREAMER_ROTATION_SIZE', 10)
 
 
 ########################################################################
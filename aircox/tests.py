@@ -1,12 +1,24 @@
 import datetime
 import calendar
+import concurrent.futures as futures
 import logging
+import os
+import tempfile
+import time
+from unittest import mock
+import wave
 from dateutil.relativedelta import relativedelta
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone as tz
 
+from aircox import settings
+from aircox.management.commands.sounds_monitor import EventPipeline, \
+    PathEvents, SoundScanner
 from aircox.models import *
+from aircox.utils import atomic_write
 
 logger = logging.getLogger('aircox.test')
 logger.setLevel('INFO')
@@ -63,3 +75,175 @@ class ScheduleCheck (TestCase):
 
     def check_n_of_week(self, schedule, date, dates):
         pass
+
+
+class UtilsCheck (TestCase):
+    def test_atomic_write(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'sub', 'file.txt')
+            atomic_write(path, 'text')
+            atomic_write(path, b'bytes')
+            with open(path) as file:
+                self.assertEqual(file.read(), 'bytes')
+            # no temporary file left
+            self.assertEqual(os.listdir(os.path.dirname(path)), ['file.txt'])
+
+
+class SoundScannerCheck(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        patch = mock.patch.object(settings, 'AIRCOX_PROGRAMS_DIR',
+                                  self.dir.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+        patch = mock.patch.object(
+            settings, 'AIRCOX_SOUND_INDEX',
+            os.path.join(self.dir.name, 'cache', 'sounds_index.json'))
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(self.dir.cleanup)
+
+        station = Station.objects.create(name='Station', slug='station')
+        self.program = Program.objects.create(title='Program',
+                                              station=station)
+        self.program.ensure_dir(settings.AIRCOX_SOUND_ARCHIVES_SUBDIR)
+
+    def write_sound(self, name, seconds=2):
+        path = os.path.join(self.program.archives_path, name)
+        with wave.open(path, 'wb') as file:
+            file.setnchannels(1)
+            file.setsampwidth(1)
+            file.setframerate(100)
+            file.writeframes(bytes(100 * seconds))
+        return path
+
+    def test_scan(self):
+        paths = [self.write_sound('{}.wav'.format(i), i + 1)
+                 for i in range(3)]
+        scanner = SoundScanner()
+        scanner.scan([self.program])
+        self.assertEqual((scanner.files, scanner.read), (3, 3))
+        sounds = Sound.objects.filter(program=self.program).order_by('path')
+        self.assertEqual([(s.path, s.type, s.duration) for s in sounds],
+                         [(path, Sound.TYPE_ARCHIVE, datetime.time(0, 0, i + 1))
+                          for i, path in enumerate(paths)])
+
+        # unchanged files are skipped, removed ones are marked
+        os.remove(paths[0])
+        scanner = SoundScanner()
+        scanner.scan([self.program])
+        self.assertEqual((scanner.files, scanner.synced, scanner.read),
+                         (2, 1, 0))
+        self.assertEqual(Sound.objects.get(path=paths[0]).type,
+                         Sound.TYPE_REMOVED)
+
+        # a file modified within the same second is found by the file index
+        mtime = os.stat(paths[1]).st_mtime_ns
+        self.write_sound('1.wav', 5)
+        os.utime(paths[1], ns=(mtime, mtime))
+        scanner = SoundScanner()
+        scanner.scan([self.program])
+        self.assertEqual((scanner.synced, scanner.read), (1, 1))
+        self.assertEqual(Sound.objects.get(path=paths[1]).duration,
+                         datetime.time(0, 0, 5))
+
+        # full scan reads all files, index is kept out of programs' dir
+        scanner = SoundScanner(full=True)
+        scanner.scan([self.program])
+        self.assertEqual((scanner.files, scanner.read), (2, 2))
+        self.assertTrue(os.path.exists(settings.AIRCOX_SOUND_INDEX))
+        self.assertNotIn('.sounds_index.json', os.listdir(self.dir.name))
+
+    def test_scan_timezone(self):
+        # file's mtime does not depend on the current timezone
+        self.write_sound('0.wav')
+        with tz.override('Pacific/Kiritimati'):
+            SoundScanner().scan([self.program])
+            scanner = SoundScanner()
+            scanner.scan([self.program])
+        self.assertEqual((scanner.synced, scanner.read), (0, 0))
+
+    def test_scan_queries(self):
+        counts = []
+        for files in (2, 6):
+            for i in range(files):
+                self.write_sound('{}_{}.wav'.format(files, i))
+            with CaptureQueriesContext(connection) as queries:
+                SoundScanner().scan([self.program])
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(Sound.objects.filter(program=self.program).count(),
+                         8)
+
+    def test_scan_episodes(self):
+        episodes = []
+        for day in (1, 2):
+            episode = Episode.objects.create(title='Episode {}'.format(day),
+                                             parent=self.program)
+            start = tz.make_aware(datetime.datetime(2020, 1, day, 10))
+            Diffusion.objects.create(episode=episode, start=start,
+                                     end=start + datetime.timedelta(hours=1))
+            episodes.append(episode)
+
+        self.write_sound('20200101_first.wav')
+        self.write_sound('20200102_10h30_second.wav')
+        self.write_sound('20200103_none.wav')
+        with CaptureQueriesContext(connection) as queries:
+            SoundScanner().scan([self.program])
+        self.assertEqual(
+            [(s.name, s.episode) for s in Sound.objects.order_by('path')],
+            [('first', episodes[0]), ('second', episodes[1]),
+             ('none', None)])
+        self.assertEqual(len([q for q in queries.captured_queries
+                              if 'aircox_diffusion' in q['sql']]), 1)
+
+    def test_monitor_pipeline(self):
+        pipeline = EventPipeline(debounce=5, jobs=2)
+        pipeline.executor = futures.ThreadPoolExecutor(2)
+        self.addCleanup(pipeline.executor.shutdown)
+
+        def process():
+            pipeline.process(time.monotonic() + 10, timeout=5)
+
+        # events are coalesced until the file is quiet
+        path = self.write_sound('0.wav')
+        for i in range(3):
+            pipeline.push(path, PathEvents.SYNC, type=Sound.TYPE_ARCHIVE)
+        pipeline.process(time.monotonic(), timeout=0)
+        self.assertEqual((pipeline.queue_depth, pipeline.events), (1, 3))
+        self.assertFalse(Sound.objects.exists())
+
+        process()
+        self.assertEqual((pipeline.queue_depth, pipeline.written), (0, 1))
+        sound = Sound.objects.get()
+        self.assertEqual((sound.path, sound.duration),
+                         (path, datetime.time(0, 0, 2)))
+
+        # moved file keeps its sound, deleted one is marked as removed
+        dest = os.path.join(os.path.dirname(path), '1.wav')
+        os.rename(path, dest)
+        pipeline.push(dest, PathEvents.MOVE, src=path,
+                      type=Sound.TYPE_ARCHIVE)
+        process()
+        self.assertEqual(Sound.objects.get().path, dest)
+
+        os.remove(dest)
+        pipeline.push(dest, PathEvents.DELETE)
+        process()
+        self.assertEqual(Sound.objects.get(pk=sound.pk).type,
+                         Sound.TYPE_REMOVED)
+        self.assertIn('aircox_sounds_monitor_writes_total 3',
+                      pipeline.get_metrics().render())
+
+        # file moved then deleted before being handled
+        path = self.write_sound('2.wav')
+        pipeline.push(path, PathEvents.SYNC, type=Sound.TYPE_ARCHIVE)
+        process()
+        os.rename(path, dest)
+        pipeline.push(dest, PathEvents.MOVE, src=path,
+                      type=Sound.TYPE_ARCHIVE)
+        os.remove(dest)
+        pipeline.push(dest, PathEvents.DELETE)
+        process()
+        self.assertEqual(Sound.objects.get(path=path).type,
+                         Sound.TYPE_REMOVED)
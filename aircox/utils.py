@@ -1,9 +1,13 @@
 import datetime
+import os
+import tempfile
+
 import django.utils.timezone as tz
 
 
 __all__ = ['Redirect', 'redirect', 'date_range', 'cast_date',
-           'date_or_default', 'to_timedelta', 'seconds_to_time']
+           'date_or_default', 'to_timedelta', 'seconds_to_time',
+           'atomic_write']
 
 
 class Redirect(Exception):
@@ -100,3 +104,21 @@ def seconds_to_time(seconds):
                          microsecond=int(microseconds*100000))
 
 
+def atomic_write(path, data, mode=0o644):
+    """
+    Write `data` (str or bytes) to the file at `path`, replacing it
+    atomically: readers never see it half-written. Parent directory is
+    created if needed.
+    """
+    dirname = os.path.dirname(path) or '.'
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname,
+                               prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as file:
+            file.write(data)
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except OSError:
+        os.unlink(tmp)
+        raise
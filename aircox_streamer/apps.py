@@ -4,4 +4,5 @@ from django.apps import AppConfig
 class AircoxStreamerConfig(AppConfig):
     name = 'aircox_streamer'
 
-
+    def ready(self):
+        from . import signals
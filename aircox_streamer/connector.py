@@ -1,12 +1,74 @@
-import socket
-import re
+import asyncio
 import json
+import logging
+import re
+import socket
 
 
-response_re = re.compile(r'(.*)\s+END\s*$')
 key_val_re = re.compile(r'(?P<key>[^=]+)="?(?P<value>([^"]|\\")+)"?')
 
 
+logger = logging.getLogger('aircox')
+
+
+__all__ = ['ConnectorError', 'ConnectorTimeout', 'ResponseReader',
+           'Connector', 'AsyncConnector']
+
+
+class ConnectorError(Exception):
+    """ Connection failure or unexpected end of communication. """
+
+
+class ConnectorTimeout(ConnectorError):
+    """ No response has been received in time. """
+
+
+class ResponseReader:
+    """
+    Incremental reader of `END`-terminated responses. Received data is
+    appended to a buffer and only the newly received bytes are scanned for
+    the terminator line; a response is decoded once it is complete.
+    """
+    terminator = b'END'
+    buffer = None
+    """ Bytearray of received data not yet returned as response """
+    start = 0
+    """ Start index of the current response in buffer """
+    line = 0
+    """ Start index of the current line in buffer """
+    scan = 0
+    """ Index from which to look for new lines """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """ Append data to the buffer and return completed responses. """
+        buffer = self.buffer
+        buffer += data
+
+        responses = []
+        size = len(self.terminator)
+        index = buffer.find(b'\n', self.scan)
+        while index != -1:
+            # only slice lines that can be the terminator
+            if size <= index - self.line <= size + 1 and \
+                    buffer[self.line:index].rstrip(b'\r') == self.terminator:
+                response = buffer[self.start:self.line]
+                responses.append(response.decode('utf-8').strip())
+                self.start = index + 1
+            self.line = index + 1
+            index = buffer.find(b'\n', self.line)
+        self.scan = len(buffer)
+
+        if self.start:
+            del buffer[:self.start]
+            self.line -= self.start
+            self.scan -= self.start
+            self.start = 0
+        return responses
+
+
 class Connector:
     """
     Connection to AF_UNIX or AF_INET, get and send data. Received
@@ -19,14 +81,22 @@ class Connector:
     String to a Unix domain socket file, or a tuple (host, port) for
     TCP/IP connection
     """
+    timeout = 10
+    """ Timeout in seconds for socket operations (None for blocking). """
+    recv_size = 4096
+    """ Max size of data received at once. """
 
     @property
     def is_open(self):
         return self.socket is not None
 
-    def __init__(self, address=None):
+    def __init__(self, address=None, timeout=None, recv_size=None):
         if address:
             self.address = address
+        if timeout is not None:
+            self.timeout = timeout
+        if recv_size:
+            self.recv_size = recv_size
 
     def open(self):
         if self.is_open:
@@ -36,36 +106,97 @@ class Connector:
             socket.AF_INET
         try:
             self.socket = socket.socket(family, socket.SOCK_STREAM)
+            self.socket.settimeout(self.timeout)
             self.socket.connect(self.address)
-        except:
+        except OSError:
             self.close()
             return -1
 
     def close(self):
-        self.socket.close()
-        self.socket = None
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
 
-    # FIXME: return None on failed
-    def send(self, *data, try_count=1, parse=False, parse_json=False):
+    @staticmethod
+    def format(command):
+        """
+        Return command as bytes. It can either be a string or a tuple of
+        values to join.
+        """
+        if not isinstance(command, str):
+            command = ''.join(str(d) for d in command)
+        return bytes(command + '\n', encoding='utf-8')
+
+    def request(self, commands):
+        """
+        Send commands at once and return their responses as a list of
+        strings in the same order.
+
+        :raises ConnectorTimeout: no response in time.
+        :raises ConnectorError: connection or communication failure.
+        """
         if self.open():
-            return None
+            raise ConnectorError('can not connect to {}'.format(self.address))
 
-        data = bytes(''.join([str(d) for d in data]) + '\n', encoding='utf-8')
+        reader, responses = ResponseReader(), []
         try:
-            self.socket.sendall(data)
-            data = ''
-            while not response_re.search(data):
-                data += self.socket.recv(1024).decode('utf-8')
-
-            if data:
-                data = response_re.sub(r'\1', data).strip()
-                data = self.parse(data) if parse else \
-                    self.parse_json(data) if parse_json else data
-            return data
-        except:
-            self.close()
-            if try_count > 0:
-                return self.send(data, try_count - 1)
+            self.socket.sendall(b''.join(self.format(c) for c in commands))
+            while len(responses) < len(commands):
+                data = self.socket.recv(self.recv_size)
+                if not data:
+                    raise ConnectorError('connection closed by peer')
+                responses += reader.feed(data)
+        except socket.timeout as err:
+            raise ConnectorTimeout('no response from {}'
+                                   .format(self.address)) from err
+        except (OSError, UnicodeDecodeError) as err:
+            raise ConnectorError(str(err)) from err
+        return responses
+
+    def send_batch(self, commands, try_count=1, raise_error=False):
+        """
+        Send multiple commands at once and return their responses as a list
+        of strings in the same order. Each command is either a string or a
+        tuple of values joined together.
+
+        Commands are all written on the socket before reading anything, then
+        responses are split on their `END` terminator: the whole batch costs
+        a single round-trip.
+
+        On failure, the connection is reopened and the batch sent again up
+        to `try_count` times. Then the error is raised if `raise_error`,
+        otherwise None is returned. As liquidsoap may have run commands
+        before failing (e.g. on timeout), commands changing its state
+        (`push`, `skip`, etc.) must be sent with a `try_count` of 0.
+        """
+        if not commands:
+            return []
+
+        while True:
+            try:
+                return self.request(commands)
+            except ConnectorError as err:
+                self.close()
+                if try_count > 0:
+                    try_count -= 1
+                    continue
+                if raise_error:
+                    raise
+                logger.warning('connector %s: %s', self.address, err)
+                return None
+
+    # FIXME: return None on failed
+    def send(self, *data, try_count=1, parse=False, parse_json=False,
+             raise_error=False):
+        responses = self.send_batch([data], try_count, raise_error)
+        if responses is None:
+            return None
+
+        data = responses[0]
+        if data:
+            data = self.parse(data) if parse else \
+                self.parse_json(data) if parse_json else data
+        return data
 
     def parse(self, value):
         return {
@@ -81,3 +212,104 @@ class Connector:
             return json.loads(value) if value else None
         except:
             return None
+
+
+class AsyncConnector(Connector):
+    """
+    Connector using asyncio streams: `open`, `close`, `request`, `send` and
+    `send_batch` are coroutines that never block the event loop.
+    """
+    reader = None
+    """ Asyncio stream reader """
+    writer = None
+    """ Asyncio stream writer """
+    lock = None
+    """ Ensure a single request at a time is running on the connection """
+
+    @property
+    def is_open(self):
+        return self.writer is not None
+
+    async def open(self):
+        if self.is_open:
+            return
+
+        try:
+            connect = asyncio.open_unix_connection(self.address) \
+                if isinstance(self.address, str) else \
+                asyncio.open_connection(*self.address)
+            self.reader, self.writer = \
+                await asyncio.wait_for(connect, self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            await self.close()
+            return -1
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = self.writer = None
+
+    async def request(self, commands):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            return await self._request(commands)
+
+    async def _request(self, commands):
+        if await self.open():
+            raise ConnectorError('can not connect to {}'.format(self.address))
+
+        reader, responses = ResponseReader(), []
+        try:
+            self.writer.write(b''.join(self.format(c) for c in commands))
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+            while len(responses) < len(commands):
+                data = await asyncio.wait_for(
+                    self.reader.read(self.recv_size), self.timeout)
+                if not data:
+                    raise ConnectorError('connection closed by peer')
+                responses += reader.feed(data)
+        except asyncio.CancelledError:
+            # pending responses would be read by the next request
+            self.writer.close()
+            self.reader = self.writer = None
+            raise
+        except asyncio.TimeoutError as err:
+            raise ConnectorTimeout('no response from {}'
+                                   .format(self.address)) from err
+        except (OSError, UnicodeDecodeError) as err:
+            raise ConnectorError(str(err)) from err
+        return responses
+
+    async def send_batch(self, commands, try_count=1, raise_error=False):
+        if not commands:
+            return []
+
+        while True:
+            try:
+                return await self.request(commands)
+            except ConnectorError as err:
+                await self.close()
+                if try_count > 0:
+                    try_count -= 1
+                    continue
+                if raise_error:
+                    raise
+                logger.warning('connector %s: %s', self.address, err)
+                return None
+
+    async def send(self, *data, try_count=1, parse=False, parse_json=False,
+                   raise_error=False):
+        responses = await self.send_batch([data], try_count, raise_error)
+        if responses is None:
+            return None
+
+        data = responses[0]
+        if data:
+            data = self.parse(data) if parse else \
+                self.parse_json(data) if parse_json else data
+        return data
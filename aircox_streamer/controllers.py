@@ -1,9 +1,11 @@
 import atexit
+import hashlib
 import logging
 import os
 import re
 import signal
 import subprocess
+import time
 
 import psutil
 import tzlocal
@@ -14,12 +16,14 @@ from django.utils.translation import gettext_lazy as _
 
 from aircox import settings
 from aircox.models import Station, Sound, Port
-from aircox.utils import to_seconds
+from aircox.utils import atomic_write, to_seconds
 
-from .connector import Connector
+from . import metrics
+from .connector import Connector, AsyncConnector
+from .events import ensure_fifo
 
 
-__all__ = ['BaseMetadata', 'Request', 'Streamer', 'Source',
+__all__ = ['BaseMetadata', 'Request', 'Streamer', 'AsyncStreamer', 'Source',
            'PlaylistSource', 'QueueSource']
 
 # TODO: for the moment, update in station and program names do not update the
@@ -47,7 +51,8 @@ class BaseMetadata:
     """ Requests' status """
     air_time = None
     """ Launch datetime """
-
+    state_fields = ('rid', 'uri', 'status', 'request_status', 'air_time')
+    """ Attributes saved in state snapshots (see `Streamer.dump_state`) """
 
     def __init__(self, controller=None, rid=None, data=None):
         self.controller = controller
@@ -97,15 +102,54 @@ class BaseMetadata:
         self.status = self.validate_status(data.get('status'))
         self.request_status = data.get('status')
 
+    def dump_state(self):
+        """ Return state as a dict of `state_fields`. """
+        return {field: getattr(self, field) for field in self.state_fields}
+
+    def load_state(self, state):
+        """ Set attributes from a state returned by `dump_state`. """
+        for field in self.state_fields:
+            if field in state:
+                setattr(self, field, state[field])
+
 
 class Request(BaseMetadata):
     title = None
     artist = None
+    state_fields = BaseMetadata.state_fields + ('title', 'artist')
 
 
 class Streamer:
     connector = None
     process = None
+    process_started = None
+    """ Monotonic time at which process was last started """
+    restart_backoff = 1.0
+    """ Initial delay in seconds before restarting an exited process """
+    max_restart_backoff = 60.0
+    """ Max delay in seconds before restarting an exited process """
+    stable_time = 60.0
+    """ Backoff is reset once process has run this time (in seconds) """
+    ready_timeout = 30.0
+    """
+    Time in seconds a started process has to be ready, before being
+    killed and restarted.
+    """
+    backoff = 0
+    """ Current delay in seconds before restarting the process """
+    restart_next = None
+    """ Monotonic time of the next restart, when process has exited """
+    ready_deadline = None
+    """ Monotonic time before which a started process must be ready """
+    crashed = None
+    """ Monotonic time at which process was found exited or not ready """
+    kill_at_exit = False
+    """ True once the process is set to be killed at exit """
+    events = False
+    """
+    If True, generated config makes liquidsoap write on air events (see
+    `aircox_streamer.events`).
+    """
 
     station = None
     template_name = 'aircox_streamer/scripts/station.liq'
@@ -123,6 +167,11 @@ class Streamer:
     """ Queryset to input ports """
     outputs = None
     """ Queryset to output ports """
+    rotation = None
+    """
+    Rotation generating playlists, set by the monitor if enabled (see
+    `settings.AIRCOX_STREAMER_ROTATION`).
+    """
 
     def __init__(self, station, connector=None):
         self.station = station
@@ -131,7 +180,8 @@ class Streamer:
 
         self.id = self.station.slug.replace('-', '_')
         self.path = os.path.join(station.path, 'station.liq')
-        self.connector = Connector(os.path.join(station.path, 'station.sock'))
+        self.connector = connector or \
+            Connector(os.path.join(station.path, 'station.sock'))
         self.init_sources()
 
     @property
@@ -139,6 +189,16 @@ class Streamer:
         """ Path to Unix socket file """
         return self.connector.address
 
+    @property
+    def pid_path(self):
+        """ Path to the file holding process' pid """
+        return os.path.join(self.station.path, 'station.pid')
+
+    @property
+    def events_path(self):
+        """ Path to the fifo on which liquidsoap writes on air events """
+        return os.path.join(self.station.path, 'events.fifo')
+
     @property
     def is_ready(self):
         """
@@ -157,6 +217,7 @@ class Streamer:
             return True
 
         self.process = None
+        self.remove_pid_file()
         logger.debug('process died with return code %s' % returncode)
         return False
 
@@ -170,7 +231,22 @@ class Streamer:
 
     # Sources and config ###############################################
     def send(self, *args, **kwargs):
-        return self.connector.send(*args, **kwargs) or ''
+        with metrics.measure(metrics.SOCKET_TIME, station=self.station.pk):
+            response = self.connector.send(*args, **kwargs)
+        if response is None:
+            metrics.SOCKET_ERRORS.inc(station=self.station.pk)
+        return response or ''
+
+    def send_batch(self, commands):
+        """
+        Send commands in a single round-trip and return responses, using an
+        empty string for each of them on failure (as `send()` does).
+        """
+        with metrics.measure(metrics.SOCKET_TIME, station=self.station.pk):
+            responses = self.connector.send_batch(commands)
+        if responses is None:
+            metrics.SOCKET_ERRORS.inc(station=self.station.pk)
+        return responses or [''] * len(commands)
 
     def init_sources(self):
         streams = self.station.program_set.filter(stream__isnull=False)
@@ -193,17 +269,62 @@ class Streamer:
         with open(self.path, 'w+') as file:
             file.write(data)
 
+        if self.events:
+            ensure_fifo(self.events_path)
         self.sync()
 
     def sync(self):
         """ Sync all sources. """
+        self.sync_playlists()
         for source in self.sources:
-            source.sync()
+            if not isinstance(source, PlaylistSource):
+                source.sync()
+
+    def get_playlists(self):
+        """
+        Return playlists of playlist sources by program id, using a single
+        query (or from the rotation, if any).
+        """
+        playlists = {source.program.pk: [] for source in self.playlists}
+        if self.rotation is not None:
+            return self.rotation.get_playlists(list(playlists))
+
+        paths = Sound.objects.archive() \
+                     .filter(program__in=list(playlists), path__isnull=False) \
+                     .order_by('path').values_list('program_id', 'path')
+        for program_id, path in paths:
+            playlists[program_id].append(path)
+        return playlists
+
+    def sync_playlists(self):
+        """ Sync playlist sources, return the ones that were updated. """
+        playlists = self.get_playlists()
+        metrics.PLAYLIST_SYNCS.inc(station=self.station.pk)
+        synced = [source for source in self.playlists
+                  if source.sync(playlists[source.program.pk])]
+        if synced:
+            metrics.PLAYLIST_WRITES.inc(len(synced), station=self.station.pk)
+        return synced
+
+    def get_fetch_commands(self):
+        """ Return commands used to fetch all sources, as a flat list. """
+        return [command for source in self.sources
+                for command in source.get_fetch_commands()]
 
     def fetch(self):
-        """ Fetch data from liquidsoap """
+        """
+        Fetch data from liquidsoap. Commands of all sources are sent as a
+        single batch.
+        """
+        self.on_fetch(self.send_batch(self.get_fetch_commands()))
+
+    def on_fetch(self, responses):
+        """ Update sources from responses to `get_fetch_commands()`. """
+        index = 0
         for source in self.sources:
-            source.fetch()
+            count = len(source.get_fetch_commands())
+            source.on_fetch(responses[index:index+count])
+            index += count
 
         # request.on_air is not ordered: we need to do it manually
         self.source = next(iter(sorted(
@@ -212,19 +333,106 @@ class Streamer:
             key=lambda o: o.air_time, reverse=True
         )), None)
 
+    def dump_state(self):
+        """
+        Return a snapshot of sources' data as last fetched, that can be
+        loaded by another process using `load_state`.
+        """
+        return {
+            'date': tz.now(),
+            'source': self.source and self.source.id,
+            'sources': {source.id: source.dump_state()
+                        for source in self.sources},
+        }
+
+    def load_state(self, state):
+        """ Update sources from a state returned by `dump_state`. """
+        sources = state['sources']
+        for source in self.sources:
+            if source.id in sources:
+                source.load_state(sources[source.id])
+        self.source = next((source for source in self.sources
+                            if source.id == state['source']), None)
+
     # Process ##########################################################
     def get_process_args(self):
         return ['liquidsoap', '-v', self.path]
 
+    def get_socket_inodes(self):
+        """
+        Return inodes of the Unix sockets bound to `socket_path`, read from
+        `/proc/net/unix`. Return None if it is not available.
+        """
+        try:
+            with open('/proc/net/unix') as file:
+                next(file)
+                lines = [line.split() for line in file]
+        except OSError:
+            return None
+        path = os.path.abspath(self.socket_path)
+        return {line[6] for line in lines
+                if len(line) > 7 and line[7] == path}
+
+    @staticmethod
+    def get_socket_pids(inodes, pids=None):
+        """
+        Return pids of the processes having one of the given socket inodes
+        open. Only `pids` are looked up if given, otherwise all processes.
+        """
+        links = {'socket:[{}]'.format(inode) for inode in inodes}
+        if pids is None:
+            pids = (int(pid) for pid in os.listdir('/proc') if pid.isdigit())
+        found = []
+        for pid in pids:
+            fd_path = '/proc/{}/fd'.format(pid)
+            try:
+                if any(os.readlink(os.path.join(fd_path, fd)) in links
+                       for fd in os.listdir(fd_path)):
+                    found.append(pid)
+            except OSError:
+                continue
+        return found
+
+    def read_pid_file(self):
+        try:
+            with open(self.pid_path) as file:
+                return int(file.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def remove_pid_file(self):
+        if os.path.exists(self.pid_path):
+            os.remove(self.pid_path)
+
     def check_zombie_process(self):
+        """
+        Kill processes (e.g. from a previous run) still listening on the
+        socket. The pidfile's process is looked up first, other processes
+        only if it does not hold the socket.
+        """
         if not os.path.exists(self.socket_path):
             return
 
-        conns = [conn for conn in psutil.net_connections(kind='unix')
-                 if conn.laddr == self.socket_path]
-        for conn in conns:
-            if conn.pid is not None:
-                os.kill(conn.pid, signal.SIGKILL)
+        inodes = self.get_socket_inodes()
+        if inodes is None:
+            pids = [conn.pid for conn in psutil.net_connections(kind='unix')
+                    if conn.laddr == self.socket_path and
+                    conn.pid is not None]
+        elif not inodes:
+            pids = []
+        else:
+            pid = self.read_pid_file()
+            pids = self.get_socket_pids(inodes, [pid]) if pid else []
+            if not pids:
+                pids = self.get_socket_pids(inodes)
+
+        for pid in pids:
+            if pid == os.getpid():
+                continue
+            logger.warning('streamer %s: kill zombie process %s', self.id,
+                           pid)
+            os.kill(pid, signal.SIGKILL)
+        self.remove_pid_file()
 
     def run_process(self):
         """
@@ -241,14 +449,23 @@ class Streamer:
 
         self.check_zombie_process()
         self.process = subprocess.Popen(args, stderr=subprocess.STDOUT)
-        atexit.register(lambda: self.kill_process())
+        with open(self.pid_path, 'w') as file:
+            file.write(str(self.process.pid))
+        self.process_started = time.monotonic()
+        self.ready_deadline = self.process_started + self.ready_timeout
+        self.restart_next = None
+        if not self.kill_at_exit:
+            atexit.register(self.kill_process)
+            self.kill_at_exit = True
 
     def kill_process(self):
         if self.process:
             logger.debug("kill process %s: %s", self.process.pid,
                          ' '.join(self.get_process_args()))
             self.process.kill()
+            self.process.wait()
             self.process = None
+            self.remove_pid_file()
 
     def wait_process(self):
         """
@@ -257,6 +474,85 @@ class Streamer:
         if self.process:
             self.process.wait()
             self.process = None
+            self.remove_pid_file()
+
+    def supervise_process(self):
+        """
+        Restart the process with exponential backoff once it has exited or
+        it has not been ready in time (see `ready_timeout`). Return True
+        if it is running and ready, in which case it can be monitored.
+
+        Recovery time, from the exit to the readiness of the restarted
+        process, is observed in the metrics.
+        """
+        now = time.monotonic()
+        if not self.is_running:
+            if self.restart_next is None:
+                self.schedule_restart(now, 'process exited')
+            if now < self.restart_next:
+                return False
+            logger.info('streamer %s: restart process', self.id)
+            self.run_process()
+            metrics.RESTARTS.inc(station=self.station.pk)
+
+        if self.ready_deadline is None:
+            return True
+        if self.is_ready:
+            if self.crashed is not None:
+                recovery = now - self.crashed
+                metrics.RECOVERY_TIME.observe(recovery,
+                                              station=self.station.pk)
+                logger.info('streamer %s: recovered in %.1fs', self.id,
+                            recovery)
+            self.ready_deadline = self.crashed = None
+            return True
+        if now >= self.ready_deadline:
+            self.kill_process()
+            self.schedule_restart(now, 'process not ready after {}s'
+                                  .format(self.ready_timeout))
+        return False
+
+    def schedule_restart(self, now, reason):
+        """ Schedule restart of the exited process, with backoff. """
+        if self.crashed is None:
+            self.crashed = now
+        if self.process_started is not None and \
+                now - self.process_started >= self.stable_time:
+            self.backoff = self.restart_backoff
+        else:
+            self.backoff = min(self.max_restart_backoff,
+                               max(self.restart_backoff, self.backoff * 2))
+        self.restart_next = now + self.backoff
+        logger.warning('streamer %s: %s, restart in %ss', self.id, reason,
+                       self.backoff)
+
+
+class AsyncStreamer(Streamer):
+    """
+    Streamer fetching data from liquidsoap through an asyncio connection,
+    so that multiple stations can be monitored from a single event loop.
+
+    Other commands (e.g. `push`) still use the blocking connector and
+    must be run in an executor.
+    """
+    async_connector = None
+
+    def __init__(self, station, connector=None):
+        super().__init__(station, connector)
+        self.async_connector = AsyncConnector(self.connector.address)
+
+    async def async_is_ready(self):
+        """ Same as `is_ready`. """
+        return bool(await self.async_connector.send('list'))
+
+    async def async_fetch(self):
+        """ Same as `fetch`. """
+        commands = self.get_fetch_commands()
+        with metrics.measure(metrics.SOCKET_TIME, station=self.station.pk):
+            responses = await self.async_connector.send_batch(commands)
+        if responses is None:
+            metrics.SOCKET_ERRORS.inc(station=self.station.pk)
+        self.on_fetch(responses or [''] * len(commands))
 
 
 class Source(BaseMetadata):
@@ -267,6 +563,7 @@ class Source(BaseMetadata):
     remaining = 0.0
     """ remaining time """
     status = 'stopped'
+    state_fields = BaseMetadata.state_fields + ('remaining',)
 
     @property
     def station(self):
@@ -279,21 +576,33 @@ class Source(BaseMetadata):
     def sync(self):
         """ Synchronize what should be synchronized """
 
+    def get_fetch_commands(self):
+        """ Return the list of commands used to fetch source's data. """
+        return [(self.id, '.remaining'), (self.id, '.get')]
+
     def fetch(self):
+        commands = self.get_fetch_commands()
+        self.on_fetch(self.controller.send_batch(commands))
+
+    def on_fetch(self, responses):
+        """
+        Update source from the responses to `get_fetch_commands()`'s
+        commands (in the same order).
+        """
+        remaining, data = responses[0], responses[1]
         try:
-            data = self.controller.send(self.id, '.remaining')
-            if data:
-                self.remaining = float(data)
+            if remaining:
+                self.remaining = float(remaining)
         except ValueError:
             self.remaining = None
 
-        data = self.controller.send(self.id, '.get', parse=True)
+        data = self.controller.connector.parse(data) if data else None
         if data:
             self.validate(data if data and isinstance(data, dict) else {})
 
     def skip(self):
         """ Skip the current source sound """
-        self.controller.send(self.id, '.skip')
+        self.controller.send(self.id, '.skip', try_count=0)
 
     def restart(self):
         """ Restart current sound """
@@ -302,7 +611,7 @@ class Source(BaseMetadata):
 
     def seek(self, n):
         """ Seeks into the sound. """
-        self.controller.send(self.id, '.seek ', str(n))
+        self.controller.send(self.id, '.seek ', str(n), try_count=0)
 
 
 class PlaylistSource(Source):
@@ -313,6 +622,8 @@ class PlaylistSource(Source):
     """ Related program """
     playlist = None
     """ The playlist """
+    playlist_hash = None
+    """ Hash of the playlist file's content """
 
     def __init__(self, controller, id=None, program=None, **kwargs):
         id = program.slug.replace('-', '_') if id is None else id
@@ -329,11 +640,31 @@ class PlaylistSource(Source):
         """ Get playlist from db """
         return self.get_sound_queryset().paths()
 
+    def get_file_hash(self):
+        """ Return hash of the playlist file's content (None if absent) """
+        try:
+            with open(self.path, 'rb') as file:
+                return hashlib.sha1(file.read()).hexdigest()
+        except FileNotFoundError:
+            return None
+
     def write_playlist(self, playlist=[]):
-        """ Write playlist to file. """
-        os.makedirs(os.path.dirname(self.path), exist_ok=True)
-        with open(self.path, 'w') as file:
-            file.write('\n'.join(playlist or []))
+        """
+        Write playlist to file if its content changed, and return True if
+        so. As liquidsoap reloads the playlist when the file changes, we
+        avoid useless writes.
+        """
+        data = '\n'.join(playlist or []).encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        if self.playlist_hash is None or not os.path.exists(self.path):
+            self.playlist_hash = self.get_file_hash()
+        if digest == self.playlist_hash:
+            return False
+
+        # liquidsoap must never read the file half-written.
+        atomic_write(self.path, data)
+        self.playlist_hash = digest
+        return True
 
     def stream(self):
         """ Return program's stream info if any (or None) as dict. """
@@ -349,26 +680,41 @@ class PlaylistSource(Source):
             'delay': to_seconds(stream.delay) if stream.delay else 0
         }
 
-    def sync(self):
-        playlist = self.get_playlist()
-        self.write_playlist(playlist)
+    def sync(self, playlist=None):
+        """
+        Write playlist (from the database if not given). Return True if it
+        has been updated.
+        """
+        if playlist is None:
+            playlist = self.get_playlist()
+        return self.write_playlist(playlist)
 
 
 class QueueSource(Source):
     queue = None
     """ Source's queue (excluded on_air request) """
+    request_cache = None
+    """
+    Requests metadata of the queue by rid. Requests are removed once they
+    leave the queue.
+    """
+    state_fields = Source.state_fields + ('queue',)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.request_cache = {}
 
     def push(self, *paths):
         """ Add the provided paths to source's play queue """
         for path in paths:
-            self.controller.send(self.id, '_queue.push ', path)
+            self.controller.send(self.id, '_queue.push ', path, try_count=0)
 
-    def fetch(self):
-        super().fetch()
-        queue = self.controller.send(self.id, '_queue.queue').strip()
+    def get_fetch_commands(self):
+        return super().get_fetch_commands() + [(self.id, '_queue.queue')]
+
+    def on_fetch(self, responses):
+        super().on_fetch(responses)
+        queue = responses[2].strip()
         if not queue:
             self.queue = []
             return
@@ -378,9 +724,36 @@ class QueueSource(Source):
     @property
     def requests(self):
         """ Queue as requests metadata """
-        requests = [Request(self.controller, rid) for rid in self.queue]
-        for request in requests:
-            request.fetch()
+        queue, cache = self.queue or [], self.request_cache
+        # metadata of new requests are fetched in a single round-trip
+        rids = [rid for rid in queue if rid not in cache]
+        fetched = {}
+        if rids:
+            connector = self.controller.connector
+            responses = self.controller.send_batch(
+                [('request.metadata ', rid) for rid in rids])
+            for rid, data in zip(rids, responses):
+                data = connector.parse(data) if data else None
+                fetched[rid] = Request(self.controller, rid, data or None)
+
+        requests = [cache.get(rid) or fetched[rid] for rid in queue]
+        # don't keep requests whose metadata could not be fetched
+        self.request_cache = {request.rid: request for request in requests
+                              if request.uri is not None}
         return requests
 
+    def dump_state(self):
+        state = super().dump_state()
+        state['requests'] = [request.dump_state()
+                             for request in self.requests]
+        return state
+
+    def load_state(self, state):
+        super().load_state(state)
+        self.request_cache = {}
+        for data in state.get('requests', ()):
+            request = Request(self.controller)
+            request.load_state(data)
+            self.request_cache[request.rid] = request
+
 
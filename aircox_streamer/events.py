@@ -0,0 +1,150 @@
+"""
+On air events sent by liquidsoap to the monitor.
+
+Liquidsoap writes an event for each track of the station as JSON lines on a
+fifo (see `station.liq` and `Streamer.events`), such as:
+`{"type": "track", "source": "dealer", "metadata": {...}}`. Writes are done
+without blocking nor failing when no monitor is listening: events are then
+lost, and the monitor's polling is used to reconcile.
+"""
+import json
+import logging
+import os
+import select
+import stat
+
+
+__all__ = ['Event', 'EventListener', 'EventEmitter']
+
+
+logger = logging.getLogger('aircox')
+
+
+class Event:
+    """ Event received from liquidsoap. """
+    TYPE_TRACK = 'track'
+    """ A new track starts on the source """
+    TYPE_METADATA = 'metadata'
+    """ Metadata have been updated on the source """
+
+    type = None
+    """ Event type """
+    source = None
+    """ Id of the source """
+    metadata = None
+    """ Track's metadata as a dict """
+
+    def __init__(self, type, source, metadata=None):
+        self.type = type
+        self.source = source
+        self.metadata = metadata or {}
+
+    @classmethod
+    def from_json(cls, data):
+        """ Return event from JSON line, or None if it is invalid. """
+        try:
+            data = json.loads(data)
+            return cls(data['type'], data['source'], data.get('metadata'))
+        except (ValueError, KeyError, TypeError):
+            logger.warning('invalid event: %s', data)
+            return None
+
+    def to_json(self):
+        return json.dumps({'type': self.type, 'source': self.source,
+                           'metadata': self.metadata})
+
+
+def ensure_fifo(path):
+    """ Create fifo at the given path if it does not exist yet. """
+    if os.path.exists(path):
+        if not stat.S_ISFIFO(os.stat(path).st_mode):
+            raise ValueError('{} exists and is not a fifo'.format(path))
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.mkfifo(path)
+
+
+class EventListener:
+    """ Read events from a fifo without blocking. """
+    path = None
+    """ Path to the fifo """
+    fd = None
+    """ File descriptor of the opened fifo """
+    buffer = b''
+    """ Data of incomplete event """
+    max_read = 65536
+    """ Max size of data read at once """
+
+    def __init__(self, path):
+        self.path = path
+
+    def fileno(self):
+        return self.fd
+
+    def open(self):
+        if self.fd is not None:
+            return
+        ensure_fifo(self.path)
+        # opening for writing too prevents end-of-file when liquidsoap
+        # closes its side of the fifo.
+        self.fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.buffer = b''
+
+    def read(self):
+        """ Return list of events received since last call. """
+        self.open()
+        data = self.buffer
+        while True:
+            try:
+                chunk = os.read(self.fd, self.max_read)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+
+        lines = data.split(b'\n')
+        self.buffer = lines.pop()
+        events = (Event.from_json(line.decode('utf-8', 'replace'))
+                  for line in lines if line.strip())
+        return [event for event in events if event is not None]
+
+    def wait(self, timeout):
+        """ Wait at most `timeout` seconds for events to be available. """
+        return self.wait_any([self], timeout)
+
+    @staticmethod
+    def wait_any(listeners, timeout):
+        """
+        Wait for events on any of the given listeners at most `timeout`
+        seconds. Return listeners with events available.
+        """
+        for listener in listeners:
+            listener.open()
+        return select.select(listeners, [], [], timeout)[0]
+
+
+class EventEmitter:
+    """
+    Write events on a fifo as liquidsoap does. This is mostly used for
+    testing purpose.
+    """
+    path = None
+
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, type, source, **metadata):
+        event = Event(type, source, metadata)
+        ensure_fifo(self.path)
+        fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+        try:
+            os.write(fd, bytes(event.to_json() + '\n', encoding='utf-8'))
+        finally:
+            os.close(fd)
+        return event
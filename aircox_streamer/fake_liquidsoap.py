@@ -0,0 +1,266 @@
+"""
+Fake liquidsoap server speaking the subset of the telnet/socket protocol
+used by aircox, in order to test and benchmark the streamer stack without
+running liquidsoap.
+
+Tracks are changed when they end (after `duration` seconds), or on demand
+using `FakeLiquidsoap.play`. Latency and failures can be injected, and the
+clock can be replaced (e.g. for simulations).
+
+Sources are given in order of priority, as a liquidsoap `fallback`: only
+the first one having a current track is reported as playing.
+"""
+import itertools
+import os
+import random
+import socketserver
+import threading
+import time
+
+from django.utils import timezone as tz
+
+from .connector import Connector, ConnectorError
+
+
+__all__ = ['FakeRequest', 'FakeSource', 'FakeLiquidsoap', 'FakeConnector']
+
+
+class FakeRequest:
+    """ A request (track) handled by the fake server. """
+    rid = None
+    uri = None
+    status = 'ready'
+    on_air = None
+    """ Timestamp at which request started to play """
+
+    def __init__(self, rid, uri):
+        self.rid = rid
+        self.uri = uri
+
+    def metadata(self, status=None):
+        """ Return metadata as liquidsoap prints them. """
+        metadata = [('rid', self.rid), ('initial_uri', self.uri),
+                    ('status', status or self.status)]
+        if self.on_air is not None:
+            on_air = tz.datetime.fromtimestamp(self.on_air)
+            metadata.append(('on_air', on_air.strftime('%Y/%m/%d %H:%M:%S')))
+        return '\n'.join('{}="{}"'.format(k, v) for k, v in metadata)
+
+
+class FakeSource:
+    """
+    Source of the fake server: play its queue's requests, or when empty
+    its playlist's uris (if any) in a loop.
+    """
+    id = None
+    playlist = None
+    """ Uris played when queue is empty """
+    queue = None
+    """ Queued requests """
+    current = None
+    """ Current request """
+
+    def __init__(self, id, playlist=None):
+        self.id = id
+        self.playlist = itertools.cycle(playlist) if playlist else None
+        self.queue = []
+
+
+class FakeLiquidsoap:
+    """
+    Fake liquidsoap server listening on a Unix socket.
+    """
+    sources = None
+    """ Sources by id """
+    duration = 60.0
+    """ Default duration of tracks in seconds """
+    durations = None
+    """ Duration of tracks in seconds by uri """
+    latency = 0
+    """ Delay in seconds before answering each command """
+    failure_rate = 0
+    """ Probability of closing the connection instead of answering """
+    commands = 0
+    """ Count of received commands """
+
+    def __init__(self, path=None, sources=None, duration=None, latency=None,
+                 failure_rate=None, durations=None, clock=None):
+        """
+        :param path: socket path;
+        :param sources: dict of `{source_id: playlist}`, where playlist is
+            a list of uris or None (e.g. for the dealer);
+        :param clock: function returning current timestamp (`time.time`
+            by default).
+        """
+        self.path = path
+        self.durations = durations or {}
+        self.clock = clock or time.time
+        self.sources = {id: FakeSource(id, playlist)
+                        for id, playlist in (sources or {}).items()}
+        if duration is not None:
+            self.duration = duration
+        if latency is not None:
+            self.latency = latency
+        if failure_rate is not None:
+            self.failure_rate = failure_rate
+        self.rids = itertools.count()
+        self.requests = {}
+        self.lock = threading.RLock()
+        self.server = None
+
+    # Server ###########################################################
+    def start(self):
+        """ Start serving in a background thread. """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    response = fake.handle(line.decode('utf-8').strip())
+                    if response is None:
+                        return
+                    self.wfile.write(bytes(response + '\r\nEND\r\n',
+                                           encoding='utf-8'))
+
+        self.server = socketserver.ThreadingUnixStreamServer(self.path,
+                                                             Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def handle(self, command):
+        """
+        Return response to command, or None if the connection must be
+        closed (failure injection).
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            return None
+        with self.lock:
+            self.commands += 1
+            return self.run(command)
+
+    # Commands #########################################################
+    def run(self, command):
+        command, _, arg = command.partition(' ')
+        if command == 'list':
+            return '\n'.join('{} : interactive'.format(id)
+                             for id in self.sources)
+        if command == 'request.metadata':
+            request = self.requests.get(arg)
+            return request.metadata() if request else ''
+
+        id, _, action = command.rpartition('.')
+        source = self.sources.get(id[:-len('_queue')]
+                                  if id.endswith('_queue') else id)
+        if source is None:
+            return 'ERROR: unknown command, type "help" to get a list of ' \
+                   'commands.'
+
+        self.update(source)
+        if action == 'get':
+            if source.current is None:
+                return ''
+            return source.current.metadata(
+                None if self.is_on_air(source) else 'ready')
+        if action == 'remaining':
+            return '{:.2f}'.format(self.get_remaining(source))
+        if action == 'queue':
+            return ' '.join(request.rid for request in source.queue)
+        if action == 'push':
+            request = self.new_request(arg)
+            source.queue.append(request)
+            return request.rid
+        if action == 'skip':
+            self.play(source.id)
+            return 'Done'
+        if action == 'seek':
+            return 'Done'
+        return 'ERROR: unknown command'
+
+    # Tracks ###########################################################
+    def new_request(self, uri):
+        request = FakeRequest(str(next(self.rids)), uri)
+        self.requests[request.rid] = request
+        return request
+
+    def get_remaining(self, source):
+        if source.current is None:
+            return 0.0
+        duration = self.durations.get(source.current.uri, self.duration)
+        return max(0.0, source.current.on_air + duration - self.clock())
+
+    def is_on_air(self, source):
+        """ Return True if source is the one on air (as a fallback). """
+        for other in self.sources.values():
+            if other is source:
+                return True
+            self.update(other)
+            if other.current is not None:
+                return False
+
+    def update(self, source):
+        """ Change track if the current one has ended. """
+        if source.current is None or not self.get_remaining(source):
+            self.play(source.id)
+
+    def play(self, source_id, uri=None):
+        """
+        Change track of the given source: play `uri` if given, otherwise
+        the next request of the source's queue or playlist.
+        """
+        with self.lock:
+            source = self.sources[source_id]
+            if source.current is not None:
+                source.current.status = 'destroyed'
+                self.requests.pop(source.current.rid, None)
+
+            if uri is not None:
+                request = self.new_request(uri)
+            elif source.queue:
+                request = source.queue.pop(0)
+            elif source.playlist is not None:
+                request = self.new_request(next(source.playlist))
+            else:
+                source.current = None
+                return None
+
+            request.status, request.on_air = 'playing', self.clock()
+            source.current = request
+            return request
+
+
+class FakeConnector(Connector):
+    """
+    Connector sending commands directly to a FakeLiquidsoap, without
+    socket.
+    """
+    fake = None
+    """ FakeLiquidsoap receiving the commands """
+
+    def __init__(self, fake, **kwargs):
+        super().__init__(fake.path, **kwargs)
+        self.fake = fake
+
+    def open(self):
+        pass
+
+    def request(self, commands):
+        responses = []
+        for command in commands:
+            response = self.fake.handle(self.format(command).decode('utf-8')
+                                                            .strip())
+            if response is None:
+                raise ConnectorError('connection closed by peer')
+            responses.append(response)
+        return responses
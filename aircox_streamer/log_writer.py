@@ -0,0 +1,108 @@
+import atexit
+import logging
+import signal
+import threading
+import time
+
+from django.db import transaction
+
+from aircox.models import Log
+
+
+__all__ = ['LogWriter']
+
+
+logger = logging.getLogger('aircox')
+
+
+class LogWriter:
+    """
+    Buffer logs and write them in the database using `bulk_create`, once
+    `size` logs are waiting or `interval` seconds have passed since the
+    last write. Logs that are not yet written can be retrieved using
+    `pending()`.
+
+    A single writer can be shared by multiple monitors (and threads).
+
+    Note: depending on the database backend, written logs may not have a
+    primary key assigned.
+    """
+    size = 100
+    """ Max count of logs waiting to be written. """
+    interval = 2.0
+    """ Max delay in seconds before writing logs. """
+    logs = None
+    """ Logs waiting to be written """
+    next_flush = None
+    """ Time (as given by `time.monotonic`) of the next write """
+
+    def __init__(self, size=None, interval=None):
+        if size is not None:
+            self.size = size
+        if interval is not None:
+            self.interval = interval
+        self.logs = []
+        self.lock = threading.RLock()
+
+    def write(self, log):
+        """ Add log to write. """
+        with self.lock:
+            if not self.logs:
+                self.next_flush = time.monotonic() + self.interval
+            self.logs.append(log)
+            if len(self.logs) >= self.size:
+                self.flush()
+
+    def pending(self, station=None):
+        """ Return logs not yet written (for the given station). """
+        with self.lock:
+            return [log for log in self.logs
+                    if station is None or log.station_id == station.pk]
+
+    def check(self):
+        """ Write logs if interval is elapsed. """
+        if self.logs and time.monotonic() >= self.next_flush:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all waiting logs. If they can not be written at once, they
+        are saved one by one, and the ones that fail are dropped (and
+        reported), such as an invalid log does not block the other ones.
+        """
+        with self.lock:
+            if not self.logs:
+                return
+            try:
+                with transaction.atomic():
+                    Log.objects.bulk_create(self.logs)
+            except Exception:
+                logger.exception('can not write %d logs at once, write them '
+                                 'one by one', len(self.logs))
+                self.save_each()
+            self.logs = []
+
+    def save_each(self):
+        for log in self.logs:
+            try:
+                with transaction.atomic():
+                    log.save()
+            except Exception:
+                logger.exception('can not write log, dropped: %s', log)
+
+    def install(self):
+        """
+        Ensure logs are written at exit, including on SIGTERM. Must be
+        called from the main thread.
+        """
+        atexit.register(self.flush)
+        previous = signal.getsignal(signal.SIGTERM)
+
+        # logs are not written from the handler, which may interrupt a
+        # write: exiting runs the atexit flush.
+        def on_sigterm(signum, frame):
+            if callable(previous):
+                previous(signum, frame)
+            raise SystemExit(128 + signum)
+
+        signal.signal(signal.SIGTERM, on_sigterm)
@@ -11,245 +11,30 @@ used to:
 # x diffusion conflicts
 # x cancel
 # x when liquidsoap fails to start/exists: exit
-# - handle restart after failure
 # - is stream restart after live ok?
 from argparse import RawTextHelpFormatter
+import asyncio
+import concurrent.futures as futures
 import time
 
 import pytz
-from django.db.models import Q
 from django.core.management.base import BaseCommand
 from django.utils import timezone as tz
 
-from aircox.models import Station, Episode, Diffusion, Track, Sound, Log
-from aircox.utils import date_range
+from aircox.models import Station
 
-from aircox_streamer.controllers import Streamer
+from aircox_streamer.controllers import Streamer, AsyncStreamer
+from aircox_streamer.events import EventListener
+from aircox_streamer.log_writer import LogWriter
+from aircox_streamer.monitor import Monitor, AsyncMonitor
+from aircox_streamer.timeline import TimelineGroup
+from aircox_streamer.workers import Supervisor
 
 
 # force using UTC
 tz.activate(pytz.UTC)
 
 
-class Monitor:
-    """
-    Log and launch diffusions for the given station.
-
-    Monitor should be able to be used after a crash a go back
-    where it was playing, so we heavily use logs to be able to
-    do that.
-
-    We keep trace of played items on the generated stream:
-    - sounds played on this stream;
-    - scheduled diffusions
-    - tracks for sounds of streamed programs
-    """
-    streamer = None
-    """ Streamer controller """
-    delay = None
-    """ Timedelta: minimal delay between two call of monitor. """
-    logs = None
-    """ Queryset to station's logs (ordered by -pk) """
-    cancel_timeout = 20
-    """ Timeout in minutes before cancelling a diffusion. """
-    sync_timeout = 5
-    """ Timeout in minutes between two streamer's sync. """
-    sync_next = None
-    """ Datetime of the next sync """
-
-    @property
-    def station(self):
-        return self.streamer.station
-
-    @property
-    def last_log(self):
-        """ Last log of monitored station. """
-        return self.logs.first()
-
-    @property
-    def last_diff_start(self):
-        """ Log of last triggered item (sound or diffusion). """
-        return self.logs.start().with_diff().first()
-
-    def __init__(self, streamer, delay, cancel_timeout, **kwargs):
-        self.streamer = streamer
-        # adding time ensure all calculation have a margin
-        self.delay = delay + tz.timedelta(seconds=5)
-        self.cancel_timeout = cancel_timeout
-        self.__dict__.update(kwargs)
-        self.logs = self.get_logs_queryset()
-
-    def get_logs_queryset(self):
-        """ Return queryset to assign as `self.logs` """
-        return self.station.log_set.select_related('diffusion', 'sound') \
-                           .order_by('-pk')
-
-    def monitor(self):
-        """ Run all monitoring functions once. """
-        if not self.streamer.is_ready:
-            return
-
-        self.streamer.fetch()
-
-        # Skip tracing - analyzis:
-        # Reason: multiple database request every x seconds, reducing it.
-        # We could skip this part when remaining time is higher than a minimal
-        # value (which should be derived from Command's delay). Problems:
-        # - How to trace tracks? (+ Source can change: caching log might sucks)
-        # - if liquidsoap's source/request changes: remaining time goes higher,
-        #   thus avoiding fetch
-        #
-        # Approach: something like having a mean time, such as:
-        #
-        # ```
-        # source = stream.source
-        # mean_time = source.air_time
-        #           + min(next_track.timestamp, source.remaining)
-        #           - (command.delay + 1)
-        # trace_required = \/ source' != source
-        #                  \/ source.uri' != source.uri
-        #                  \/ now < mean_time
-        # ```
-        #
-        source = self.streamer.source
-        if source and source.uri:
-            log = self.trace_sound(source)
-            if log:
-                self.trace_tracks(log)
-        else:
-            print('no source or sound for stream; source = ', source)
-
-        self.handle_diffusions()
-        self.sync()
-
-    def log(self, date=None, **kwargs):
-        """ Create a log using **kwargs, and print info """
-        kwargs.setdefault('station', self.station)
-        log = Log(date=date or tz.now(), **kwargs)
-        log.save()
-        log.print()
-        return log
-
-    def trace_sound(self, source):
-        """ Return on air sound log (create if not present). """
-        air_uri, air_time = source.uri, source.air_time
-
-        # check if there is yet a log for this sound on the source
-        log = self.logs.on_air().filter(
-            Q(sound__path=air_uri) |
-            # sound can be null when arbitrary sound file is played
-            Q(sound__isnull=True, track__isnull=True, comment=air_uri),
-            source=source.id,
-            date__range=date_range(air_time, self.delay),
-        ).first()
-        if log:
-            return log
-
-        # get sound
-        diff = None
-        sound = Sound.objects.filter(path=air_uri).first()
-        if sound and sound.episode_id is not None:
-            diff = Diffusion.objects.episode(id=sound.episode_id).on_air() \
-                                    .now(air_time).first()
-
-        # log sound on air
-        return self.log(type=Log.TYPE_ON_AIR, date=source.air_time,
-                        source=source.id, sound=sound, diffusion=diff,
-                        comment=air_uri)
-
-    def trace_tracks(self, log):
-        """
-        Log tracks for the given sound log (for streamed programs only).
-        """
-        if log.diffusion:
-            return
-
-        tracks = Track.objects \
-                      .filter(sound__id=log.sound_id, timestamp__isnull=False)\
-                      .order_by('timestamp')
-        if not tracks.exists():
-            return
-
-        # exclude already logged tracks
-        tracks = tracks.exclude(log__station=self.station, log__pk__gt=log.pk)
-        now = tz.now()
-        for track in tracks:
-            pos = log.date + tz.timedelta(seconds=track.timestamp)
-            if pos > now:
-                break
-            # log track on air
-            self.log(type=Log.TYPE_ON_AIR, date=pos, source=log.source,
-                     track=track, comment=track)
-
-    def handle_diffusions(self):
-        """
-        Handle scheduled diffusion, trigger if needed, preload playlists
-        and so on.
-        """
-        # TODO: program restart
-
-        # Diffusion conflicts are handled by the way a diffusion is defined
-        # as candidate for the next dealer's start.
-        #
-        # ```
-        # logged_diff: /\ \A diff in diffs: \E log: /\ log.type = START
-        #                                           /\ log.diff = diff
-        #                                           /\ log.date = diff.start
-        # queue_empty: /\ dealer.queue is empty
-        #              /\ \/ ~dealer.on_air
-        #                 \/ dealer.remaining < delay
-        #
-        # start_allowed: /\ diff not in logged_diff
-        #                /\ queue_empty
-        #
-        # start_canceled: /\ diff not in logged diff
-        #                 /\ ~queue_empty
-        #                 /\ diff.start < now + cancel_timeout
-        # ```
-        #
-        now = tz.now()
-        diff = Diffusion.objects.station(self.station).on_air().now(now) \
-                        .filter(episode__sound__type=Sound.TYPE_ARCHIVE) \
-                        .first()
-        # Can't use delay: diffusion may start later than its assigned start.
-        log = None if not diff else self.logs.start().filter(diffusion=diff)
-        if not diff or log:
-            return
-
-        dealer = self.streamer.dealer
-        # start
-        if not dealer.queue and dealer.rid is None or \
-                dealer.remaining < self.delay.total_seconds():
-            self.start_diff(dealer, diff)
-
-        # cancel
-        if diff.start < now - self.cancel_timeout:
-            self.cancel_diff(dealer, diff)
-
-    def start_diff(self, source, diff):
-        playlist = Sound.objects.episode(id=diff.episode_id).paths()
-        source.push(*playlist)
-        self.log(type=Log.TYPE_START, source=source.id, diffusion=diff,
-                 comment=str(diff))
-
-    def cancel_diff(self, source, diff):
-        diff.type = Diffusion.TYPE_CANCEL
-        diff.save()
-        self.log(type=Log.TYPE_CANCEL, source=source.id, diffusion=diff,
-                 comment=str(diff))
-
-    def sync(self):
-        """ Update sources' playlists. """
-        now = tz.now()
-        if self.sync_next is not None and now < self.sync_next:
-            return
-
-        self.sync_next = now + tz.timedelta(minutes=self.sync_timeout)
-
-        for source in self.streamer.playlists:
-            source.sync()
-
-
 class Command (BaseCommand):
     help = __doc__
 
@@ -288,33 +73,189 @@ class Command (BaseCommand):
             help='time to wait in MINUTES before canceling a diffusion that '
                  'should have ran but did not. '
         )
+        group.add_argument(
+            '--adaptive', action='store_true',
+            help='skip tracing of sounds and tracks while the current sound '
+                 'is known to be playing, instead of tracing at each update.'
+        )
+        group.add_argument(
+            '--schedule', action='store_true',
+            help='wake up at diffusions start and cancel deadlines instead '
+                 'of waiting for the next update: DELAY can then be raised '
+                 'without delaying diffusions.'
+        )
+        group.add_argument(
+            '--preroll', type=float, default=0,
+            help='warm up archives of diffusions starting within PREROLL '
+                 'MINUTES, and report the unreadable ones.'
+        )
+        group.add_argument(
+            '--shared', action='store_true',
+            help='load diffusions of all monitored stations altogether, '
+                 'instead of running queries for each station.'
+        )
+        group.add_argument(
+            '--publish', type=float, default=0,
+            help='publish streamers\' state and metrics in the cache every '
+                 'PUBLISH seconds, so that the web API does not poll '
+                 'liquidsoap.'
+        )
+        group.add_argument(
+            '--metrics', type=str,
+            help='when publishing, dump metrics in Prometheus text format to '
+                 'METRICS file (where "{station}" is replaced by the '
+                 'station\'s slug).'
+        )
+        group.add_argument(
+            '-e', '--events', action='store_true',
+            help='trace what is on air using events sent by liquidsoap, and '
+                 'only poll it every RECONCILE seconds. Liquidsoap only '
+                 'sends events when config is generated with this option.'
+        )
+        group.add_argument(
+            '--reconcile', type=float,
+            default=Monitor.reconcile_timeout.total_seconds(),
+            help='when using events, time in SECONDS between two polls of '
+                 'liquidsoap.'
+        )
+        group.add_argument(
+            '--log-interval', type=float, default=0,
+            help='write logs in batch every LOG_INTERVAL SECONDS instead of '
+                 'immediately. Depending on the database, written logs '
+                 'may then not have a primary key.'
+        )
+        group.add_argument(
+            '-a', '--async', action='store_true', dest='use_async',
+            help='monitor stations concurrently in an asyncio event loop, '
+                 'such as a slow station does not delay the other ones.'
+        )
+        group.add_argument(
+            '-w', '--workers', action='store_true',
+            help='run each station in its own worker process, restarted '
+                 'when it exits or stalls.'
+        )
+        group.add_argument(
+            '--cpus', type=str,
+            help='with workers, comma separated list of CPUS workers are '
+                 'pinned to (one per worker, in turn).'
+        )
+        group.add_argument(
+            '--threads', type=int, default=4,
+            help='in async mode, max count of threads used for database '
+                 'work.'
+        )
         # TODO: sync-timeout, cancel-timeout
 
     def handle(self, *args, config=None, run=None, monitor=None, station=[],
-               delay=1000, timeout=600, **options):
+               delay=1000, timeout=600, use_async=False, threads=4,
+               adaptive=False, log_interval=0, events=False,
+               reconcile=60, schedule=False, preroll=0, shared=False,
+               workers=False, cpus=None, publish=0, metrics=None,
+               **options):
         stations = Station.objects.filter(name__in=station) if station else \
                    Station.objects.all()
-        streamers = [Streamer(station) for station in stations]
+        streamer_class = AsyncStreamer if use_async else Streamer
+        streamers = [streamer_class(station) for station in stations]
 
         for streamer in streamers:
             if not streamer.outputs:
                 raise RuntimeError("Streamer {} has no outputs".format(streamer.id))
+
+        delay = tz.timedelta(milliseconds=delay)
+        timeout = tz.timedelta(minutes=timeout)
+        monitor_kwargs = {
+            'adaptive': adaptive,
+            'scheduled': schedule,
+            'preroll_timeout': tz.timedelta(minutes=preroll)
+                               if preroll else None,
+            'reconcile_timeout': tz.timedelta(seconds=reconcile),
+            'publish_timeout': tz.timedelta(seconds=publish)
+                               if publish else None,
+            'metrics_path': metrics,
+        }
+        if workers and (run or monitor):
+            supervisor = Supervisor(
+                [station.pk for station in stations],
+                cpus=[int(cpu) for cpu in cpus.split(',')] if cpus else None,
+                config=config, run=run, monitor=monitor, delay=delay,
+                timeout=timeout, events=events, log_interval=log_interval,
+                **monitor_kwargs)
+            supervisor.run()
+            return
+
+        for streamer in streamers:
             if config:
+                streamer.events = events
                 streamer.make_config()
             if run:
                 streamer.run_process()
 
         if monitor:
-            delay = tz.timedelta(milliseconds=delay)
-            timeout = tz.timedelta(minutes=timeout)
-            monitors = [Monitor(streamer, delay, timeout)
-                        for streamer in streamers]
-
-            while not run or streamer.is_running:
-                for monitor in monitors:
+            if log_interval:
+                log_writer = LogWriter(interval=log_interval)
+                log_writer.install()
+                monitor_kwargs['log_writer'] = log_writer
+            if shared:
+                monitor_kwargs['timeline_group'] = TimelineGroup(
+                    log_writer=monitor_kwargs.get('log_writer'))
+            if use_async:
+                self.run_async(streamers, delay, timeout, run, events,
+                               threads, **monitor_kwargs)
+            else:
+                self.run(streamers, delay, timeout, run, events,
+                         **monitor_kwargs)
+        elif run:
+            # restart liquidsoap on failure
+            while True:
+                for streamer in streamers:
+                    streamer.supervise_process()
+                time.sleep(1)
+
+    def get_events(self, streamer, events):
+        """ Return EventListener for streamer if events are used. """
+        return EventListener(streamer.events_path) if events else None
+
+    def run(self, streamers, delay, timeout, run, events, **monitor_kwargs):
+        """ Monitor streamers one after the other. """
+        monitors = [Monitor(streamer, delay, timeout,
+                            events=self.get_events(streamer, events),
+                            **monitor_kwargs)
+                    for streamer in streamers]
+        listeners = [monitor.events for monitor in monitors
+                     if monitor.events is not None]
+        while True:
+            start = time.monotonic()
+            for monitor in monitors:
+                # when running liquidsoap, it is restarted on failure and
+                # monitored only once ready.
+                if not run or monitor.streamer.supervise_process():
                     monitor.monitor()
-                time.sleep(delay.total_seconds())
-
-        if run:
-            for streamer in streamers:
-                streamer.wait_process()
+            timeout = max(0, delay.total_seconds() -
+                          (time.monotonic() - start))
+            timeout = min(monitor.get_timeout(timeout) for monitor in monitors)
+            if listeners:
+                EventListener.wait_any(listeners, timeout)
+            else:
+                time.sleep(timeout)
+
+    def run_async(self, streamers, delay, timeout, run, events, threads,
+                  **monitor_kwargs):
+        """
+        Monitor streamers in an asyncio event loop, one task per station.
+        """
+        with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            # monitors are initialized from the database: it must be done
+            # outside of the event loop.
+            monitors = [AsyncMonitor(streamer, delay, timeout,
+                                     executor=executor,
+                                     events=self.get_events(streamer, events),
+                                     **monitor_kwargs)
+                        for streamer in streamers]
+            asyncio.run(self.gather(monitors, delay, run))
+
+    async def gather(self, monitors, delay, run):
+        await asyncio.gather(*(
+            monitor.run(delay, monitor.streamer.supervise_process
+                        if run else None)
+            for monitor in monitors
+        ))
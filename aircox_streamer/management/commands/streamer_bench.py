@@ -0,0 +1,129 @@
+"""
+Benchmark the streamer's monitor against fake liquidsoap servers (see
+`aircox_streamer.fake_liquidsoap`), for different counts of stations.
+
+Stations and programs are created inside a transaction that is rolled back
+at the end: the database is left untouched, and running monitors are not
+notified of these changes.
+"""
+from argparse import RawTextHelpFormatter
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone as tz
+
+from aircox.models import Program, Sound, Station, Stream
+
+from aircox_streamer import signals
+from aircox_streamer.controllers import Streamer
+from aircox_streamer.fake_liquidsoap import FakeLiquidsoap
+from aircox_streamer.monitor import Monitor
+
+
+class Command (BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.formatter_class = RawTextHelpFormatter
+        parser.add_argument(
+            '-s', '--stations', type=int, nargs='+', default=[1, 10, 50],
+            help='counts of stations to benchmark'
+        )
+        parser.add_argument(
+            '-n', '--ticks', type=int, default=20,
+            help='count of monitor ticks per station'
+        )
+        parser.add_argument(
+            '--duration', type=float, default=1.0,
+            help='duration in SECONDS of fake tracks'
+        )
+        parser.add_argument(
+            '--latency', type=float, default=0,
+            help='latency in MILLISECONDS of fake servers\' answers'
+        )
+        parser.add_argument(
+            '--failure-rate', type=float, default=0,
+            help='probability that fake servers drop a connection instead '
+                 'of answering'
+        )
+        parser.add_argument(
+            '--adaptive', action='store_true',
+            help='use adaptive monitors'
+        )
+
+    def handle(self, *args, stations=[], ticks=20, duration=1.0, latency=0,
+               failure_rate=0, adaptive=False, **options):
+        self.stdout.write('stations  ticks/s  round-trips/tick  '
+                          'commands/tick  queries/tick')
+        for count in stations:
+            with tempfile.TemporaryDirectory() as path, \
+                    transaction.atomic(), signals.local_versions():
+                stats = self.bench(path, count, ticks, duration=duration,
+                                   latency=latency / 1000,
+                                   failure_rate=failure_rate,
+                                   adaptive=adaptive)
+                transaction.set_rollback(True)
+            self.stdout.write('{:>8}  {:>7.1f}  {:>16.2f}  {:>13.2f}  '
+                              '{:>12.2f}'.format(count, *stats))
+
+    def create_station(self, path, index):
+        """ Create a station with a streamed program, return its sources """
+        station = Station.objects.create(
+            name='Bench {}'.format(index), slug='bench-{}'.format(index),
+            path='{}/{}'.format(path, index))
+        program = Program.objects.create(title='Bench {} stream'.format(index),
+                                         station=station)
+        Stream.objects.create(program=program)
+        playlist = []
+        for i in range(5):
+            sound = Sound(program=program, type=Sound.TYPE_ARCHIVE,
+                          path='{}/{}.ogg'.format(program.archives_path, i))
+            sound.save(check=False)
+            playlist.append(sound.path)
+        return station, {'dealer': None,
+                         program.slug.replace('-', '_'): playlist}
+
+    def bench(self, path, count, ticks, adaptive=False, **server_kwargs):
+        """
+        Run benchmark for `count` stations and return `(ticks/sec,
+        round-trips/tick, commands/tick, queries/tick)`.
+        """
+        servers, monitors, round_trips = [], [], [0]
+        for index in range(count):
+            station, sources = self.create_station(path, index)
+            streamer = Streamer(station)
+            server = FakeLiquidsoap(streamer.socket_path, sources,
+                                    **server_kwargs)
+            server.start()
+            servers.append(server)
+            monitors.append(Monitor(streamer, tz.timedelta(seconds=1),
+                                    tz.timedelta(minutes=20),
+                                    adaptive=adaptive))
+
+            # count round-trips
+            request = streamer.connector.request
+
+            def counted(commands, request=request):
+                round_trips[0] += 1
+                return request(commands)
+            streamer.connector.request = counted
+
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                start = time.monotonic()
+                for i in range(ticks):
+                    for monitor in monitors:
+                        monitor.monitor()
+                elapsed = time.monotonic() - start
+        finally:
+            for monitor, server in zip(monitors, servers):
+                monitor.streamer.connector.close()
+                server.stop()
+
+        total = ticks * count
+        return (total / elapsed, round_trips[0] / total,
+                sum(server.commands for server in servers) / total,
+                len(queries) / total)
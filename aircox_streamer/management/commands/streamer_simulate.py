@@ -0,0 +1,205 @@
+"""
+Simulate the playout of a station over a period (30 days by default) using
+the monitor against a simulated liquidsoap (see
+`aircox_streamer.fake_liquidsoap`) and a virtual clock, much faster than
+real time.
+
+Logs are written in a transaction that is rolled back at the end, unless
+`--commit` is given. Running monitors are not notified of the changes made
+by the simulation. Statistics are printed: logs that would have been
+written, diffusions' start lateness, cancellations and monitor CPU time per
+simulated hour.
+"""
+from argparse import RawTextHelpFormatter
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone as tz
+
+from aircox.models import Diffusion, Log, Sound, Station
+
+from aircox_streamer import signals
+from aircox_streamer.controllers import Streamer
+from aircox_streamer.fake_liquidsoap import FakeConnector, FakeLiquidsoap
+from aircox_streamer.monitor import Monitor
+
+
+class VirtualClock:
+    """ Clock advanced manually. """
+    now = None
+    """ Current datetime """
+
+    def __init__(self, now):
+        self.now = now
+
+    def timestamp(self):
+        return self.now.timestamp()
+
+
+class SimulatedMonitor(Monitor):
+    """
+    Monitor using a virtual clock. It neither writes playlists nor
+    publishes streamer's state, as they are used by the running station.
+    """
+    clock = None
+    """ VirtualClock """
+    publish_timeout = None
+
+    def now(self):
+        return self.clock.now
+
+    def sync(self):
+        pass
+
+
+class Command (BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.formatter_class = RawTextHelpFormatter
+        parser.add_argument(
+            'station', type=str, help='name of the station to simulate'
+        )
+        parser.add_argument(
+            '--start', type=str,
+            help='start date of the simulation as YYYY-MM-DD (now by default)'
+        )
+        parser.add_argument(
+            '--days', type=int, default=30,
+            help='count of simulated days'
+        )
+        parser.add_argument(
+            '-d', '--delay', type=int, default=10,
+            help='simulated time in SECONDS between two monitor updates'
+        )
+        parser.add_argument(
+            '-t', '--timeout', type=float, default=Monitor.cancel_timeout,
+            help='time in MINUTES before canceling a diffusion'
+        )
+        parser.add_argument(
+            '--track-duration', type=float, default=240,
+            help='duration in SECONDS of sounds without a known duration'
+        )
+        parser.add_argument(
+            '--adaptive', action='store_true',
+            help='use an adaptive monitor'
+        )
+        parser.add_argument(
+            '--commit', action='store_true',
+            help='keep the logs written by the simulation in the database'
+        )
+
+    def handle(self, station, start=None, days=30, delay=10, timeout=20,
+               track_duration=240, adaptive=False, commit=False, **options):
+        station = Station.objects.filter(name=station).first()
+        if station is None:
+            raise CommandError('station not found')
+
+        start = tz.make_aware(datetime.datetime.strptime(start, '%Y-%m-%d')) \
+            if start else tz.now()
+        end = start + tz.timedelta(days=days)
+
+        with transaction.atomic(), signals.local_versions():
+            stats = self.simulate(station, start, end, delay, timeout,
+                                  track_duration, adaptive=adaptive)
+            logs = Log.objects.station(station) \
+                      .filter(pk__gt=stats['last_log']) \
+                      .values_list('type').annotate(count=Count('pk'))
+            stats['logs'] = {dict(Log.TYPE_CHOICES)[t]: c for t, c in logs}
+            if not commit:
+                transaction.set_rollback(True)
+        self.report(stats)
+
+    def get_durations(self, station, start, end, track_duration):
+        """
+        Return sounds' durations in seconds by path. Diffusions' archives
+        share their diffusion's duration.
+        """
+        durations = {}
+        sounds = Sound.objects.station(station).archive() \
+                      .filter(path__isnull=False) \
+                      .values_list('path', 'duration')
+        for path, duration in sounds:
+            durations[path] = duration.hour * 3600 + duration.minute * 60 + \
+                duration.second if duration else track_duration
+
+        diffs = Diffusion.objects.station(station).on_air() \
+                         .filter(start__lt=end, end__gt=start)
+        sounds = Sound.objects.archive() \
+                      .filter(episode__diffusion__in=diffs,
+                              path__isnull=False, duration__isnull=True) \
+                      .values_list('path', 'episode__diffusion__start',
+                                   'episode__diffusion__end', 'episode_id')
+        counts = Sound.objects.archive() \
+                      .filter(episode__diffusion__in=diffs) \
+                      .values_list('episode_id').annotate(count=Count('pk'))
+        counts = dict(counts)
+        for path, diff_start, diff_end, episode_id in sounds:
+            durations[path] = (diff_end - diff_start).total_seconds() / \
+                counts.get(episode_id, 1)
+        return durations
+
+    def simulate(self, station, start, end, delay, timeout, track_duration,
+                 **monitor_kwargs):
+        clock = VirtualClock(start)
+        streamer = Streamer(station)
+        playlists = streamer.get_playlists()
+        sources = {'dealer': None}
+        sources.update((source.id, playlists[source.program.pk] or None)
+                       for source in streamer.playlists)
+        fake = FakeLiquidsoap(
+            sources=sources, clock=clock.timestamp,
+            durations=self.get_durations(station, start, end, track_duration),
+            duration=track_duration)
+        streamer.connector = FakeConnector(fake)
+
+        last_log = Log.objects.order_by('-pk').values_list('pk', flat=True) \
+                      .first() or 0
+        monitor = SimulatedMonitor(
+            streamer, tz.timedelta(seconds=delay),
+            tz.timedelta(minutes=timeout), clock=clock, **monitor_kwargs)
+
+        step = tz.timedelta(seconds=delay)
+        cpu, wall = time.process_time(), time.monotonic()
+        while clock.now < end:
+            monitor.monitor()
+            clock.now += step
+        cpu, wall = time.process_time() - cpu, time.monotonic() - wall
+
+        # start logs are dated when diffusions are pushed
+        starts = Log.objects.station(station) \
+                    .filter(type=Log.TYPE_START, pk__gt=last_log,
+                            diffusion__isnull=False) \
+                    .values_list('date', 'diffusion__start')
+        return {
+            'last_log': last_log,
+            'hours': (end - start).total_seconds() / 3600,
+            'cpu': cpu, 'wall': wall,
+            'lateness': [(date - start).total_seconds()
+                         for date, start in starts],
+            'cancels': Log.objects.station(station).filter(
+                type=Log.TYPE_CANCEL, pk__gt=last_log).count(),
+        }
+
+    def report(self, stats):
+        write = self.stdout.write
+        write('simulated {hours:.0f} hours in {wall:.1f}s ({speed:.0f}x '
+              'real time)'.format(speed=stats['hours'] * 3600 / stats['wall'],
+                                  **stats))
+        write('monitor CPU time: {:.1f}ms per simulated hour'
+              .format(stats['cpu'] * 1000 / stats['hours']))
+
+        lateness = stats['lateness']
+        if lateness:
+            write('started diffusions: {}, lateness mean: {:.1f}s, '
+                  'max: {:.1f}s'.format(len(lateness),
+                                        sum(lateness) / len(lateness),
+                                        max(lateness)))
+        else:
+            write('started diffusions: 0')
+        write('canceled diffusions: {}'.format(stats['cancels']))
+        for type, count in sorted(stats['logs'].items()):
+            write('logs {}: {}'.format(type, count))
@@ -0,0 +1,121 @@
+"""
+Metrics of the streamer and its monitor: counters and histograms labelled
+by station, rendered in Prometheus text format.
+
+Metrics classes are provided by `aircox.metrics`. Each process has its own
+registry. Monitors publish the metrics of their station in the cache, from
+which they are read by the admin's metrics view (see `publish` and
+`load`). They can also be dumped in a file.
+"""
+import contextlib
+import time
+
+from django.core.cache import cache
+from django.db import connection
+
+from aircox.metrics import Counter, Histogram, Registry
+from aircox.models import Log
+
+
+__all__ = ['Counter', 'Histogram', 'Registry', 'registry', 'measure',
+           'count_queries', 'publish', 'load']
+
+
+registry = Registry(labels=('station',))
+"""
+Registry of the current process. Metrics' first label is always the
+station.
+"""
+
+SOCKET_TIME = registry.histogram(
+    'aircox_streamer_socket_seconds',
+    'Time of a round-trip to liquidsoap')
+SOCKET_ERRORS = registry.counter(
+    'aircox_streamer_socket_errors_total',
+    'Failed round-trips to liquidsoap')
+TICK_TIME = registry.histogram(
+    'aircox_streamer_tick_seconds', 'Time of a monitor pass')
+TICK_QUERIES = registry.histogram(
+    'aircox_streamer_tick_queries', 'Database queries of a monitor pass',
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 500))
+LOG_TYPES = {
+    Log.TYPE_STOP: 'stop', Log.TYPE_START: 'start',
+    Log.TYPE_CANCEL: 'cancel', Log.TYPE_ON_AIR: 'on_air',
+    Log.TYPE_OTHER: 'other',
+}
+""" Value of the `type` label of logs, by log type """
+LOGS = registry.counter(
+    'aircox_streamer_logs_total', 'Logs written by the monitor',
+    labels=('station', 'type'))
+DIFFUSIONS_STARTED = registry.counter(
+    'aircox_streamer_diffusions_started_total', 'Started diffusions')
+DIFFUSIONS_CANCELED = registry.counter(
+    'aircox_streamer_diffusions_canceled_total', 'Canceled diffusions')
+DIFFUSIONS_LATENESS = registry.histogram(
+    'aircox_streamer_diffusions_lateness_seconds',
+    'Delay between diffusions\' start and their actual start',
+    buckets=(.5, 1, 2, 5, 10, 30, 60, 300, 900))
+RESTARTS = registry.counter(
+    'aircox_streamer_restarts_total', 'Restarts of liquidsoap')
+RECOVERY_TIME = registry.histogram(
+    'aircox_streamer_recovery_seconds',
+    'Time from liquidsoap\'s exit to its restarted process being ready',
+    buckets=(1, 2, 5, 10, 30, 60, 120, 300))
+PLAYLIST_SYNCS = registry.counter(
+    'aircox_streamer_playlist_syncs_total', 'Playlists synchronisations')
+PLAYLIST_WRITES = registry.counter(
+    'aircox_streamer_playlist_writes_total', 'Playlists files written')
+
+
+@contextlib.contextmanager
+def measure(histogram, **labels):
+    """ Observe the time spent in the context. """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        histogram.observe(time.monotonic() - start, **labels)
+
+
+@contextlib.contextmanager
+def count_queries(histogram, **labels):
+    """
+    Observe the count of database queries run in the context (by the
+    current thread).
+    """
+    count = [0]
+
+    def wrapper(execute, *args, **kwargs):
+        count[0] += 1
+        return execute(*args, **kwargs)
+
+    try:
+        with connection.execute_wrapper(wrapper):
+            yield
+    finally:
+        histogram.observe(count[0], **labels)
+
+
+# Publication ##########################################################
+TIMEOUT = 300
+""" Published metrics expire after this time in seconds """
+
+
+def get_key(station_id):
+    return 'aircox_streamer.metrics.{}'.format(station_id)
+
+
+def publish(station_id, timeout=TIMEOUT):
+    """ Publish metrics of the given station in the cache. """
+    cache.set(get_key(station_id), registry.dump_state(station_id), timeout)
+
+
+def load(station_ids):
+    """
+    Return a new registry holding the metrics published for the given
+    stations.
+    """
+    loaded = registry.copy()
+    for state in cache.get_many([get_key(id) for id in station_ids]).values():
+        loaded.load_state(state)
+    return loaded
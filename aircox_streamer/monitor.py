@@ -0,0 +1,653 @@
+"""
+Monitor of the streamer: log what happens on air, launch scheduled
+diffusions and keep playlists up to date.
+"""
+import asyncio
+import concurrent.futures as futures
+import logging
+import time
+
+from django.db.models import Max, Subquery
+from django.utils import timezone as tz
+
+from aircox import settings
+from aircox.models import Diffusion, Track, Sound, Log
+from aircox.utils import date_range
+
+from . import metrics, signals, state
+from .controllers import PlaylistSource
+from .events import Event
+from .preroll import Preroll
+from .rotation import Rotation
+from .scheduler import DiffusionScheduler
+from .timeline import DiffusionTimeline
+
+
+__all__ = ['OnAirState', 'Monitor', 'AsyncMonitor']
+
+
+logger = logging.getLogger('aircox')
+
+
+class OnAirState:
+    r"""
+    In-memory state of what is currently on air for a station. It is used
+    to skip sound and tracks tracing while the current sound is known to be
+    playing, as:
+
+    ```
+    deadline = min(source.air_time + next_track.timestamp,
+                   now + source.remaining) - delay
+    trace_required = \/ source' != source
+                     \/ source.rid' != source.rid
+                     \/ source.uri' != source.uri
+                     \/ now >= deadline
+    ```
+    """
+    source = None
+    """ Id of the source on air """
+    rid = None
+    """ Request id on air """
+    uri = None
+    """ Uri of the sound on air """
+    log = None
+    """ On air log of the sound """
+    deadline = None
+    """ Datetime until which tracing can be skipped """
+    ticks = 0
+    """ Count of monitoring passes """
+    skipped = 0
+    """ Count of monitoring passes for which tracing has been skipped """
+
+    def is_playing(self, source, now):
+        """
+        Return True if the given source is still playing the same sound
+        and tracing is not required before the deadline.
+        """
+        return source is not None and self.deadline is not None and \
+            now < self.deadline and source.id == self.source and \
+            source.rid == self.rid and source.uri == self.uri
+
+    def update(self, source, log, next_track, now, delay):
+        """
+        Update state for the given source and its on air log. `next_track`
+        is the next track to log on air, if any.
+        """
+        self.source, self.rid, self.uri, self.log = \
+            source.id, source.rid, source.uri, log
+
+        deadlines = []
+        if source.remaining:
+            deadlines.append(now + tz.timedelta(seconds=source.remaining))
+        if next_track is not None and log is not None:
+            deadlines.append(log.date +
+                             tz.timedelta(seconds=next_track.timestamp))
+        self.deadline = min(deadlines) - delay if deadlines else None
+
+    def reset(self):
+        self.source = self.rid = self.uri = self.log = self.deadline = None
+
+
+class Monitor:
+    """
+    Log and launch diffusions for the given station.
+
+    Monitor should be able to be used after a crash a go back
+    where it was playing, so we heavily use logs to be able to
+    do that.
+
+    We keep trace of played items on the generated stream:
+    - sounds played on this stream;
+    - scheduled diffusions
+    - tracks for sounds of streamed programs
+    """
+    streamer = None
+    """ Streamer controller """
+    delay = None
+    """ Timedelta: minimal delay between two call of monitor. """
+    logs = None
+    """ Queryset to station's logs (ordered by -pk) """
+    cancel_timeout = 20
+    """ Timeout in minutes before cancelling a diffusion. """
+    sync_timeout = 5
+    """
+    Timeout in minutes between two streamer's sync. Sync also happens when
+    sounds change (see `aircox_streamer.signals`).
+    """
+    sync_next = None
+    """ Datetime of the next sync """
+    sync_version = None
+    """ Version of the playlists at last sync """
+    adaptive = False
+    """
+    If True, skip sound and tracks tracing while the current sound is known
+    to be playing (see `OnAirState`).
+    """
+    on_air = None
+    """ OnAirState of the station """
+    sound_logs = None
+    """
+    Last on air sound log by source id, used by `trace_sound` in order to
+    avoid querying the database while the same sound is playing.
+    """
+    timeline = None
+    """ DiffusionTimeline of the station's diffusions """
+    timeline_group = None
+    """
+    If given, TimelineGroup from which timeline is taken, in order to share
+    diffusions' queries with other monitors.
+    """
+    log_writer = None
+    """ If given, LogWriter used to write logs """
+    events = None
+    """
+    If given, EventListener from which on air events are received. The
+    streamer is then only polled every `reconcile_timeout`.
+    """
+    reconcile_timeout = tz.timedelta(minutes=1)
+    """ When using events, delay between two polls of the streamer """
+    reconcile_next = None
+    """ Datetime of the next poll when using events """
+    scheduled = False
+    """
+    If True, diffusions are only handled when one of their deadlines is
+    reached (see `DiffusionScheduler`), and `get_timeout` returns the time
+    left until the next one.
+    """
+    scheduler = None
+    """ DiffusionScheduler, when `scheduled` """
+    preroll_timeout = None
+    """
+    If given, timedelta before diffusions' start at which their archives
+    are warmed up (see `Preroll`).
+    """
+    preroll = None
+    """ Preroll, when `preroll_timeout` is given """
+    publish_timeout = None
+    """
+    Delay between two publications of the streamer's state (see
+    `aircox_streamer.state`) and metrics. If None, they are not published.
+    """
+    publish_next = None
+    """ Datetime of the next publication """
+    metrics_path = None
+    """
+    If given, path of the file metrics are dumped to on publication. It can
+    contain `{station}`, replaced by the station's slug.
+    """
+
+    @property
+    def station(self):
+        return self.streamer.station
+
+    @property
+    def last_log(self):
+        """ Last log of monitored station. """
+        return self.logs.first()
+
+    @property
+    def last_diff_start(self):
+        """ Log of last triggered item (sound or diffusion). """
+        return self.logs.start().with_diff().first()
+
+    def __init__(self, streamer, delay, cancel_timeout, **kwargs):
+        self.streamer = streamer
+        # adding time ensure all calculation have a margin
+        self.delay = delay + tz.timedelta(seconds=5)
+        self.cancel_timeout = cancel_timeout
+        self.__dict__.update(kwargs)
+        self.logs = self.get_logs_queryset()
+        self.on_air = OnAirState()
+        if settings.AIRCOX_STREAMER_ROTATION and streamer.rotation is None:
+            streamer.rotation = Rotation(self.station)
+        if self.timeline_group is not None:
+            self.timeline = self.timeline_group.get_timeline(self.station)
+        else:
+            self.timeline = DiffusionTimeline(self.station,
+                                              log_writer=self.log_writer)
+        if self.scheduled:
+            self.scheduler = DiffusionScheduler(self.timeline,
+                                                self.cancel_timeout)
+        if self.preroll_timeout:
+            self.preroll = Preroll(self.timeline, self.preroll_timeout)
+        self.load_sound_logs()
+
+    def now(self):
+        """ Return current datetime (overridden by simulations). """
+        return tz.now()
+
+    def get_logs_queryset(self):
+        """ Return queryset to assign as `self.logs` """
+        return self.station.log_set.select_related('diffusion', 'sound') \
+                           .order_by('-pk')
+
+    def load_sound_logs(self):
+        """
+        Load last on air sound log of each source from the database (used
+        to go back to where we were after a restart).
+        """
+        last_logs = self.logs.on_air().filter(track__isnull=True) \
+                             .order_by().values('source') \
+                             .annotate(last_pk=Max('pk')) \
+                             .values('last_pk')
+        self.sound_logs = {log.source: log for log in
+                           self.logs.filter(pk__in=Subquery(last_logs))}
+
+    def monitor(self):
+        """ Run all monitoring functions once. """
+        with metrics.measure(metrics.TICK_TIME, station=self.station.pk):
+            if self.events is not None and not self.is_reconcile_due():
+                self.count_queries(self.process_events)
+                return
+
+            if not self.streamer.is_ready:
+                return
+
+            self.streamer.fetch()
+            self.count_queries(self.process)
+
+    def count_queries(self, func):
+        """ Run `func`, observing the count of its database queries. """
+        with metrics.count_queries(metrics.TICK_QUERIES,
+                                   station=self.station.pk):
+            return func()
+
+    def get_timeout(self, timeout):
+        """
+        Return time in seconds to wait before the next call of `monitor`, at
+        most `timeout` seconds.
+        """
+        if self.scheduler is None:
+            return timeout
+        return self.scheduler.get_timeout(self.now(), timeout)
+
+    def is_reconcile_due(self):
+        """ When using events, return True if streamer must be polled. """
+        now = self.now()
+        if self.reconcile_next is not None and now < self.reconcile_next:
+            return False
+        self.reconcile_next = now + self.reconcile_timeout
+        return True
+
+    def process(self):
+        """
+        Run monitoring functions using data previously fetched from the
+        streamer.
+        """
+        source = self.streamer.source
+        self.on_air.ticks += 1
+        if self.adaptive and self.on_air.is_playing(source, self.now()):
+            self.on_air.skipped += 1
+        else:
+            self.trace(source)
+        self.handle()
+
+    def process_events(self):
+        """
+        Run monitoring functions using events received from liquidsoap
+        instead of polling it.
+        """
+        for event in self.events.read():
+            self.on_event(event)
+        self.handle(fetch=True)
+
+    def on_event(self, event):
+        """ Update sources from event, and trace new tracks. """
+        source = next((source for source in self.streamer.sources
+                       if source.id == event.source), None)
+        if source is None:
+            return
+
+        if event.type == Event.TYPE_TRACK:
+            self.streamer.source = source
+            source.validate(event.metadata)
+            self.trace(source)
+        else:
+            source.validate(event.metadata)
+
+    def trace(self, source):
+        """ Trace sound and tracks of the given source on air. """
+        if source and source.uri:
+            log = self.trace_sound(source)
+            next_track = self.trace_tracks(log) if log else None
+            self.on_air.update(source, log, next_track, self.now(),
+                               self.delay)
+        else:
+            self.on_air.reset()
+            print('no source or sound for stream; source = ', source)
+
+    def handle(self, fetch=False):
+        """
+        Handle diffusions, playlists and logs. If `fetch`, dealer's data is
+        fetched before starting a diffusion.
+        """
+        self.handle_diffusions(fetch)
+        if self.preroll is not None:
+            self.preroll.check(self.now())
+        self.sync()
+        self.publish()
+        if self.log_writer is not None:
+            self.log_writer.check()
+
+    def publish(self):
+        """ Publish streamer's state snapshot. """
+        now = self.now()
+        if self.publish_timeout is None or \
+                self.publish_next is not None and now < self.publish_next:
+            return
+        self.publish_next = now + self.publish_timeout
+        state.publish(self.streamer)
+        metrics.publish(self.station.pk)
+        if self.metrics_path:
+            metrics.registry.dump(
+                self.metrics_path.format(station=self.station.slug))
+
+    def log(self, date=None, **kwargs):
+        """ Create a log using **kwargs, and print info """
+        kwargs.setdefault('station', self.station)
+        log = Log(date=date or self.now(), **kwargs)
+        if self.log_writer is not None:
+            self.log_writer.write(log)
+        else:
+            log.save()
+        metrics.LOGS.inc(station=self.station.pk,
+                         type=metrics.LOG_TYPES.get(log.type, log.type))
+        log.print()
+        return log
+
+    def is_sound_log(self, log, source):
+        """
+        Return True if log is the on air log of the source's current sound.
+        """
+        # sound can be null when arbitrary sound file is played, but
+        # comment is always the uri.
+        if log.comment != source.uri and \
+                (log.sound is None or log.sound.path != source.uri):
+            return False
+        if log.date is None or source.air_time is None:
+            return log.date == source.air_time
+        start, end = date_range(source.air_time, self.delay)
+        return start <= log.date <= end
+
+    def trace_sound(self, source):
+        """ Return on air sound log (create if not present). """
+        air_uri, air_time = source.uri, source.air_time
+
+        # check if there is yet a log for this sound on the source
+        log = self.sound_logs.get(source.id)
+        if log is not None and self.is_sound_log(log, source):
+            return log
+
+        # get sound
+        diff = None
+        sound = Sound.objects.filter(path=air_uri).first()
+        if sound and sound.episode_id is not None:
+            diff = Diffusion.objects.episode(id=sound.episode_id).on_air() \
+                                    .now(air_time).first()
+
+        # log sound on air
+        log = self.log(type=Log.TYPE_ON_AIR, date=source.air_time,
+                       source=source.id, sound=sound, diffusion=diff,
+                       comment=air_uri)
+        self.sound_logs[source.id] = log
+
+        rotation = self.streamer.rotation
+        if rotation is not None and sound is not None:
+            rotation.history.add(sound.pk, log.date or self.now())
+            # rotation playlist must be updated
+            if isinstance(source, PlaylistSource):
+                self.sync_next = None
+        return log
+
+    def trace_tracks(self, log):
+        """
+        Log tracks for the given sound log (for streamed programs only).
+        Return the next track to be logged, if any.
+        """
+        if log.diffusion:
+            return
+
+        tracks = Track.objects \
+                      .filter(sound__id=log.sound_id, timestamp__isnull=False)\
+                      .order_by('timestamp')
+        if not tracks.exists():
+            return
+
+        # exclude already logged tracks (logs may not have been written
+        # yet: we can't rely on their pk)
+        tracks = tracks.exclude(log__station=self.station,
+                                log__date__gte=log.date)
+        if self.log_writer is not None:
+            tracks = tracks.exclude(pk__in=[
+                l.track_id for l in self.log_writer.pending(self.station)
+                if l.track_id is not None and l.date >= log.date
+            ])
+        now = self.now()
+        for track in tracks:
+            pos = log.date + tz.timedelta(seconds=track.timestamp)
+            if pos > now:
+                return track
+            # log track on air
+            self.log(type=Log.TYPE_ON_AIR, date=pos, source=log.source,
+                     track=track, comment=track)
+
+    def handle_diffusions(self, fetch=False):
+        """
+        Handle scheduled diffusion, trigger if needed, preload playlists
+        and so on. If `fetch`, dealer's data is fetched from the streamer
+        before deciding to start the diffusion.
+        """
+        # TODO: program restart
+
+        # Diffusion conflicts are handled by the way a diffusion is defined
+        # as candidate for the next dealer's start.
+        #
+        # ```
+        # logged_diff: /\ \A diff in diffs: \E log: /\ log.type = START
+        #                                           /\ log.diff = diff
+        #                                           /\ log.date = diff.start
+        # queue_empty: /\ dealer.queue is empty
+        #              /\ \/ ~dealer.on_air
+        #                 \/ dealer.remaining < delay
+        #
+        # start_allowed: /\ diff not in logged_diff
+        #                /\ queue_empty
+        #
+        # start_canceled: /\ diff not in logged diff
+        #                 /\ ~queue_empty
+        #                 /\ diff.start < now + cancel_timeout
+        # ```
+        #
+        now = self.now()
+        if self.scheduler is not None:
+            deadlines = self.scheduler.pop(now)
+            if not deadlines:
+                return
+
+        item = self.timeline.get(now)
+        # Can't use delay: diffusion may start later than its assigned start.
+        if not item:
+            return
+        if item.started:
+            # an overlapping diffusion is on air: reached deadlines are
+            # handled again once it ends (as polling would do).
+            if self.scheduler is not None:
+                retry = item.end + tz.timedelta(seconds=1)
+                for _, _, type, pending in deadlines:
+                    self.scheduler.push(retry, type, pending)
+            return
+
+        diff = item.diffusion
+        dealer = self.streamer.dealer
+        if fetch:
+            dealer.fetch()
+
+        # start
+        if not dealer.queue and dealer.rid is None or \
+                dealer.remaining < self.delay.total_seconds():
+            self.start_diff(dealer, diff, item.playlist)
+            item.started = True
+
+        # cancel
+        if diff.start < now - self.cancel_timeout:
+            self.cancel_diff(dealer, diff)
+            self.timeline.remove(item)
+        elif not item.started and self.scheduler is not None:
+            # retry once dealer's current sound is about to end
+            retry = max(dealer.remaining - self.delay.total_seconds(), 1)
+            self.scheduler.push(now + tz.timedelta(seconds=retry),
+                                self.scheduler.START, item)
+
+    def start_diff(self, source, diff, playlist=None):
+        if playlist is None:
+            playlist = Sound.objects.episode(id=diff.episode_id).paths()
+        source.push(*playlist)
+        lateness = self.now() - diff.start
+        metrics.DIFFUSIONS_STARTED.inc(station=self.station.pk)
+        metrics.DIFFUSIONS_LATENESS.observe(lateness.total_seconds(),
+                                            station=self.station.pk)
+        logger.info('monitor %s: diffusion %s started, %.3fs late',
+                    self.station, diff, lateness.total_seconds())
+        self.log(type=Log.TYPE_START, source=source.id, diffusion=diff,
+                 comment=str(diff))
+
+    def cancel_diff(self, source, diff):
+        diff.type = Diffusion.TYPE_CANCEL
+        diff.save()
+        metrics.DIFFUSIONS_CANCELED.inc(station=self.station.pk)
+        self.log(type=Log.TYPE_CANCEL, source=source.id, diffusion=diff,
+                 comment=str(diff))
+
+    def sync(self):
+        """ Update sources' playlists. """
+        now = self.now()
+        version = signals.get_version(signals.PLAYLISTS)
+        if version == self.sync_version and self.sync_next is not None \
+                and now < self.sync_next:
+            return
+
+        self.sync_version = version
+        self.sync_next = now + tz.timedelta(minutes=self.sync_timeout)
+        self.streamer.sync_playlists()
+
+
+class AsyncMonitor(Monitor):
+    """
+    Monitor running inside an asyncio event loop: data is fetched from
+    liquidsoap without blocking the loop, and database work is run in the
+    given executor. Multiple stations can then be monitored concurrently
+    without a slow one delaying the others.
+
+    Streamer must be an `AsyncStreamer`.
+    """
+    executor = None
+    """ Executor used to run database work """
+    timeout = 30
+    """ Timeout in seconds of a single monitoring pass. """
+    pending = None
+    """ concurrent.futures.Future of database work still running """
+    next_deadline = None
+    """
+    When `scheduled`, monotonic time of the next deadline, as computed at
+    the end of the last pass (the scheduler is only used by the executor's
+    threads).
+    """
+
+    def __init__(self, streamer, delay, cancel_timeout, executor=None,
+                 **kwargs):
+        super().__init__(streamer, delay, cancel_timeout, **kwargs)
+        self.executor = executor or futures.ThreadPoolExecutor(1)
+
+    @property
+    def is_busy(self):
+        """
+        True while database work of a previous pass is still running (e.g.
+        after a timeout): streamer's data must not be touched meanwhile.
+        """
+        return self.pending is not None and not self.pending.done()
+
+    async def monitor(self):
+        """ Run all monitoring functions once. """
+        if self.is_busy:
+            logger.warning('monitor %s: previous pass still running',
+                           self.station)
+            return
+
+        with metrics.measure(metrics.TICK_TIME, station=self.station.pk):
+            if self.events is not None and not self.is_reconcile_due():
+                await self.run_in_executor(self.process_events)
+                return
+
+            if not await self.streamer.async_is_ready():
+                return
+
+            await self.streamer.async_fetch()
+            await self.run_in_executor(self.process)
+
+    async def run_in_executor(self, func):
+        """
+        Run database work `func` in the executor. The executor's future is
+        kept, since cancelling the awaiting task (on timeout) does not stop
+        the running thread.
+        """
+        self.pending = self.executor.submit(self.run_pass, func)
+        await asyncio.shield(asyncio.wrap_future(self.pending))
+
+    def run_pass(self, func):
+        """ Run database work `func` (from the executor). """
+        self.count_queries(func)
+        if self.scheduler is not None:
+            timeout = super().get_timeout(float('inf'))
+            self.next_deadline = time.monotonic() + timeout
+
+    def get_timeout(self, timeout):
+        """
+        Same as `Monitor.get_timeout`, using the deadline computed by the
+        last pass.
+        """
+        if self.next_deadline is None:
+            return timeout
+        return max(0, min(timeout, self.next_deadline - time.monotonic()))
+
+    async def wait(self, timeout):
+        """
+        Wait for `timeout` seconds, or until events are received if
+        listening to them.
+        """
+        if self.events is None:
+            await asyncio.sleep(timeout)
+            return
+
+        loop, ready = asyncio.get_running_loop(), asyncio.Event()
+        self.events.open()
+        loop.add_reader(self.events.fileno(), ready.set)
+        try:
+            await asyncio.wait_for(ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            loop.remove_reader(self.events.fileno())
+
+    async def run(self, delay, is_ready=None):
+        """
+        Run monitor forever, waiting `delay` (timedelta) between two passes.
+        If given, passes are skipped while `is_ready()` returns False. As it
+        may block (e.g. `Streamer.supervise_process`), it is run in the
+        loop's default executor.
+        """
+        loop = asyncio.get_running_loop()
+        delay = delay.total_seconds()
+        while True:
+            start = loop.time()
+            if is_ready is not None and \
+                    not await loop.run_in_executor(None, is_ready):
+                await asyncio.sleep(delay)
+                continue
+            try:
+                await asyncio.wait_for(self.monitor(), self.timeout)
+            except asyncio.TimeoutError:
+                logger.warning('monitor %s: timeout', self.station)
+            except Exception:
+                logger.exception('monitor %s: unexpected error', self.station)
+            await self.wait(self.get_timeout(
+                max(0, delay - (loop.time() - start))))
@@ -0,0 +1,85 @@
+from concurrent import futures
+import logging
+import os
+
+from django.utils import timezone as tz
+
+
+__all__ = ['Preroll']
+
+
+logger = logging.getLogger('aircox')
+
+
+class Preroll:
+    """
+    Warm up archives of the diffusions starting soon: check they exist and
+    are readable, and ask the kernel to load them in the page cache, such
+    as liquidsoap does not wait for a slow storage at diffusion start.
+
+    Files are warmed up in a background thread; problems are logged as
+    warnings before air time.
+    """
+    timeline = None
+    """ DiffusionTimeline of the station """
+    timeout = tz.timedelta(minutes=10)
+    """ Warm up diffusions starting within this timedelta """
+    warmed = None
+    """ Ids of diffusions already warmed up """
+    errors = None
+    """ List of `(path, error)` for unreadable archives, by diffusion id """
+    executor = None
+    """ Executor used to warm up files """
+
+    def __init__(self, timeline, timeout=None, executor=None):
+        self.timeline = timeline
+        if timeout is not None:
+            self.timeout = timeout
+        self.executor = executor or futures.ThreadPoolExecutor(max_workers=1)
+        self.warmed = set()
+        self.errors = {}
+
+    def check(self, now=None):
+        """ Warm up files of diffusions starting before `now + timeout`. """
+        now = now or tz.now()
+        if self.timeline.is_outdated(now):
+            self.timeline.refresh(now)
+
+        self.warmed &= {item.diffusion.pk for item in self.timeline.items}
+        end = now + self.timeout
+        for item in self.timeline.items:
+            if item.start > end:
+                break
+            if item.started or item.diffusion.pk in self.warmed:
+                continue
+            self.warmed.add(item.diffusion.pk)
+            self.executor.submit(self.warm, item.diffusion, item.playlist)
+
+    def warm(self, diffusion, playlist):
+        """ Warm up playlist's files, return list of `(path, error)`. """
+        if not playlist:
+            logger.warning('preroll %s: no archive to play', diffusion)
+
+        errors = []
+        for path in playlist:
+            try:
+                self.warm_file(path)
+            except OSError as err:
+                logger.warning('preroll %s: archive %s is not readable: %s',
+                               diffusion, path, err)
+                errors.append((path, err))
+        self.errors[diffusion.pk] = errors
+        return errors
+
+    @staticmethod
+    def warm_file(path):
+        """ Load file in the page cache (raise OSError on failure). """
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            else:
+                # read first block at least
+                os.read(fd, 4096)
+        finally:
+            os.close(fd)
@@ -0,0 +1,116 @@
+"""
+Rotation of streamed programs' sounds, generated by aircox from the play
+history of the station instead of being shuffled by liquidsoap.
+"""
+import datetime
+import random
+
+from django.db.models import Max
+from django.utils import timezone as tz
+
+from aircox import settings
+from aircox.models import Log, Sound, Stream
+
+
+__all__ = ['PlayHistory', 'Rotation']
+
+
+class PlayHistory:
+    """
+    In-memory index of the last on air date of a station's sounds, loaded
+    from logs in a single aggregated query.
+    """
+    station = None
+    """ Related station """
+    last_plays = None
+    """ Last on air datetime by sound id """
+
+    def __init__(self, station):
+        self.station = station
+
+    def load(self):
+        """ Load history from the database. """
+        self.last_plays = dict(
+            Log.objects.station(self.station).on_air()
+               .filter(sound__isnull=False).order_by()
+               .values('sound').annotate(last=Max('date'))
+               .values_list('sound', 'last')
+        )
+
+    def get(self, sound_id):
+        """ Return last on air date of the sound (or None). """
+        if self.last_plays is None:
+            self.load()
+        return self.last_plays.get(sound_id)
+
+    def add(self, sound_id, date):
+        """ Register a sound played at the given date. """
+        if self.last_plays is None:
+            self.load()
+        last = self.last_plays.get(sound_id)
+        if last is None or last < date:
+            self.last_plays[sound_id] = date
+
+
+class Rotation:
+    """
+    Generate playlists of streamed programs: eligible sounds are the
+    archives not marked as bad quality and not played since the stream's
+    delay. They are ordered by last play date, never played ones first.
+
+    Only the `size` first sounds are written to playlists: they are updated
+    as sounds are played.
+    """
+    history = None
+    """ PlayHistory of the station """
+    size = None
+    """ Count of sounds in playlists """
+    seed = None
+    """ Used to order sounds never played, stable across syncs """
+
+    def __init__(self, station, size=None):
+        self.history = PlayHistory(station)
+        self.size = settings.AIRCOX_STREAMER_ROTATION_SIZE \
+            if size is None else size
+        self.seed = random.random()
+
+    def get_queryset(self, programs):
+        """ Return queryset of the programs' eligible sounds. """
+        return Sound.objects.archive() \
+                    .filter(program__in=programs, path__isnull=False) \
+                    .exclude(is_good_quality=False)
+
+    def get_delays(self, programs):
+        """ Return streams' delay as timedelta by program id. """
+        return {
+            program_id: datetime.timedelta(hours=delay.hour,
+                                           minutes=delay.minute,
+                                           seconds=delay.second)
+            for program_id, delay in Stream.objects
+                .filter(program__in=programs, delay__isnull=False)
+                .values_list('program_id', 'delay')
+        }
+
+    def get_playlists(self, programs, now=None):
+        """ Return playlists of the given programs' ids by program id. """
+        now = now or tz.now()
+        delays = self.get_delays(programs)
+        sounds = {program_id: [] for program_id in programs}
+        for sound_id, program_id, path in self.get_queryset(programs) \
+                .values_list('id', 'program_id', 'path'):
+            sounds[program_id].append((self.history.get(sound_id),
+                                       hash((self.seed, sound_id)), path))
+
+        playlists = {}
+        for program_id, items in sounds.items():
+            delay = delays.get(program_id)
+            if delay:
+                # when all sounds are too recent, fall back to the oldest
+                # ones rather than playing nothing.
+                eligible = [item for item in items
+                            if item[0] is None or item[0] <= now - delay]
+                items = eligible or items
+            items.sort(key=lambda item: (item[0] is not None,
+                                         item[0] or now, item[1]))
+            playlists[program_id] = [item[2] for item in items[:self.size]]
+        return playlists
@@ -0,0 +1,86 @@
+import heapq
+import itertools
+
+from django.utils import timezone as tz
+
+
+__all__ = ['DiffusionScheduler']
+
+
+class DiffusionScheduler:
+    """
+    Keep start and cancel deadlines of a timeline's diffusions in a heap,
+    in order to know when the next one must be handled.
+
+    Deadlines are rebuilt each time the timeline is refreshed.
+    """
+    START = 'start'
+    """ Diffusion must be started """
+    CANCEL = 'cancel'
+    """ Diffusion must be canceled if not yet started """
+
+    timeline = None
+    """ DiffusionTimeline to schedule """
+    cancel_timeout = None
+    """ Timedelta after start before cancelling a diffusion """
+    heap = None
+    """ Deadlines as `(date, index, type, item)` """
+    items = None
+    """ Timeline's items for which deadlines have been built """
+
+    def __init__(self, timeline, cancel_timeout):
+        self.timeline = timeline
+        self.cancel_timeout = cancel_timeout
+        self.heap = []
+        self.counter = itertools.count()
+
+    def push(self, date, type, item):
+        """ Add a deadline. """
+        heapq.heappush(self.heap, (date, next(self.counter), type, item))
+
+    def refresh(self, now):
+        """ Refresh timeline if needed, and rebuild deadlines. """
+        if self.timeline.is_outdated(now):
+            self.timeline.refresh(now)
+        if self.items is self.timeline.items:
+            return
+
+        self.items, self.heap = self.timeline.items, []
+        for item in self.items:
+            if not item.started:
+                self.push(item.start, self.START, item)
+                # cancel happens strictly after timeout
+                self.push(item.start + self.cancel_timeout +
+                          tz.timedelta(seconds=1), self.CANCEL, item)
+
+    def is_obsolete(self, deadline):
+        item = deadline[3]
+        return item.started or item not in self.items
+
+    def next_deadline(self, now):
+        """ Return date of the next deadline, or None. """
+        self.refresh(now)
+        heap = self.heap
+        while heap and self.is_obsolete(heap[0]):
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def pop(self, now):
+        """ Remove and return deadlines reached at the given date. """
+        self.refresh(now)
+        deadlines = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline = heapq.heappop(self.heap)
+            if not self.is_obsolete(deadline):
+                deadlines.append(deadline)
+        return deadlines
+
+    def get_timeout(self, now, timeout):
+        """
+        Return time in seconds until the next deadline, at most `timeout`
+        seconds.
+        """
+        deadline = self.next_deadline(now)
+        if deadline is None:
+            return timeout
+        return max(0, min(timeout, (deadline - now).total_seconds()))
@@ -0,0 +1,76 @@
+"""
+Notify monitors of changes in the database. A version number is kept in
+the cache for each kind of data: when it changes, data kept in memory must
+be reloaded. Using a shared cache backend (e.g. memcached), this works
+across processes.
+"""
+import contextlib
+
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import signals
+from django.dispatch import receiver
+
+from aircox.models import Diffusion, Episode, Sound
+from aircox.models.signals import sounds_synced
+
+
+__all__ = ['DIFFUSIONS', 'PLAYLISTS', 'get_version', 'touch',
+           'local_versions']
+
+
+DIFFUSIONS = 'diffusions'
+""" Diffusions and their archives """
+PLAYLISTS = 'playlists'
+""" Streamed programs' playlists """
+
+
+def get_key(name):
+    return 'aircox_streamer.changes.' + name
+
+
+def get_version(name):
+    """ Return current version number of the given kind of data. """
+    return cache.get(get_key(name), 0)
+
+
+def touch(name):
+    """ Increment version of the given kind of data. """
+    key = get_key(name)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+
+
+@contextlib.contextmanager
+def local_versions():
+    """
+    Keep versions in a cache local to the process in the context, such as
+    changes are not notified to other processes (e.g. for changes that are
+    rolled back).
+    """
+    global cache
+    shared, cache = cache, LocMemCache('aircox_streamer.changes', {})
+    try:
+        yield
+    finally:
+        cache = shared
+
+
+@receiver(signals.post_save, sender=Diffusion)
+@receiver(signals.post_delete, sender=Diffusion)
+@receiver(signals.post_save, sender=Episode)
+@receiver(signals.post_delete, sender=Episode)
+@receiver(signals.post_save, sender=Sound)
+@receiver(signals.post_delete, sender=Sound)
+@receiver(sounds_synced)
+def diffusions_changed(sender, *args, **kwargs):
+    touch(DIFFUSIONS)
+
+
+@receiver(signals.post_save, sender=Sound)
+@receiver(signals.post_delete, sender=Sound)
+@receiver(sounds_synced)
+def playlists_changed(sender, *args, **kwargs):
+    touch(PLAYLISTS)
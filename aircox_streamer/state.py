@@ -0,0 +1,34 @@
+"""
+Snapshots of streamers' state (see `Streamer.dump_state`), published in
+the cache by the monitor and read by other processes (e.g. the web API),
+such as they don't need to poll liquidsoap themselves.
+"""
+from django.core.cache import cache
+
+
+__all__ = ['get_key', 'publish', 'load']
+
+
+TIMEOUT = 60
+""" Snapshots expire after this time in seconds """
+
+
+def get_key(station_id):
+    return 'aircox_streamer.state.{}'.format(station_id)
+
+
+def publish(streamer, timeout=TIMEOUT):
+    """ Publish streamer's state snapshot. """
+    cache.set(get_key(streamer.station.pk), streamer.dump_state(), timeout)
+
+
+def load(streamer):
+    """
+    Update streamer from its last snapshot. Return False if there is no
+    snapshot.
+    """
+    state = cache.get(get_key(streamer.station.pk))
+    if state is None:
+        return False
+    streamer.load_state(state)
+    return True
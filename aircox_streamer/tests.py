@@ -1,3 +1,975 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import queue
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone as tz
+
+from .connector import Connector, AsyncConnector, ConnectorTimeout, \
+    ResponseReader
+from aircox.models import Diffusion, Episode, Log, Program, Sound, Station, \
+    Stream
+
+from . import metrics, signals, state
+from .controllers import AsyncStreamer, Request, Source, Streamer
+from .events import Event, EventEmitter, EventListener
+from .fake_liquidsoap import FakeLiquidsoap
+from .log_writer import LogWriter
+from .management.commands.streamer_simulate import Command
+from .monitor import AsyncMonitor, Monitor, OnAirState
+from .preroll import Preroll
+from .rotation import Rotation
+from .scheduler import DiffusionScheduler
+from .timeline import DiffusionTimeline, TimelineGroup
+from .workers import Supervisor
+
+
+def create_diffusion(program, start, duration=None, archives=1):
+    """ Create a diffusion with its episode and archive sounds. """
+    end = start + (duration or tz.timedelta(hours=1))
+    episode = Episode.objects.create(title='{} {}'.format(program, start),
+                                     parent=program)
+    diffusion = Diffusion.objects.create(episode=episode, start=start,
+                                         end=end)
+    for i in range(archives):
+        Sound(program=program, episode=episode, type=Sound.TYPE_ARCHIVE,
+              path=os.path.join(program.archives_path,
+                                '{}_{}.ogg'.format(diffusion.pk, i))) \
+            .save(check=False)
+    return diffusion
+
+
+class EchoHandler(socketserver.StreamRequestHandler):
+    """ Answer each command line with its text, in liquidsoap's format. """
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode('utf-8').strip()
+            self.wfile.write(bytes(line + '\r\nEND\r\n', encoding='utf-8'))
+
+
+class SilentHandler(socketserver.StreamRequestHandler):
+    """ Read commands and never answer, and record them. """
+    commands = []
+
+    def handle(self):
+        for line in self.rfile:
+            self.commands.append(line.decode('utf-8').strip())
+
+
+class MetadataHandler(socketserver.StreamRequestHandler):
+    """ Answer `request.metadata` commands, and record them. """
+    commands = []
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode('utf-8').strip()
+            self.commands.append(line)
+            rid = line.split(' ')[-1]
+            self.wfile.write(bytes(
+                'initial_uri="/tmp/{}.ogg"\nstatus="ready"\r\nEND\r\n'
+                .format(rid), encoding='utf-8'))
+
+
+class ResponseReaderCheck(SimpleTestCase):
+    def test_feed(self):
+        data = 'un été\r\nEND\r\n\r\nEND\r\nrid=1\nENDING\nEND\n' \
+               .encode('utf-8')
+        reader, responses = ResponseReader(), []
+        # split in every possible way, including inside utf-8 sequences
+        for i in range(len(data)):
+            responses += reader.feed(data[i:i+1])
+        self.assertEqual(responses, ['un été', '', 'rid=1\nENDING'])
+        self.assertEqual(len(reader.buffer), 0)
+
+
+class ConnectorCheck(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.dir.name, 'test.sock')
+        self.server = socketserver.ThreadingUnixStreamServer(path, EchoHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True) \
+                 .start()
+        self.connector = Connector(path)
+
+    def tearDown(self):
+        self.connector.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+    def test_send(self):
+        self.assertEqual(self.connector.send('dealer', '.get'), 'dealer.get')
+
+    def test_send_batch(self):
+        commands = [('source_{}'.format(i), '.remaining') for i in range(50)]
+        responses = self.connector.send_batch(commands)
+        self.assertEqual(responses, [''.join(c) for c in commands])
+        self.assertEqual(self.connector.send_batch([]), [])
+
+    def test_async_send_batch(self):
+        async def run():
+            connector = AsyncConnector(self.connector.address)
+            responses = await asyncio.gather(*(
+                connector.send('source_{}'.format(i), '.get')
+                for i in range(10)
+            ))
+            batch = await connector.send_batch(['list', 'dealer.remaining'])
+            await connector.close()
+            return responses, batch
+
+        responses, batch = asyncio.run(run())
+        self.assertEqual(responses,
+                         ['source_{}.get'.format(i) for i in range(10)])
+        self.assertEqual(batch, ['list', 'dealer.remaining'])
+
+    def test_send_timeout(self):
+        path = os.path.join(self.dir.name, 'silent.sock')
+        server = socketserver.ThreadingUnixStreamServer(path, SilentHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            connector = Connector(path, timeout=0.1)
+            with self.assertRaises(ConnectorTimeout):
+                connector.send('list', try_count=0, raise_error=True)
+            self.assertIsNone(connector.send('list', try_count=0))
+            self.assertFalse(connector.is_open)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class QueueSourceCheck(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        station = Station.objects.create(name='Station', slug='station',
+                                         path=self.dir.name)
+        self.streamer = Streamer(station)
+        self.server = socketserver.ThreadingUnixStreamServer(
+            self.streamer.socket_path, MetadataHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True) \
+                 .start()
+        MetadataHandler.commands = []
+
+    def tearDown(self):
+        self.streamer.connector.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+    def test_requests(self):
+        dealer = self.streamer.dealer
+        dealer.queue = ['1', '2']
+        self.assertEqual([r.uri for r in dealer.requests],
+                         ['/tmp/1.ogg', '/tmp/2.ogg'])
+
+        # only new rids are fetched, and removed ones are dropped
+        dealer.queue = ['2', '3']
+        self.assertEqual([r.uri for r in dealer.requests],
+                         ['/tmp/2.ogg', '/tmp/3.ogg'])
+        self.assertEqual(MetadataHandler.commands,
+                         ['request.metadata 1', 'request.metadata 2',
+                          'request.metadata 3'])
+        self.assertEqual(list(dealer.request_cache), ['2', '3'])
+
+    def test_control_commands(self):
+        # commands that may have been run are not sent again on timeout
+        path = os.path.join(self.dir.name, 'silent.sock')
+        server = socketserver.ThreadingUnixStreamServer(path, SilentHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.streamer.connector = Connector(path, timeout=0.1)
+        SilentHandler.commands = []
+        try:
+            self.streamer.dealer.push('/tmp/0.ogg')
+            self.streamer.dealer.skip()
+            self.assertEqual(SilentHandler.commands,
+                             ['dealer_queue.push /tmp/0.ogg', 'dealer.skip'])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class PlaylistSourceCheck(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        station = Station.objects.create(name='Station', slug='station',
+                                         path=self.dir.name)
+        self.programs = []
+        for i in range(2):
+            program = Program.objects.create(title='Program {}'.format(i),
+                                             station=station)
+            Stream.objects.create(program=program)
+            for j in range(2):
+                Sound(program=program, type=Sound.TYPE_ARCHIVE,
+                      path='/tmp/{}_{}.ogg'.format(i, j)).save(check=False)
+            self.programs.append(program)
+        self.streamer = Streamer(station)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_sync_playlists(self):
+        with self.assertNumQueries(1):
+            updated = self.streamer.sync_playlists()
+        self.assertEqual(len(updated), 2)
+        source = updated[0]
+        with open(source.path) as file:
+            self.assertEqual(file.read(), '\n'.join(source.get_playlist()))
+
+        # unchanged playlists are not written again
+        self.assertEqual(self.streamer.sync_playlists(), [])
+        source.playlist_hash = None
+        self.assertFalse(source.sync())
+        self.assertTrue(source.sync(['/tmp/other.ogg']))
+        # no temporary file left
+        self.assertEqual(sorted(os.listdir(self.dir.name)),
+                         sorted(os.path.basename(s.path) for s in updated))
+
+
+class RotationCheck(TestCase):
+    def setUp(self):
+        self.station = Station.objects.create(name='Station', slug='station')
+        self.program = Program.objects.create(title='Program',
+                                              station=self.station)
+        Stream.objects.create(program=self.program,
+                              delay=tz.datetime(2000, 1, 1, 1).time())
+        self.sounds = []
+        for i, quality in enumerate((None, True, True, False)):
+            sound = Sound(program=self.program, type=Sound.TYPE_ARCHIVE,
+                          path='/tmp/{}.ogg'.format(i),
+                          is_good_quality=quality)
+            sound.save(check=False)
+            self.sounds.append(sound)
+
+        self.now = tz.now()
+        for sound, delta in ((self.sounds[0], 10), (self.sounds[1], 120),
+                             (self.sounds[1], 240)):
+            Log.objects.create(station=self.station, type=Log.TYPE_ON_AIR,
+                               sound=sound, comment=sound.path,
+                               date=self.now - tz.timedelta(minutes=delta))
+
+    def test_get_playlists(self):
+        rotation = Rotation(self.station, size=5)
+        with self.assertNumQueries(3):
+            playlists = rotation.get_playlists([self.program.pk], self.now)
+        self.assertEqual(playlists, {self.program.pk: [
+            self.sounds[2].path, self.sounds[1].path]})
+        self.assertEqual(rotation.history.get(self.sounds[1].pk),
+                         self.now - tz.timedelta(minutes=120))
+
+        rotation.history.add(self.sounds[2].pk, self.now)
+        playlists = rotation.get_playlists([self.program.pk], self.now)
+        self.assertEqual(playlists[self.program.pk], [self.sounds[1].path])
+
+    @mock.patch('aircox.settings.AIRCOX_STREAMER_ROTATION', True)
+    def test_streamer(self):
+        with tempfile.TemporaryDirectory() as path:
+            self.station.path = path
+            streamer = Streamer(self.station)
+            self.assertIsNone(streamer.rotation)
+            streamer.make_config()
+            with open(streamer.path) as file:
+                config = file.read()
+            # rotated streams are played in order, still spaced by delay
+            self.assertIn('mode = "normal"', config)
+            self.assertIn('delay(', config)
+
+            Monitor(streamer, tz.timedelta(seconds=1),
+                    tz.timedelta(minutes=20))
+            self.assertIsInstance(streamer.rotation, Rotation)
+
+
+class OnAirStateCheck(SimpleTestCase):
+    def test_is_playing(self):
+        now, delay = tz.now(), tz.timedelta(seconds=6)
+        source = Source(id='dealer')
+        source.rid, source.uri, source.remaining = 1, '/tmp/a.ogg', 60.0
+
+        state = OnAirState()
+        self.assertFalse(state.is_playing(source, now))
+        state.update(source, None, None, now, delay)
+        self.assertTrue(state.is_playing(source, now))
+        self.assertFalse(state.is_playing(source, now + tz.timedelta(
+            seconds=55)))
+
+        source.rid = 2
+        self.assertFalse(state.is_playing(source, now))
+
+
+class DiffusionTimelineCheck(TestCase):
+    def setUp(self):
+        self.station = Station.objects.create(name='Station', slug='station')
+        self.program = Program.objects.create(title='Program',
+                                              station=self.station)
+        self.now = tz.now()
+        self.diffs = [create_diffusion(self.program, self.now + delta)
+                      for delta in (tz.timedelta(minutes=-30),
+                                    tz.timedelta(minutes=30))]
+        self.timeline = DiffusionTimeline(self.station,
+                                          timeout=tz.timedelta(hours=1))
+
+    def test_get(self):
+        item = self.timeline.get(self.now)
+        self.assertEqual(item.diffusion, self.diffs[0])
+        self.assertEqual(item.playlist,
+                         list(Sound.objects.episode(id=item.diffusion.episode_id)
+                                           .paths()))
+        self.assertFalse(item.started)
+
+        with self.assertNumQueries(0):
+            item = self.timeline.get(self.now + tz.timedelta(minutes=45))
+        self.assertEqual(item.diffusion, self.diffs[1])
+        self.assertIsNone(self.timeline.get(self.now + tz.timedelta(hours=2)))
+
+    def test_refresh_on_change(self):
+        self.timeline.get(self.now)
+        self.diffs[0].type = Diffusion.TYPE_CANCEL
+        self.diffs[0].save()
+        self.assertTrue(self.timeline.is_outdated(self.now))
+        self.assertIsNone(self.timeline.get(self.now))
+
+
+class TimelineGroupCheck(TestCase):
+    def setUp(self):
+        self.now = tz.now()
+        self.stations = []
+        for i in range(3):
+            station = Station.objects.create(name='Station {}'.format(i),
+                                             slug='station-{}'.format(i))
+            program = Program.objects.create(title='Program {}'.format(i),
+                                             station=station)
+            create_diffusion(program, self.now, archives=2)
+            self.stations.append(station)
+
+    def refresh(self, stations):
+        group = TimelineGroup()
+        timelines = [group.get_timeline(station) for station in stations]
+        with self.assertNumQueries(3):
+            group.refresh(self.now)
+        return timelines
+
+    def test_refresh(self):
+        self.refresh(self.stations[:1])
+        timelines = self.refresh(self.stations)
+        for station, timeline in zip(self.stations, timelines):
+            item = timeline.get(self.now)
+            self.assertEqual(item.diffusion.program.station, station)
+            self.assertEqual(len(item.playlist), 2)
+            self.assertEqual(item.playlist, DiffusionTimeline(station)
+                             .get(self.now).playlist)
+
+
+class DiffusionSchedulerCheck(TestCase):
+    setUp = DiffusionTimelineCheck.setUp
+
+    def test_deadlines(self):
+        scheduler = DiffusionScheduler(self.timeline, tz.timedelta(hours=1))
+        self.assertEqual(scheduler.next_deadline(self.now),
+                         self.diffs[0].start)
+        self.assertEqual(scheduler.get_timeout(self.now, 60), 0)
+
+        deadlines = scheduler.pop(self.now)
+        self.assertEqual([(d[2], d[3].diffusion) for d in deadlines],
+                         [(scheduler.START, self.diffs[0])])
+        # next deadline is diffs[1] start, before diffs[0] cancel
+        self.assertEqual(scheduler.next_deadline(self.now),
+                         self.diffs[1].start)
+        self.assertEqual(scheduler.get_timeout(self.now, 60), 60)
+
+        # started diffusions' deadlines are dropped
+        self.timeline.items[1].started = True
+        self.assertEqual(scheduler.next_deadline(self.now),
+                         self.diffs[0].start + tz.timedelta(hours=1,
+                                                            seconds=1))
+
+    def test_async_monitor(self):
+        monitor = AsyncMonitor(Streamer(self.station),
+                               tz.timedelta(seconds=1),
+                               tz.timedelta(minutes=20), scheduled=True)
+        self.addCleanup(monitor.executor.shutdown)
+        self.assertEqual(monitor.get_timeout(60), 60)
+        monitor.run_pass(lambda: monitor.scheduler.pop(tz.now()))
+
+        # timeout is computed by the pass, without using the scheduler
+        monitor.scheduler = None
+        self.assertAlmostEqual(monitor.get_timeout(3600), 1800, delta=10)
+
+
+class PrerollCheck(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.station = Station.objects.create(name='Station', slug='station',
+                                              path=self.dir.name)
+        self.program = Program.objects.create(title='Program',
+                                              station=self.station)
+        self.now = tz.now()
+        self.diffs = [create_diffusion(self.program, self.now + delta,
+                                       archives=2)
+                      for delta in (tz.timedelta(minutes=5),
+                                    tz.timedelta(minutes=30))]
+        for sound in Sound.objects.all():
+            sound.path = os.path.join(self.dir.name,
+                                      os.path.basename(sound.path))
+            sound.save(check=False)
+        self.timeline = DiffusionTimeline(self.station)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_check(self):
+        item = self.timeline.get(self.now + tz.timedelta(minutes=5))
+        with open(item.playlist[0], 'wb') as file:
+            file.write(b'sound')
+
+        preroll = Preroll(self.timeline, tz.timedelta(minutes=10))
+        preroll.check(self.now)
+        preroll.check(self.now)
+        preroll.executor.shutdown(wait=True)
+
+        self.assertEqual(preroll.warmed, {self.diffs[0].pk})
+        self.assertEqual([path for path, _ in preroll.errors[self.diffs[0].pk]],
+                         item.playlist[1:])
+
+
+class LogWriterCheck(TestCase):
+    def setUp(self):
+        self.station = Station.objects.create(name='Station', slug='station')
+
+    def test_write(self):
+        writer = LogWriter(size=3, interval=60)
+        logs = [Log(station=self.station, type=Log.TYPE_ON_AIR,
+                    comment=str(i)) for i in range(4)]
+        with CaptureQueriesContext(connection) as queries:
+            for log in logs:
+                writer.write(log)
+        self.assertEqual(len([q for q in queries.captured_queries
+                              if q['sql'].startswith('INSERT')]), 1)
+        self.assertEqual(writer.pending(self.station), logs[3:])
+        self.assertEqual(Log.objects.count(), 3)
+
+        writer.check()
+        self.assertEqual(Log.objects.count(), 3)
+        writer.flush()
+        self.assertEqual(writer.pending(), [])
+        self.assertEqual(Log.objects.count(), 4)
+
+    def test_flush_invalid(self):
+        # an invalid log does not block the other ones
+        writer = LogWriter(size=3, interval=60)
+        logs = [Log(station=self.station, type=Log.TYPE_ON_AIR,
+                    comment=str(i)) for i in range(3)]
+        logs[1].type = None
+        with self.assertLogs('aircox', 'ERROR'):
+            for log in logs:
+                writer.write(log)
+        self.assertEqual(writer.pending(), [])
+        self.assertEqual(sorted(Log.objects.values_list('comment', flat=True)),
+                         ['0', '2'])
+
+
+class StateCheck(TestCase):
+    def test_publish(self):
+        station = Station.objects.create(name='Station', slug='station')
+        streamer = Streamer(station)
+        cache.delete(state.get_key(station.pk))
+        self.assertFalse(state.load(streamer))
+
+        dealer = streamer.dealer
+        dealer.rid, dealer.uri, dealer.remaining = 1, '/tmp/a.ogg', 12.0
+        dealer.air_time, dealer.queue = tz.now(), ['2']
+        dealer.request_cache = {'2': Request(streamer, '2')}
+        dealer.request_cache['2'].title = 'title'
+        streamer.source = dealer
+        state.publish(streamer)
+
+        streamer = Streamer(station)
+        self.assertTrue(state.load(streamer))
+        self.assertEqual(streamer.source, streamer.dealer)
+        self.assertEqual(
+            (streamer.dealer.rid, streamer.dealer.uri,
+             streamer.dealer.remaining, streamer.dealer.air_time,
+             streamer.dealer.queue),
+            (dealer.rid, dealer.uri, dealer.remaining, dealer.air_time,
+             dealer.queue))
+        self.assertEqual([(r.rid, r.title) for r in streamer.dealer.requests],
+                         [('2', 'title')])
+
+
+class MetricsCheck(SimpleTestCase):
+    def test_histogram(self):
+        histogram = metrics.Histogram('test', 'Test', labels=('station',),
+                                      buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value, station=1)
+        self.assertEqual(histogram.get(station=1), (14.5, 4))
+        self.assertEqual(histogram.render_value(('1',),
+                                                histogram.values[('1',)]), [
+            'test_bucket{station="1",le="1"} 2',
+            'test_bucket{station="1",le="5"} 3',
+            'test_bucket{station="1",le="+Inf"} 4',
+            'test_sum{station="1"} 14.5',
+            'test_count{station="1"} 4',
+        ])
+
+    def test_dump(self):
+        registry = metrics.Registry()
+        registry.counter('test_total', 'Test').inc(2, station=1)
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'metrics.prom')
+            registry.dump(path)
+            with open(path) as file:
+                self.assertEqual(file.read(), registry.render())
+            self.assertEqual(os.listdir(dir), ['metrics.prom'])
+
+
+class SupervisorCheck(SimpleTestCase):
+    def test_schedule_restart(self):
+        supervisor = Supervisor([1, 2], cpus=[0])
+        worker = supervisor.workers[1]
+        self.assertEqual(worker.cpus, {0})
+
+        worker.started = 0
+        for backoff in (1, 2, 4):
+            supervisor.schedule_restart(worker, 10, 'exited')
+            self.assertEqual((worker.backoff, worker.next_start),
+                             (backoff, 10 + backoff))
+        supervisor.schedule_restart(worker, 100, 'exited')
+        self.assertEqual(worker.backoff, supervisor.backoff)
+        self.assertEqual(worker.restarts, 4)
+
+    def test_check_exited(self):
+        supervisor = Supervisor([1])
+        worker = supervisor.workers[1]
+        worker.started = time.monotonic()
+        worker.process = mock.Mock(exitcode=1, **{'is_alive.return_value':
+                                                  False})
+        with mock.patch.object(supervisor, 'start') as start:
+            supervisor.check()
+            start.assert_not_called()
+            self.assertEqual((worker.process, worker.restarts), (None, 1))
+
+            # restarted once backoff is elapsed
+            worker.next_start = time.monotonic()
+            supervisor.check()
+            start.assert_called_once_with(worker)
+
+    def test_check_health_timeout(self):
+        supervisor = Supervisor([1])
+        supervisor.reports = queue.Queue()
+        worker = supervisor.workers[1]
+        worker.process = mock.Mock(**{'is_alive.return_value': True})
+        worker.started = time.monotonic()
+        worker.last_report = worker.started - supervisor.health_timeout - 1
+
+        # reporting worker is kept
+        supervisor.reports.put({'station': 1, 'pid': 0})
+        with mock.patch.object(supervisor, 'stop') as stop:
+            supervisor.check()
+            stop.assert_not_called()
+
+        worker.last_report -= supervisor.health_timeout + 1
+        process = worker.process
+        with mock.patch.object(supervisor, 'start') as start:
+            supervisor.check()
+        process.terminate.assert_called_once_with()
+        self.assertEqual((worker.process, worker.restarts), (None, 1))
+        start.assert_not_called()
+
+    def test_stop(self):
+        # liquidsoap is killed when the worker is terminated
+        dir = tempfile.TemporaryDirectory()
+        self.addCleanup(dir.cleanup)
+        pid_path = os.path.join(dir.name, 'pid')
+
+        class FakeStreamer:
+            def __init__(self, station):
+                pass
+
+            def run_process(self):
+                self.process = subprocess.Popen(['sleep', '60'])
+                with open(pid_path, 'w') as file:
+                    file.write(str(self.process.pid))
+
+            def wait_process(self):
+                self.process.wait()
+
+            def kill_process(self):
+                self.process.kill()
+                self.process.wait()
+
+        supervisor = Supervisor([1], run=True, monitor=False)
+        worker = supervisor.workers[1]
+        with mock.patch('aircox_streamer.workers.Streamer', FakeStreamer), \
+                mock.patch('aircox_streamer.workers.Station'):
+            supervisor.start(worker)
+            process = worker.process
+            for i in range(100):
+                if os.path.exists(pid_path):
+                    break
+                time.sleep(0.05)
+            with open(pid_path) as file:
+                pid = int(file.read())
+            supervisor.stop(worker)
+
+        self.assertEqual(process.exitcode, 128 + 15)
+        with self.assertRaises(ProcessLookupError):
+            os.kill(pid, 0)
+
+
+class EventsCheck(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.station = Station.objects.create(name='Station', slug='station',
+                                              path=self.dir.name)
+        self.program = Program.objects.create(title='Program',
+                                              station=self.station)
+        self.sound = Sound(program=self.program, type=Sound.TYPE_ARCHIVE,
+                           path=os.path.join(self.program.archives_path,
+                                             'sound.ogg'))
+        self.sound.save(check=False)
+
+        self.streamer = Streamer(self.station)
+        self.emitter = EventEmitter(self.streamer.events_path)
+        self.listener = EventListener(self.streamer.events_path)
+
+    def tearDown(self):
+        self.listener.close()
+        self.dir.cleanup()
+
+    def test_listener(self):
+        # no listener: event is dropped without blocking
+        self.emitter.emit(Event.TYPE_TRACK, 'dealer', rid='0')
+        self.assertEqual(self.listener.read(), [])
+
+        self.assertEqual(self.listener.wait(0), [])
+        for i in range(3):
+            self.emitter.emit(Event.TYPE_TRACK, 'dealer', rid=str(i))
+        self.assertEqual(self.listener.wait(0), [self.listener])
+        events = self.listener.read()
+        self.assertEqual([e.metadata['rid'] for e in events], ['0', '1', '2'])
+        self.assertEqual(self.listener.read(), [])
+
+    def test_monitor(self):
+        monitor = Monitor(self.streamer, tz.timedelta(seconds=1),
+                          tz.timedelta(minutes=20), events=self.listener,
+                          reconcile_next=tz.now() + tz.timedelta(hours=1))
+        self.listener.open()
+        self.emitter.emit(Event.TYPE_TRACK, 'dealer', rid='1',
+                          status='playing', initial_uri=self.sound.path,
+                          on_air=tz.now().strftime('%Y/%m/%d %H:%M:%S'))
+        monitor.monitor()
+
+        log = Log.objects.get()
+        self.assertEqual((log.type, log.source, log.sound),
+                         (Log.TYPE_ON_AIR, 'dealer', self.sound))
+        self.assertEqual(self.streamer.source, self.streamer.dealer)
+
+    def test_make_config(self):
+        # events are only sent by liquidsoap when enabled
+        self.streamer.make_config()
+        with open(self.streamer.path) as file:
+            self.assertNotIn('emit_track', file.read())
+        self.assertFalse(os.path.exists(self.streamer.events_path))
+
+        self.streamer.events = True
+        self.streamer.make_config()
+        with open(self.streamer.path) as file:
+            self.assertIn('emit_track', file.read())
+        self.assertTrue(os.path.exists(self.streamer.events_path))
+
+
+class FakeLiquidsoapCheck(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.station = Station.objects.create(name='Station', slug='station',
+                                              path=self.dir.name)
+        program = Program.objects.create(title='Program',
+                                         station=self.station)
+        Stream.objects.create(program=program)
+        self.sounds = []
+        for i in range(2):
+            sound = Sound(program=program, type=Sound.TYPE_ARCHIVE,
+                          path='/tmp/{}.ogg'.format(i))
+            sound.save(check=False)
+            self.sounds.append(sound)
+
+        self.streamer = Streamer(self.station)
+        self.server = FakeLiquidsoap(self.streamer.socket_path, {
+            'dealer': None, 'program': [s.path for s in self.sounds],
+        })
+        self.server.start()
+
+    def tearDown(self):
+        self.streamer.connector.close()
+        self.server.stop()
+        self.dir.cleanup()
+
+    def test_monitor(self):
+        monitor = Monitor(self.streamer, tz.timedelta(seconds=1),
+                          tz.timedelta(minutes=20))
+        monitor.monitor()
+        self.assertEqual(self.streamer.source.id, 'program')
+        self.assertAlmostEqual(self.streamer.source.remaining, 60, delta=1)
+
+        self.streamer.source.skip()
+        monitor.monitor()
+        self.assertEqual(
+            [log.sound for log in Log.objects.on_air().order_by('pk')],
+            self.sounds)
+
+        # idle dealer plays pushed sounds right away
+        self.streamer.dealer.push('/tmp/pushed.ogg')
+        self.streamer.fetch()
+        self.assertEqual(self.streamer.dealer.uri, '/tmp/pushed.ogg')
+
+    def test_trace_sound_cached(self):
+        monitor = Monitor(self.streamer, tz.timedelta(seconds=1),
+                          tz.timedelta(minutes=20))
+        monitor.monitor()
+        log = Log.objects.on_air().get()
+        # on air log is known: no query
+        with self.assertNumQueries(0):
+            self.assertEqual(monitor.trace_sound(self.streamer.source), log)
+
+        # including when it is loaded from the database (restart)
+        monitor = Monitor(self.streamer, tz.timedelta(seconds=1),
+                          tz.timedelta(minutes=20))
+        with self.assertNumQueries(0):
+            self.assertEqual(monitor.trace_sound(self.streamer.source), log)
+
+    def test_adaptive(self):
+        monitor = Monitor(self.streamer, tz.timedelta(seconds=1),
+                          tz.timedelta(minutes=20), adaptive=True)
+        monitor.monitor()
+        rid = self.streamer.source.rid
+        # same sound still playing: tracing is skipped
+        with self.assertNumQueries(0):
+            for i in range(3):
+                monitor.monitor()
+        self.assertEqual(self.streamer.source.rid, rid)
+        self.assertEqual((monitor.on_air.ticks, monitor.on_air.skipped),
+                         (4, 3))
+
+        # traced once deadline is reached
+        monitor.on_air.deadline = tz.now()
+        with CaptureQueriesContext(connection) as queries:
+            monitor.monitor()
+        self.assertTrue(queries.captured_queries)
+        self.assertEqual((monitor.on_air.ticks, monitor.on_air.skipped),
+                         (5, 3))
+
+        # traced on rid change
+        self.streamer.source.skip()
+        monitor.monitor()
+        self.assertNotEqual(self.streamer.source.rid, rid)
+        self.assertEqual((monitor.on_air.ticks, monitor.on_air.skipped),
+                         (6, 3))
+        self.assertEqual(Log.objects.on_air().count(), 2)
+
+    def test_async_monitor_timeout(self):
+        streamer = AsyncStreamer(self.station)
+        monitor = AsyncMonitor(streamer, tz.timedelta(seconds=1),
+                               tz.timedelta(minutes=20))
+        self.addCleanup(monitor.executor.shutdown)
+        release, passes = threading.Event(), []
+
+        def process():
+            passes.append(streamer.source)
+            release.wait(5)
+        monitor.process = process
+
+        async def run():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(monitor.monitor(), 0.5)
+            # timed out pass is still running: next one is skipped
+            self.assertTrue(monitor.is_busy)
+            await monitor.monitor()
+            await streamer.async_connector.close()
+        asyncio.run(run())
+        release.set()
+        monitor.pending.result(5)
+        self.assertFalse(monitor.is_busy)
+        self.assertEqual(len(passes), 1)
+
+    def test_async_monitor_is_ready(self):
+        monitor = AsyncMonitor(AsyncStreamer(self.station),
+                               tz.timedelta(seconds=1),
+                               tz.timedelta(minutes=20))
+        self.addCleanup(monitor.executor.shutdown)
+        threads = []
+
+        def is_ready():
+            threads.append(threading.current_thread())
+            return False
+
+        async def run():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    monitor.run(tz.timedelta(seconds=1), is_ready), 0.5)
+        asyncio.run(run())
+        # blocking check is not run in the event loop's thread
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_metrics(self):
+        pk = self.station.pk
+        ticks = metrics.TICK_TIME.get(station=pk)[1]
+        logs = metrics.LOGS.get(station=pk, type='on_air')
+        monitor = Monitor(self.streamer, tz.timedelta(seconds=1),
+                          tz.timedelta(minutes=20))
+        monitor.monitor()
+        self.assertEqual(metrics.TICK_TIME.get(station=pk)[1], ticks + 1)
+        self.assertEqual(metrics.LOGS.get(station=pk, type='on_air'),
+                         logs + 1)
+        self.assertGreater(metrics.SOCKET_TIME.get(station=pk)[1], 0)
+
+        cache.delete(metrics.get_key(pk))
+        metrics.publish(pk)
+        text = metrics.load([pk]).render()
+        self.assertIn('aircox_streamer_logs_total{{station="{}",'
+                      'type="on_air"}} {}'.format(pk, logs + 1), text)
+        self.assertIn('aircox_streamer_tick_seconds_count{{station="{}"}} {}'
+                      .format(pk, ticks + 1), text)
+
+
+class ProcessCheck(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.station = Station.objects.create(name='Station', slug='station',
+                                              path=self.dir.name)
+        self.streamer = Streamer(self.station)
+
+    def tearDown(self):
+        self.streamer.kill_process()
+        self.streamer.connector.close()
+        self.dir.cleanup()
+
+    def test_check_zombie_process(self):
+        script = 'import socket, time\n' \
+                 's = socket.socket(socket.AF_UNIX)\n' \
+                 's.bind({!r})\n' \
+                 's.listen()\n' \
+                 'print(flush=True)\n' \
+                 'time.sleep(60)'.format(self.streamer.socket_path)
+        process = subprocess.Popen([sys.executable, '-c', script],
+                                   stdout=subprocess.PIPE)
+        process.stdout.readline()
+        with open(self.streamer.pid_path, 'w') as file:
+            file.write(str(process.pid))
+
+        self.assertEqual(
+            self.streamer.get_socket_pids(self.streamer.get_socket_inodes()),
+            [process.pid])
+        self.streamer.check_zombie_process()
+        self.assertEqual(process.wait(5), -9)
+        self.assertFalse(os.path.exists(self.streamer.pid_path))
+
+    def test_supervise_process(self):
+        self.streamer.get_process_args = lambda: ['sleep', '60']
+        self.streamer.run_process()
+        self.assertFalse(self.streamer.supervise_process())
+
+        server = FakeLiquidsoap(self.streamer.socket_path, {'dealer': None})
+        server.start()
+        self.assertTrue(self.streamer.supervise_process())
+        recoveries = metrics.RECOVERY_TIME.get(station=self.station.pk)[1]
+
+        # restart after exit, with backoff
+        self.streamer.process.kill()
+        self.streamer.process.wait()
+        server.stop()
+        self.streamer.connector.close()
+        self.assertFalse(self.streamer.supervise_process())
+        self.assertEqual(self.streamer.backoff, self.streamer.restart_backoff)
+        self.streamer.restart_next = 0
+        with mock.patch('atexit.register') as register:
+            self.assertFalse(self.streamer.supervise_process())
+        self.assertTrue(self.streamer.is_running)
+        # kill at exit is only registered once
+        register.assert_not_called()
+
+        server.start()
+        try:
+            self.assertTrue(self.streamer.supervise_process())
+            self.assertEqual(
+                metrics.RECOVERY_TIME.get(station=self.station.pk)[1],
+                recoveries + 1)
+        finally:
+            server.stop()
+
+
+class SimulateCheck(TestCase):
+    def test_simulate(self):
+        station = Station.objects.create(name='Station', slug='station')
+        program = Program.objects.create(title='Program', station=station)
+        create_diffusion(program, tz.now() + tz.timedelta(hours=1))
+
+        out = io.StringIO()
+        call_command('streamer_simulate', 'Station', days=1, delay=60,
+                     stdout=out)
+        self.assertIn('started diffusions: 1,', out.getvalue())
+        self.assertIn('logs start: 1', out.getvalue())
+        # simulation is rolled back
+        self.assertFalse(Log.objects.exists())
+
+    def test_simulate_scheduled(self):
+        station = Station.objects.create(name='Station', slug='station')
+        program = Program.objects.create(title='Program', station=station)
+        start = tz.now().replace(microsecond=0) + tz.timedelta(hours=1)
+        # second diffusion is started once the first one ends
+        create_diffusion(program, start)
+        create_diffusion(program, start + tz.timedelta(minutes=30))
+
+        lateness = []
+        for scheduled in (False, True):
+            with transaction.atomic():
+                stats = Command().simulate(
+                    station, start - tz.timedelta(minutes=10),
+                    start + tz.timedelta(hours=3), 60, 60, 240,
+                    scheduled=scheduled)
+                transaction.set_rollback(True)
+            lateness.append(sorted(stats['lateness']))
+        self.assertEqual(len(lateness[1]), 2)
+        self.assertEqual(lateness[0], lateness[1])
+
+    def test_simulate_changes(self):
+        station = Station.objects.create(name='Station', slug='station')
+        program = Program.objects.create(title='Program', station=station)
+        # second diffusion is canceled, as the first one is still playing
+        create_diffusion(program, tz.now() + tz.timedelta(hours=1))
+        create_diffusion(program, tz.now() + tz.timedelta(minutes=70))
+        version = signals.get_version(signals.DIFFUSIONS)
+
+        out = io.StringIO()
+        call_command('streamer_simulate', 'Station', days=1, delay=60,
+                     stdout=out)
+        self.assertIn('canceled diffusions: 1', out.getvalue())
+        # running monitors are not notified of rolled back changes
+        self.assertEqual(signals.get_version(signals.DIFFUSIONS), version)
+
+    def test_bench(self):
+        versions = [signals.get_version(name)
+                    for name in (signals.DIFFUSIONS, signals.PLAYLISTS)]
+        out = io.StringIO()
+        call_command('streamer_bench', stations=[1], ticks=2, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1].split()[0], '1')
+        self.assertFalse(Station.objects.exists())
+        self.assertEqual([signals.get_version(name)
+                          for name in (signals.DIFFUSIONS, signals.PLAYLISTS)],
+                         versions)
@@ -0,0 +1,241 @@
+from bisect import bisect_right
+import threading
+
+from django.db.models import F
+from django.utils import timezone as tz
+
+from aircox.models import Diffusion, Log, Sound
+
+from . import signals
+
+
+__all__ = ['TimelineItem', 'DiffusionTimeline', 'TimelineGroup']
+
+
+class TimelineItem:
+    """ A diffusion of the timeline. """
+    diffusion = None
+    """ The diffusion """
+    playlist = None
+    """ Archives paths of the diffusion """
+    started = False
+    """ Diffusion has already been started (there is a start log) """
+
+    def __init__(self, diffusion, playlist, started=False):
+        self.diffusion = diffusion
+        self.playlist = playlist
+        self.started = started
+
+    @property
+    def start(self):
+        return self.diffusion.start
+
+    @property
+    def end(self):
+        return self.diffusion.end
+
+
+class DiffusionTimeline:
+    """
+    In-memory timeline of the on air diffusions of a station that have
+    archives, sorted by start. Playlists and start status are loaded
+    altogether, such as getting what should be playing now does not query
+    the database.
+
+    Timeline is reloaded after `timeout` or when diffusions, episodes or
+    sounds change (see `aircox_streamer.signals`).
+    """
+    station = None
+    """ Related station """
+    duration = tz.timedelta(hours=6)
+    """ Timespan of loaded diffusions, starting from now """
+    timeout = tz.timedelta(minutes=5)
+    """ Max delay before reloading the timeline """
+    items = None
+    """ Timeline items sorted by start """
+    starts = None
+    """ Items' start, used for bisection """
+    next_refresh = None
+    """ Datetime of the next refresh """
+    version = None
+    """ Version of the data at last refresh """
+    log_writer = None
+    """ LogWriter whose start logs are taken in account """
+
+    group = None
+    """ TimelineGroup loading this timeline, if any """
+
+    def __init__(self, station, duration=None, timeout=None,
+                 log_writer=None, group=None):
+        self.station = station
+        self.log_writer = log_writer
+        self.group = group
+        if duration is not None:
+            self.duration = duration
+        if timeout is not None:
+            self.timeout = timeout
+
+    @staticmethod
+    def filter_diffusions(queryset, now, duration):
+        """ Filter diffusions queryset to load in timelines. """
+        return queryset.on_air() \
+                       .filter(start__lte=now + duration, end__gte=now,
+                               episode__sound__type=Sound.TYPE_ARCHIVE) \
+                       .select_related('episode').distinct() \
+                       .order_by('start')
+
+    @staticmethod
+    def get_related(diffs, logs, pending):
+        """
+        Return `(playlists, started)` for the given diffusions, where
+        `playlists` are archives' paths by episode id, and `started` the
+        set of `(station_id, diffusion_id)` having a start log (from
+        `logs` queryset or `pending` logs).
+        """
+        playlists = {}
+        paths = Sound.objects.archive() \
+                     .filter(episode__in={d.episode_id for d in diffs},
+                             path__isnull=False) \
+                     .order_by('path').values_list('episode_id', 'path')
+        for episode_id, path in paths:
+            playlists.setdefault(episode_id, []).append(path)
+
+        started = set(logs.start().filter(diffusion__in=diffs)
+                          .values_list('station_id', 'diffusion_id'))
+        started.update((log.station_id, log.diffusion_id) for log in pending
+                       if log.type == Log.TYPE_START)
+        return playlists, started
+
+    def get_queryset(self, now):
+        """ Return queryset of diffusions to load in the timeline. """
+        return self.filter_diffusions(
+            Diffusion.objects.station(self.station), now, self.duration)
+
+    def is_outdated(self, now):
+        if self.group is not None:
+            return self.items is None or self.group.is_outdated(now)
+        return self.items is None or now >= self.next_refresh or \
+            self.version != signals.get_version(signals.DIFFUSIONS)
+
+    def refresh(self, now=None):
+        """ Load timeline from the database. """
+        now = now or tz.now()
+        if self.group is not None:
+            self.group.refresh(now)
+            return
+
+        version = signals.get_version(signals.DIFFUSIONS)
+        # get pending logs before querying the database: they can be
+        # written meanwhile.
+        pending = self.log_writer.pending(self.station) \
+            if self.log_writer is not None else []
+        diffs = list(self.get_queryset(now))
+        playlists, started = self.get_related(
+            diffs, Log.objects.station(self.station), pending)
+        self.load(now, version, diffs, playlists, started)
+
+    def load(self, now, version, diffs, playlists, started):
+        """ Set timeline items (see `refresh` and `get_related`). """
+        station_id = self.station.pk
+        items = [TimelineItem(diff, playlists.get(diff.episode_id, []),
+                              (station_id, diff.pk) in started)
+                 for diff in diffs]
+        self.items, self.starts = items, [item.start for item in items]
+        self.version = version
+        self.next_refresh = now + self.timeout
+
+    def get(self, now=None):
+        """
+        Return the first item of diffusions running at the given date (or
+        None).
+        """
+        now = now or tz.now()
+        if self.is_outdated(now):
+            self.refresh(now)
+
+        index = bisect_right(self.starts, now)
+        return next((item for item in self.items[:index]
+                     if item.end >= now), None)
+
+    def remove(self, item):
+        """ Remove item from the timeline. """
+        index = self.items.index(item)
+        del self.items[index]
+        del self.starts[index]
+
+
+class TimelineGroup:
+    """
+    Timelines of multiple stations loaded altogether, such as the count of
+    queries run to refresh them does not depend on the count of stations.
+
+    Timelines are refreshed at once, when one of them is outdated.
+    """
+    duration = DiffusionTimeline.duration
+    """ Timespan of loaded diffusions, starting from now """
+    timeout = DiffusionTimeline.timeout
+    """ Max delay before reloading timelines """
+    log_writer = None
+    """ LogWriter whose start logs are taken in account """
+    timelines = None
+    """ Timelines by station id """
+    next_refresh = None
+    """ Datetime of the next refresh """
+    version = None
+    """ Version of the data at last refresh """
+
+    def __init__(self, duration=None, timeout=None, log_writer=None):
+        self.log_writer = log_writer
+        if duration is not None:
+            self.duration = duration
+        if timeout is not None:
+            self.timeout = timeout
+        self.timelines = {}
+        self.lock = threading.Lock()
+
+    def get_timeline(self, station):
+        """ Return timeline of the given station. """
+        timeline = self.timelines.get(station.pk)
+        if timeline is None:
+            timeline = DiffusionTimeline(station, self.duration, self.timeout,
+                                         self.log_writer, group=self)
+            self.timelines[station.pk] = timeline
+            self.next_refresh = None
+        return timeline
+
+    def get_queryset(self, now):
+        """ Return queryset of diffusions to load in the timelines. """
+        return DiffusionTimeline.filter_diffusions(
+            Diffusion.objects.filter(program__station__in=list(self.timelines)),
+            now, self.duration
+        ).annotate(station_id=F('program__station_id'))
+
+    def is_outdated(self, now):
+        return self.next_refresh is None or now >= self.next_refresh or \
+            self.version != signals.get_version(signals.DIFFUSIONS)
+
+    def refresh(self, now=None):
+        """ Load all timelines from the database. """
+        now = now or tz.now()
+        # monitors can run in different threads
+        with self.lock:
+            if not self.is_outdated(now) and all(
+                    t.items is not None for t in self.timelines.values()):
+                return
+
+            version = signals.get_version(signals.DIFFUSIONS)
+            pending = self.log_writer.pending() \
+                if self.log_writer is not None else []
+            diffs = list(self.get_queryset(now))
+            playlists, started = DiffusionTimeline.get_related(
+                diffs, Log.objects.filter(station__in=list(self.timelines)),
+                pending)
+
+            by_station = {}
+            for diff in diffs:
+                by_station.setdefault(diff.station_id, []).append(diff)
+            for station_id, timeline in self.timelines.items():
+                timeline.load(now, version, by_station.get(station_id, []),
+                              playlists, started)
+            self.version = version
+            self.next_refresh = now + self.timeout
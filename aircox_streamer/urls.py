@@ -3,11 +3,13 @@ from django.utils.translation import ugettext_lazy as _
 
 from . import viewsets
 from aircox.viewsets import SoundViewSet
-from .views import StreamerAdminMixin
+from .views import MetricsView, StreamerAdminMixin
 
 
 admin.site.route_view('tools/streamer', StreamerAdminMixin.as_view(),
                       'tools-streamer', label=_('Streamer Monitor'))
+admin.site.route_view('tools/streamer/metrics', MetricsView.as_view(),
+                      'tools-streamer-metrics')
 
 streamer_prefix = 'streamer/(?P<station_pk>[0-9]+)/'
 
@@ -1,11 +1,27 @@
+from django.http import HttpResponse
 from django.utils.translation import ugettext_lazy as _
-from django.views.generic import TemplateView
+from django.views.generic import TemplateView, View
 
+from aircox.models import Station
 from aircox.views.admin import AdminMixin
 
+from . import metrics
+
 
 class StreamerAdminMixin(AdminMixin, TemplateView):
     template_name = 'aircox_streamer/streamer.html'
     title = _('Streamer Monitor')
 
 
+class MetricsView(View):
+    """
+    Render metrics published by the monitors of active stations, in
+    Prometheus text format.
+    """
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def get(self, request, *args, **kwargs):
+        station_ids = Station.objects.active().values_list('pk', flat=True)
+        registry = metrics.load(station_ids)
+        return HttpResponse(registry.render(), content_type=self.content_type)
+
@@ -10,7 +10,7 @@ from rest_framework.response import Response
 
 from aircox.models import Sound, Station
 from aircox.serializers import SoundSerializer
-from . import controllers
+from . import controllers, state
 from .serializers import *
 
 
@@ -44,6 +44,10 @@ class Streamers:
                           for station in stations}
 
     def fetch(self):
+        """
+        Update streamers from the snapshots published by the monitor, or
+        fetch data from liquidsoap when there is none.
+        """
         if self.streamers is None:
             self.load()
 
@@ -52,7 +56,8 @@ class Streamers:
             return
 
         for streamer in self.streamers.values():
-            streamer.fetch()
+            if not state.load(streamer):
+                streamer.fetch()
         self.date = now + self.timeout
 
     def get(self, key, default=None):
@@ -0,0 +1,249 @@
+"""
+Run streamers in worker processes (one per station), supervised by the
+parent process: crashed or stalled workers are restarted with backoff.
+Workers regularly report to the supervisor that they are alive; their
+timing metrics are the monitor's ones (see `aircox_streamer.metrics`).
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from django.db import connections
+from django.utils import timezone as tz
+
+from aircox.models import Station
+
+from .controllers import Streamer
+from .events import EventListener
+from .log_writer import LogWriter
+from .monitor import Monitor
+
+
+__all__ = ['Worker', 'Supervisor', 'run_worker', 'exit_on_sigterm']
+
+
+logger = logging.getLogger('aircox')
+
+
+def exit_on_sigterm():
+    """
+    Raise SystemExit on SIGTERM, so that `finally` clauses run (default
+    handler exits right away). Must be called from the main thread.
+    """
+    def on_sigterm(signum, frame):
+        raise SystemExit(128 + signum)
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+
+def run_worker(station_id, reports, cpus=None, config=False, run=False,
+               monitor=True, delay=tz.timedelta(seconds=1),
+               timeout=tz.timedelta(minutes=Monitor.cancel_timeout),
+               events=False, log_interval=0,
+               report_interval=5.0, **monitor_kwargs):
+    """
+    Worker process' main function: generate config, run the process and
+    monitor a single station, reporting it is alive in `reports` queue
+    every `report_interval` seconds.
+
+    Liquidsoap is killed when the worker exits, including on SIGTERM.
+    """
+    # liquidsoap must be killed when the supervisor stops the worker
+    exit_on_sigterm()
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+    streamer = Streamer(Station.objects.get(pk=station_id))
+    if config:
+        streamer.events = events
+        streamer.make_config()
+    if run:
+        streamer.run_process()
+
+    log_writer = None
+    try:
+        if monitor:
+            if log_interval:
+                log_writer = monitor_kwargs['log_writer'] = \
+                    LogWriter(interval=log_interval)
+            if events:
+                monitor_kwargs['events'] = EventListener(streamer.events_path)
+            monitor_loop(Monitor(streamer, delay, timeout, **monitor_kwargs),
+                         reports, run, delay, report_interval)
+        elif run:
+            streamer.wait_process()
+    finally:
+        # worker processes exit without running atexit functions
+        if log_writer is not None:
+            log_writer.flush()
+        streamer.kill_process()
+
+
+def monitor_loop(monitor, reports, run, delay, report_interval):
+    """ Run monitor, and report it is alive. """
+    next_report = time.monotonic()
+    streamer = monitor.streamer
+    while True:
+        start = time.monotonic()
+        if not run or streamer.supervise_process():
+            monitor.monitor()
+        duration = time.monotonic() - start
+
+        if start >= next_report:
+            reports.put({'station': monitor.station.pk, 'pid': os.getpid()})
+            next_report = start + report_interval
+
+        timeout = monitor.get_timeout(max(0, delay.total_seconds() -
+                                          duration))
+        if monitor.events is not None:
+            monitor.events.wait(timeout)
+        else:
+            time.sleep(timeout)
+
+
+class Worker:
+    """ Worker process of a station, as handled by the supervisor. """
+    station_id = None
+    """ Id of the station """
+    cpus = None
+    """ Set of cpus the process is pinned to """
+    process = None
+    """ Running multiprocessing.Process """
+    started = None
+    """ Monotonic time of the last start """
+    next_start = None
+    """ Monotonic time of the next start, when not running """
+    backoff = 0
+    """ Current delay in seconds before restarting the worker """
+    restarts = 0
+    """ Count of restarts """
+    last_report = None
+    """ Monotonic time of the last report """
+
+    def __init__(self, station_id, cpus=None):
+        self.station_id = station_id
+        self.cpus = cpus
+
+    @property
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+class Supervisor:
+    """
+    Run a worker process for each station, restart them when they exit or
+    stop reporting.
+    """
+    backoff = 1.0
+    """ Initial delay in seconds before restarting a worker """
+    max_backoff = 60.0
+    """ Max delay in seconds before restarting a worker """
+    stable_time = 60.0
+    """ Backoff is reset once a worker has run this time (in seconds) """
+    health_timeout = 60.0
+    """
+    Worker is restarted when it did not report since this time (in
+    seconds). Must be greater than workers' report interval.
+    """
+    workers = None
+    """ Workers by station id """
+    options = None
+    """ Keyword arguments passed to `run_worker` """
+    reports = None
+    """ Queue of workers' reports """
+
+    def __init__(self, station_ids, cpus=None, **options):
+        """
+        :param station_ids: ids of stations to run workers for;
+        :param cpus: list of cpus workers are pinned to, each worker is
+            assigned one of them in turn;
+        :param **options: arguments passed to `run_worker`.
+        """
+        self.workers = {
+            station_id: Worker(station_id,
+                               {cpus[i % len(cpus)]} if cpus else None)
+            for i, station_id in enumerate(station_ids)
+        }
+        self.options = options
+        self.reports = multiprocessing.Queue()
+
+    def start(self, worker):
+        """ Start worker's process. """
+        # database connections must not be shared with children
+        connections.close_all()
+        worker.process = multiprocessing.Process(
+            target=run_worker, args=(worker.station_id, self.reports),
+            kwargs=dict(self.options, cpus=worker.cpus),
+            name='aircox-streamer-{}'.format(worker.station_id),
+        )
+        worker.process.start()
+        worker.started = worker.last_report = time.monotonic()
+        worker.next_start = None
+        logger.info('worker %s: started, pid %s', worker.station_id,
+                    worker.process.pid)
+
+    def stop(self, worker, timeout=10):
+        """ Stop worker's process. """
+        if worker.process is None:
+            return
+        worker.process.terminate()
+        worker.process.join(timeout)
+        if worker.process.is_alive():
+            worker.process.kill()
+            worker.process.join()
+        worker.process = None
+
+    def schedule_restart(self, worker, now, reason):
+        """ Schedule restart of a stopped worker, with backoff. """
+        if now - worker.started >= self.stable_time:
+            worker.backoff = self.backoff
+        else:
+            worker.backoff = min(self.max_backoff,
+                                 max(self.backoff, worker.backoff * 2))
+        worker.process = None
+        worker.next_start = now + worker.backoff
+        worker.restarts += 1
+        logger.warning('worker %s: %s, restart in %ss', worker.station_id,
+                       reason, worker.backoff)
+
+    def read_reports(self, now):
+        """ Read workers' reports. """
+        while True:
+            try:
+                report = self.reports.get_nowait()
+            except queue.Empty:
+                return
+            worker = self.workers.get(report['station'])
+            if worker is not None:
+                worker.last_report = now
+
+    def check(self):
+        """ Read reports, restart exited and stalled workers. """
+        now = time.monotonic()
+        self.read_reports(now)
+        for worker in self.workers.values():
+            if worker.process is not None and not worker.is_alive:
+                self.schedule_restart(worker, now, 'exited with code {}'
+                                      .format(worker.process.exitcode))
+            elif worker.is_alive and self.options.get('monitor', True) and \
+                    now - worker.last_report > self.health_timeout:
+                self.stop(worker)
+                self.schedule_restart(worker, now, 'no report since {}s'
+                                      .format(int(now - worker.last_report)))
+
+            if worker.process is None and (worker.next_start is None or
+                                           worker.next_start <= now):
+                self.start(worker)
+
+    def run(self, interval=1.0):
+        """ Run workers until interrupted (including by SIGTERM). """
+        exit_on_sigterm()
+        try:
+            while True:
+                self.check()
+                time.sleep(interval)
+        finally:
+            for worker in self.workers.values():
+                self.stop(worker)